@@ -14,13 +14,22 @@ features are not as extensively tested.
 .. warning:: This library has not been thoroughly tested yet!
 """
 
-import os, sys, glob, shutil, warnings
+import os, sys, glob, shutil, warnings, time
+import multiprocessing
 import cPickle as pickle
 
 import numpy as np
 import pandas
-import mvpa2.suite
-import nibabel as nb
+# PyMVPA and NiBabel are needed to load and decode data but not for the
+# array computations, which can thus be used (and tested) without them
+try:
+    import mvpa2.suite
+except ImportError:
+    mvpa2 = None
+try:
+    import nibabel as nb
+except ImportError:
+    nb = None
 
 # some modules are only available in Python 2.6
 try:
@@ -97,7 +106,8 @@ class Analysis(object):
             ('verbose', True),
             ('visualize', False),
             ('force', False),
-            ('dry', False)
+            ('dry', False),
+            ('workers', 1)
             ])
         if extraInfo is not None:
             self.extraInfo.update(extraInfo)
@@ -184,14 +194,27 @@ class Analysis(object):
         plt.show()
 
     def run_method(self, subjIDs, runType, rois, method='svm', values='raw',
-                offset=None, dur=None, filename = 'RENAME.pkl', simds=None):
+                offset=None, dur=None, filename='%s_%s_%s.pkl', simds=None,
+                workers=None):
         """
         A wrapper for running a specified analysis.
 
-        Process:
+        Each participant and ROI is a separate job. Participants are run one
+        after another (see :func:`run_subject`): all ROIs of a participant
+        are extracted in a single pass over the data (see
+        :func:`extract_rois`) and passed to the participant's jobs, also
+        when `runParams['noOutput']` is set, before the next participant is
+        extracted. The jobs of a participant are run in a pool of `workers`
+        processes, and the result of each job is stored as soon as it
+        finishes, so an interrupted analysis resumes from the completed
+        jobs.
+
+        Process (per job):
             1. Attempt to load stored results from the analysis that was done
-               before. (stored in teh analysis folder in a file
-               `<method>_<values>_<subjID>.pkl`
+               before. (stored in the analysis folder in a file
+               `<method>_<values>_<subjID>_<ROI>.pkl`; for 'corr' and 'svm',
+               results of all ROIs stored per participant in
+               `<method>_<values>_<subjID>.pkl` are loaded too)
             2. If that fails, it's probably because the analysis has
                not been performed yet or, in rare cases, because the data
                file is corrupt or missing. So a new analysis is initiated.
@@ -202,6 +225,10 @@ class Analysis(object):
                 3. Extracted ROIs are stored in ``PATHS['data_rois']``.
                 4. Finally, the specified analysis is performed.
 
+        How long each job took is stored in `self.timing`, a list of dicts
+        with 'subjID', 'ROI', 'method', 'values', 'time' (in seconds) and
+        'loaded' (whether results were loaded from a stored file) keys.
+
         :Args:
             - subjIDs (str of list of str)
                 Which participants should be analyzed
@@ -223,97 +250,217 @@ class Analysis(object):
                 e.g.:
                     offset = {'V1': 4, 'V2': 4, 'V3': 4, 'LO': 3, 'pFs': 3}
                     dur = 1
+            - filename (str, default: '%s_%s_%s.pkl')
+                Pattern of result file names, filled in with the method,
+                values and participant ID; the ROI name is appended to it
+            - workers (int, default: None)
+                Number of processes to run jobs in. If None,
+                `runParams['workers']` is used (default: 1), so it can be
+                set for :func:`run`, too.
         """
-
         if type(subjIDs) not in [list, tuple]:
             subjIDs = [subjIDs]
-        results = []
-        #loadable = []
-        ## quick way to see if we need to import mvpa2.suite
-        #for sNo, subjID in enumerate(subjIDs):
-            #try:
-                #filename_full = filename % (method, values, subjID)
-            #except:
-                #pass
-            #loadable.append(os.path.isfile(filename_full))
-        #import pdb; pdb.set_trace()
-        #if not np.all(loadable):
+        if workers is None:
+            workers = self.runParams.get('workers', 1)
+        force = self.runParams.get('force', False)
+        try:
+            filename % (method, values, 'subjID')
+        except TypeError:
+            raise ValueError('filename must be a pattern with three %%s '
+                             'fields (method, values and participant ID), '
+                             'got %r' % filename)
+
+        todo = []
+        done = {}
+        self.timing = []
+        for subjID in subjIDs:
+            subj_res = None
+            if method in ['corr', 'svm'] and not force:
+                subj_res = self._load_results(filename % (method, values,
+                                                          subjID))
+            for ROI_list in rois:
+                job = (subjID, ROI_list[1])
+                res = None
+                if subj_res is not None:
+                    header, result = subj_res
+                    result = [line for line in result
+                              if line[-2:] == [subjID, ROI_list[1]]]
+                    # ROIs added since the file was stored are computed
+                    if len(result) > 0:
+                        res = (header, result)
+                if res is None and not force:
+                    res = self._load_results(self._job_fname(filename,
+                                             method, values, subjID,
+                                             ROI_list[1]))
+                if res is not None:
+                    done[job] = res
+                    self._add_timing(subjID, ROI_list[1], method, values,
+                                     None, True)
+                else:
+                    todo.append((subjID, runType, ROI_list, method, values,
+                                 offset, dur, filename, simds))
 
+        # each participant's ROIs are extracted in a single pass over the
+        # data and its jobs are run (and stored) before the next participant
+        # is extracted, so only one participant's data is held at a time
+        subj_jobs = []
+        for subjID in subjIDs:
+            jobs = [job for job in todo if job[0] == subjID]
+            if len(jobs) > 0:
+                subj_jobs.append(jobs)
+
+        if len(todo) > 0:
+            print 'running %d %s %s jobs (%d loaded)' % (len(todo), method,
+                                                          values, len(done))
+        if workers > 1 and len(todo) > 1:
+            pool = multiprocessing.Pool(workers)
+        else:
+            pool = None
+        try:
+            for jobs in subj_jobs:
+                for out in self.run_subject(jobs, pool=pool):
+                    self._job_done(done, *out)
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        header = None
+        results = []
         for subjID in subjIDs:
-            print subjID,
+            for ROI_list in rois:
+                header, result = done[(subjID, ROI_list[1])]
+                results.extend(result)
+        return header, results
+
+    def run_subject(self, jobs, pool=None):
+        """
+        Runs jobs of a single participant (see :func:`run_method`), with
+        all their ROIs extracted in a single pass over the data first
+        (see :func:`extract_rois`).
+
+        :Args:
+            jobs (list)
+                Arguments of :func:`run_job` (without `ds`) of each job
+
+        :Kwargs:
+            pool (multiprocessing.Pool, default: None)
+                Pool of processes to run jobs in; if None, jobs are run
+                one after another
+
+        :Returns:
+            A generator of :func:`run_job` outputs of each job, in the
+            order they finish
+        """
+        subjID, runType, values, simds = [jobs[0][i] for i in (0, 1, 4, 8)]
+        if simds is None:
+            dss = self.extract_rois(subjID, runType,
+                                    [job[2] for job in jobs], values=values)
+        else:
+            dss = [None] * len(jobs)
+        if pool is None:
+            for job, ds in zip(jobs, dss):
+                yield self.run_job(*(job + (ds,)))
+        else:
+            for out in pool.imap_unordered(_run_job_worker,
+                                [(self,) + job + (ds,)
+                                 for job, ds in zip(jobs, dss)]):
+                yield out
+
+    def _job_done(self, done, subjID, roi, method, values, header, result,
+                  dur):
+        done[(subjID, roi)] = (header, result)
+        self._add_timing(subjID, roi, method, values, dur, False)
+        print '%s %s: %.1f s' % (subjID, roi, dur)
+
+    def _add_timing(self, subjID, roi, method, values, dur, loaded):
+        self.timing.append({'subjID': subjID, 'ROI': roi, 'method': method,
+                            'values': values, 'time': dur, 'loaded': loaded})
+
+    def _job_fname(self, filename, method, values, subjID, roi):
+        return '%s_%s.pkl' % (os.path.splitext(filename % (method, values,
+                                                            subjID))[0], roi)
+
+    def _load_results(self, fname):
+        """Returns stored header and results or None if there are none"""
+        try:
+            header, result = pickle.load(open(fname, 'rb'))
+        except:
+            return None
+        return header, result
+
+    def run_job(self, subjID, runType, ROI_list, method='svm', values='raw',
+                offset=None, dur=None, filename='%s_%s_%s.pkl', simds=None,
+                ds=None):
+        """
+        Runs a specified analysis for a single participant and ROI and
+        stores its results (see :func:`run_method` for parameters).
+
+        `ds` are samples of the ROI that were already extracted (see
+        :func:`extract_rois`); if None, they are extracted here.
+
+        :Returns:
+            Participant ID, ROI name, method, values, a header, a results
+            matrix with 'subjID' and 'ROI' columns, and how long it took
+            in seconds
+        """
+        start = time.time()
+        if simds is not None:
+            values = 'sim'
+            ds = simds
+        elif ds is None:
+            ds = self.extract_samples(subjID, runType, ROI_list,
+                                      values=values)
+        if values.startswith('raw'):
+            ds = self.detrend(ds)
+            if type(offset) == dict:  # different offsets for ROIs
+                off = offset[ROI_list[1]]
+            else:
+                off = offset
+            ds = self.nan_to_num(ds, value=0)
+            evds = self.ds2evds(ds, offset=off, dur=dur)
+        elif values in ['t', 'beta', 'sim']:
+            # SPM sets certain voxels to NaNs
+            # we just gonna convert them to 0
+            evds = self.nan_to_num(ds)
+
+        if method == 'timecourse':
+            header, result = self.get_timecourse(evds)
+        elif method in ['signal', 'univariate']:
+            header, result = self.get_signal(evds, values)
+        elif method == 'corr':
+            evds = evds[evds.sa.targets != 0]
+            header, result = self.correlation(evds, nIter=100)
+        elif method == 'svm':
+            evds = evds[evds.sa.targets != 0]
+            header, result = self.svm(evds, nIter=100)
+        else:
+            raise NotImplementedError('Analysis for %s values is not '
+                                      'implemented' % method)
+
+        header = header + ['subjID', 'ROI']
+        for line in result:
+            line.extend([subjID, ROI_list[1]])
+
+        if not self.runParams['noOutput']:
+            fname = self._job_fname(filename, method, values, subjID,
+                                    ROI_list[1])
             try:
-                out_fname = filename % (method, values, subjID)
+                os.makedirs(os.path.dirname(fname))
             except:
                 pass
-            loaded = False
-            if method in ['corr', 'svm']:
-                try:
-                    header, result = pickle.load(open(out_fname,'rb'))
-                    results.extend(result)
-                    # result = pickle.load(open(filename,'rb'))
-                    # header = [i[0] for i in result[0]]
-                    # for res in result:
-                    #     results.append([r[1] for r in res])
-                    print ': loaded stored %s results' % values
-                    loaded = True
-                except:
-                    print
-                    print "Could not load or find the results file %s" % out_fname
-                    print "Will proceed to do %s analysis from scratch" % method
-            if not loaded:
-                temp_res = []
-                for r, ROI_list in enumerate(rois):
-                    print ROI_list[1],
-                    if simds is not None:
-                        values = 'sim'
-                    else:
-                        ds = self.extract_samples(subjID, runType, ROI_list,
-                                                  values=values)
-                    if values.startswith('raw'):
-                        ds = self.detrend(ds)
-                        if type(offset) == dict:  # different offsets for ROIs
-                            off = offset[ROI_list[1]]
-                        else:
-                            off = offset
-                        ds = self.nan_to_num(ds, value=0)
-                        evds = self.ds2evds(ds, offset=off, dur=dur)
-                    elif values in ['t', 'beta', 'sim']:
-                        # SPM sets certain voxels to NaNs
-                        # we just gonna convert them to 0
-                        evds = self.nan_to_num(ds)
-
-                    if method == 'timecourse':
-                        header, result = self.get_timecourse(evds)
-                    elif method in ['signal', 'univariate']:
-                        header, result = self.get_signal(evds, values)
-                    elif method == 'corr':
-                        evds = evds[evds.sa.targets != 0]
-                        header, result = self.get_correlation(evds, nIter=100)
-                    elif method == 'svm':
-                        evds = evds[evds.sa.targets != 0]
-                        header, result = self.get_svm(evds, nIter=100)
-                    else:
-                        raise NotImplementedError('Analysis for %s values is not '
-                                                  'implemented')
-
-                    header.extend(['subjID', 'ROI'])
-                    for line in result:
-                        line.extend([subjID, ROI_list[1]])
-                        temp_res.append(line)
-                print
-                results.extend(temp_res)
-
-                # import pdb; pdb.set_trace()
-                if not self.noOutput and method in ['corr', 'svm']:
-                    # mvpa2.suite.h5save(rp.o, results)
-                    try:
-                        os.makedirs(self.paths['analysis'])
-                    except:
-                        pass
+            # write to a temporary file first so that an interrupted run
+            # never leaves a partially written result
+            pickle.dump([header, result], open(fname + '.tmp', 'wb'))
+            os.rename(fname + '.tmp', fname)
 
-                    pickle.dump([header,temp_res], open(out_fname,'wb'))
+        return (subjID, ROI_list[1], method, values, header, result,
+                time.time() - start)
 
-        return header, results
+    def nan_to_num(self, ds, value=0):
+        """Replaces NaNs in a dataset with a given value"""
+        ds.samples[np.isnan(ds.samples)] = value
+        return ds
 
     #def time_course(self):
         #ds = self.extract_samples(subjID, runType, ROI_list,
@@ -398,35 +545,96 @@ class Analysis(object):
             ds (Dataset)
 
         """
+        return self.extract_rois(subjID, runType, [ROIs], values=values)[0]
+
+    def extract_rois(self, subjID, runType, rois, values='raw'):
+        """
+        Produces datasets of several ROIs in a single pass over the data.
+
+        Datasets that were extracted before are loaded from
+        ``PATHS['data_rois']``. For the remaining ROIs, each functional run
+        (or beta or t-value image) is read only once with a mask of all of
+        these ROIs together, and each ROI's voxels are then selected by
+        their indices among the loaded voxels. Each ROI file is read once,
+        too. All extracted datasets are stored at once.
+
+        :Args:
+            - subjID (str)
+                participant ID
+            - runType (str)
+                run type
+            - rois (list)
+                ROI patterns as produced by :func:`make_roi_pattern`
+
+        :Kwargs:
+            values (str, default: 'raw')
+                What kind of values should be used. Usually you
+                have 'raw', 'beta', and 't'.
 
-        reuse = True
+        :Returns:
+            A list of datasets, one per ROI
+        """
         if values.startswith('raw'):
             add = ''
         else:
             add = '_' + values
-        suffix = ROIs[1] + add + '.gz.hdf5'
-        roiname = self.paths['data_rois'] %subjID + suffix
-        if reuse and os.path.isfile(roiname):
-            ds = mvpa2.suite.h5load(roiname)
-            print '(loaded)',
-            return ds
-
-        # else
-        # make a mask by combining all ROIs
-        allROIs = []
-        for ROI in ROIs[2]:
-            theseROIs = glob.glob((self.paths['rec'] + ROI + '.nii') %subjID)
-            allROIs.extend(theseROIs)
-        # add together all ROIs -- and they should not overlap too much
-        thisMask = sum([self.get_data(roi) for roi in allROIs])
+        roinames = [self.paths['data_rois'] % subjID + ROIs[1] + add +
+                    '.gz.hdf5' for ROIs in rois]
+        dss = [None] * len(rois)
+        todo = []
+        for r, roiname in enumerate(roinames):
+            if os.path.isfile(roiname):
+                dss[r] = mvpa2.suite.h5load(roiname)
+                print '(loaded)',
+            else:
+                todo.append(r)
+        if len(todo) == 0:
+            return dss
+
+        # make a mask of each ROI by combining all its ROI files
+        roi_data = {}
+        masks = []
+        for r in todo:
+            allROIs = []
+            for ROI in rois[r][2]:
+                theseROIs = glob.glob((self.paths['rec'] + ROI + '.nii') %subjID)
+                allROIs.extend(theseROIs)
+            for roi in allROIs:
+                if roi not in roi_data:
+                    roi_data[roi] = self.get_data(roi)
+            # add together all ROIs -- and they should not overlap too much
+            masks.append(sum([roi_data[roi] for roi in allROIs]))
+        union = np.any([mask != 0 for mask in masks], axis=0)
+
+        ds_all = self._load_samples(subjID, runType, union, values=values)
+        # each ROI is a set of indices of the loaded voxels; they are
+        # selected with a mapper so that ROI datasets can be mapped back to
+        # volumes (e.g., with map2nifti)
+        voxels = np.ravel_multi_index(ds_all.fa.voxel_indices.T, union.shape)
+        for r, mask in zip(todo, masks):
+            inds = np.flatnonzero(np.in1d(voxels, np.flatnonzero(mask)))
+            dss[r] = ds_all.get_mapped(
+                                mvpa2.suite.StaticFeatureSelection(inds))
 
+        if not self.runParams['noOutput']:  # save the extracted data
+            try:
+                os.makedirs(self.paths['data_rois'] %subjID)
+            except:
+                pass
+            for r in todo:
+                mvpa2.suite.h5save(roinames[r], dss[r], compression=9)
+
+        return dss
+
+    def _load_samples(self, subjID, runType, mask, values='raw'):
+        """Loads data of a given participant and run type within a mask"""
         if values.startswith('raw'):
             # find all functional runs of a given runType
             allImg = glob.glob((self.paths['data_fmri'] + self.fmri_prefix + \
                                runType + '.nii') % subjID)
             data_path = self.paths['data_behav']+'data_%02d_%s.csv'
             labels = self.extract_labels(allImg, data_path, subjID, runType)
-            ds = self.fmri_dataset(allImg, labels, thisMask)
+            ds = self.fmri_dataset(allImg, labels, mask)
         elif values == 'beta':
             data_path = self.paths['data_behav'] + 'data_*_%s.csv'
             behav_data = self.read_csvs(data_path %(subjID, runType))
@@ -451,7 +659,7 @@ class Analysis(object):
                     samples = allImg[runNo*nLabels:(runNo+1)*nLabels].tolist(),
                     targets = labels,
                     chunks = runNo,
-                    mask = thisMask
+                    mask = mask
                     ))
             ds = mvpa2.suite.vstack(ds)
         elif values == 't':
@@ -474,18 +682,11 @@ class Analysis(object):
                 samples = allImg.tolist(),
                 targets = np.repeat(labels, numRuns).tolist(),
                 chunks = np.tile(np.arange(numRuns), len(labels)).tolist(),
-                mask = thisMask
+                mask = mask
                 )
         else:
             raise Exception('values %s are not recognized' % values)
 
-        if not self.runParams['noOutput']:  # save the extracted data
-            try:
-                os.makedirs(self.paths['data_rois'] %subjID)
-            except:
-                pass
-            mvpa2.suite.h5save(roiname, ds, compression=9)
-
         return ds
 
     def extract_labels(self, img_fnames, data_path, subjID, runType):
@@ -717,74 +918,56 @@ class Analysis(object):
         """
         return self.get_signal(evds, values)
 
-    def correlation(self, evds, nIter=100):
+    def correlation(self, evds, nIter=100, seed=None, fisher=False,
+                    compact=False):
         """
         Computes a correlation between multiple splits in half of the data.
 
-        Reported as one minus a correlation to provide a dissimilarity measure
-        as in svm.
+        Reported as one minus a correlation, divided by two, to provide a
+        dissimilarity measure as in svm.
+
+        All random splits are computed at once: split means are products of
+        a (nIter, chunks) split-assignment matrix and the data, and
+        correlations between splits are batched dot products of normalized
+        patterns.
 
         :Args:
             evds (event-related mvpa dataset)
 
         :Kwargs:
-            nIter (int, default: 100)
+            - nIter (int, default: 100)
                 Number of random splits in half of the entire dataset.
+            - seed (int, default: None)
+                Seed for random splits (see :func:`get_splits`)
+            - fisher (bool, default: False)
+                If True, correlations are averaged across splits using
+                Fisher's z-transform and reported as a single iteration
+            - compact (bool, default: False)
+                If True, conditions and an array of dissimilarities are
+                returned instead of a list of results
 
         :Returns:
             A header and a results matrix with four columns:
                 - iter: iteration number
                 - stim1.cond: first condition
                 - stim2.cond: second condition
-                - subjResp: one minus the correlation value
+                - subjResp: one minus the correlation value, divided by two
+            If `compact` is True, conditions and an array of shape
+            (nIter, conditions, conditions) are returned instead, where the
+            first dimension is dropped if `fisher` is True.
         """
-
         # calculate the mean per target per chunk (across trials)
         run_averager = mvpa2.suite.mean_group_sample(['targets','chunks'])
         evds_avg = evds.get_mapped(run_averager)
-        numT = len(evds_avg.UT)
-
-        # calculate mean across conditions per chunk per voxel
-        target_averager = mvpa2.suite.mean_group_sample(['chunks'])
-        mean = evds_avg.get_mapped(target_averager)
-        # subtract the mean chunk-wise
-        evds_avg.samples -= np.repeat(mean, numT, 0)
-
-        #results = np.zeros((nIter,numT,numT))
-        runtype = [0,1] * (len(evds_avg.UC)/2) + \
-                   [-1] * (len(evds_avg.UC)%2)
-                   # for odd number of chunks (will get rid of one)
-        targets = evds_avg.UT
-        header = ['iter', 'stim1.cond', 'stim2.cond', 'subjResp']
-        results = []
-        for n in range(nIter):
-            np.random.shuffle(runtype)
-            evds_avg.sa['runtype'] = np.repeat(runtype,numT)
-
-            evds_split1 = evds_avg[np.array([i==0 for i in evds_avg.sa.runtype])]
-            run_averager = mvpa2.suite.mean_group_sample(['targets'])
-            evds_split1 = evds_split1.get_mapped(run_averager)
-
-            evds_split2 = evds_avg[np.array([i==1 for i in evds_avg.sa.runtype])]
-            run_averager = mvpa2.suite.mean_group_sample(['targets'])
-            evds_split2 = evds_split2.get_mapped(run_averager)
-
-            result = mvpa2.clfs.distance.one_minus_correlation(evds_split1.samples, evds_split2.samples)/2
-
-            for i in range(0, numT):
-                for j in range(0, numT):
-                    results.append([n, targets[i], targets[j], result[i,j]])
+        return split_half_correlation(evds_avg.samples, evds_avg.sa.targets,
+                                      evds_avg.sa.chunks, nIter=nIter,
+                                      seed=seed, fisher=fisher,
+                                      compact=compact)
 
-        return header, results
-
-
-    def svm(self, evds, nIter=100, clf=mvpa2.suite.LinearNuSVMC()):
+    def svm(self, evds, nIter=100, clf=None, workers=1, seed=None):
         """
         Runs a support vector machine pairwise.
 
-        .. note: Might be not the most efficient implementation of SVM, but
-                 it is at least intuitive.
-
         Process:
             - Split data into a training set (about 75% of all values) and a testing
               set (about 25% of values).
@@ -793,101 +976,87 @@ class Analysis(object):
               samples. This trick usually boosts the performance (credit:
               Hans P. Op de Beeck)
 
+        Each unordered pair of conditions is trained once per split, and the
+        result is reported for both (i, j) and (j, i). Splits are generated
+        from `seed` and the iteration number only, so pairs and iterations
+        can be spread over several processes with exactly the same results
+        as when run serially.
+
         :Args:
             evds (event-related mvpa dataset)
 
         :Kwargs:
             - nIter (int, default: 100)
                 Number of random splits into a training and testing sets.
-            - clf (mvpa classfier, default: Linear Nu SVM)
+            - clf (mvpa classfier, default: None)
+                If None, a linear Nu SVM is used
+            - workers (int, default: 1)
+                Number of processes to train classifiers in
+            - seed (int, default: None)
+                Seed for random splits (see :func:`get_splits`)
 
         :Returns:
             A header and a results matrix with four columns:
                 - iter: iteration number
                 - stim1.cond: first condition
                 - stim2.cond: second condition
-                - subjResp: one minus the correlation value
+                - subjResp: classification accuracy (None for i == j)
         """
+        if clf is None:
+            clf = mvpa2.suite.LinearNuSVMC()
         # calculate the mean per target per chunk (across trials)
         run_averager = mvpa2.suite.mean_group_sample(['targets','chunks'])
         evds_avg = evds.get_mapped(run_averager)
         numT = len(evds_avg.UT)
 
         # subtract the mean across voxels (per target per chunk)
-        evds_avg.samples -= np.tile(np.mean(evds_avg, 1), (evds_avg.shape[1],1) ).T
+        evds_avg.samples -= np.mean(evds_avg.samples, axis=1)[:, np.newaxis]
         # and divide by standard deviation across voxels
-        evds_avg.samples /= np.tile(np.std(evds_avg, axis=1, ddof=1),
-            (evds_avg.shape[1],1) ).T
+        evds_avg.samples /= np.std(evds_avg.samples, axis=1,
+                                   ddof=1)[:, np.newaxis]
 
-        ## NEW
         if len(evds_avg.UC)%2:
             runtype = [0]*(len(evds_avg.UC)-9) + [1]*8 + [-1]
             # for odd number of chunks (will get rid of one)
         else:
             runtype = [0]*(len(evds_avg.UC)-8) + [1]*8
-        ###
 
-        ## OLD
-        # if len(evds_avg.UC)%2:
-        #     runtype = [0]*(len(evds_avg.UC)-3) + [1]*2 + [-1]
-        #     # for odd number of chunks (will get rid of one)
-        # else:
-        #    runtype = [0]*(len(evds_avg.UC)-2) + [1]*2
-        ###
+        # runtype of each sample per iteration
+        chunk_ind = np.searchsorted(evds_avg.UC, evds_avg.sa.chunks)
+        splits = get_splits(runtype, nIter, seed=seed)[:, chunk_ind]
+
+        targets = evds_avg.UT
+        plan = PairPlan(evds_avg.sa.targets, splits, targets)
+        tasks = [(n, i, j) for n in range(nIter) for i, j in plan.pairs]
+        state = (evds_avg.samples, evds_avg.sa.targets, plan, clf)
+        if workers > 1:
+            pool = multiprocessing.Pool(workers, initializer=_svm_init,
+                                        initargs=state)
+            try:
+                accs = pool.map(_svm_worker, tasks,
+                                chunksize=max(1, len(tasks) // (4*workers)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            accs = []
+            for task in tasks:
+                if task[1] == 0 and task[2] == 1:
+                    print task[0],
+                accs.append(_svm_pair(*(state + task)))
+            print
+        accs = dict(zip(tasks, accs))
 
-        #targets = evds_avg.UT
         header = ['iter', 'stim1.cond', 'stim2.cond', 'subjResp']
         results = []
         for n in range(nIter):
-            print n,
-            np.random.shuffle(runtype)
-            evds_avg.sa['runtype'] = np.repeat(runtype,numT)
-
-            evds_train = evds_avg[np.array([i==0 for i in evds_avg.sa.runtype])]
-            evds_test = evds_avg[np.array([i==1 for i in evds_avg.sa.runtype])]
-            ## NEW
-            # boost results by averaging test patterns over chunks
-            run_averager = mvpa2.suite.mean_group_sample(['targets'])
-            evds_test = evds_test.get_mapped(run_averager)
-            ###
-
             for i in range(0, numT):
                 for j in range(0, numT):
-                    targets = (evds_train.UT[i], evds_train.UT[j])
-                    if i==j:
+                    if i == j:
                         pred = None
-                    else:
-                        ind_train = np.array([k in targets for k in evds_train.sa.targets])
-                        evds_train_ij = evds_train[ind_train]
-
-                        ind_test = np.array([k in targets for k in evds_test.sa.targets])
-                        # keep = np.logical_not(np.isnan(evds_test))
-                        evds_test_ij = evds_test[ind_test]
-                        # evds_test_ij = evds_test_ij[:,keep]
-                        # fsel = mvpa2.suite.StaticFeatureSelection(keep)
-                        # clf = mvpa2.suite.LinearNuSVMC()
-                        # clf = mvpa2.suite.FeatureSelectionClassifier(clf, fsel)
-                        clf.train(evds_train_ij)
-                        #fsel = mvpa2.suite.SensitivityBasedFeatureSelection(
-                            #mvpa2.suite.OneWayAnova(),
-                            #mvpa2.suite.FractionTailSelector(0.05, mode='select', tail='upper'))
-                        #fclf = mvpa2.suite.FeatureSelectionClassifier(clf, fsel)
-                        #fclf.train(evds_train_ij)
-
-                        # sensana = clf.get_sensitivity_analyzer()
-                        # sens = sensana(evds_train_ij)
-                        # inds = np.argsort(np.abs(sens.samples))
-                        # inds = np.squeeze(inds)
-                        # evds_train_ij.samples = evds_train_ij.samples[:,inds>=len(inds)-100]
-                        # #import pdb; pdb.set_trace()
-                        # clf.train(evds_train_ij)
-
-                        # test_samp = evds_test_ij.samples[:,inds>=len(inds)-100]
-                        # predictions = clf.predict(test_samp)
-                        predictions = clf.predict(evds_test_ij.samples)
-                        pred = np.mean(predictions == evds_test_ij.sa.targets)
-                    results.append([n, targets[0], targets[1], pred])
-        print
+                    else:  # the same classifier for (i,j) and (j,i)
+                        pred = accs[(n, min(i,j), max(i,j))]
+                    results.append([n, targets[i], targets[j], pred])
 
         return header, results
 
@@ -924,53 +1093,47 @@ class Analysis(object):
         # nfolds = mvpa2.suite.NFoldPartitioner(cvtype=cvtype,count=10,selection_strategy='equidistant')
         # import pdb; pdb.set_trace()
 
-        for n in range(nIter):
-            print n,
-            # we want each iteration to have a different (random) split
-            np.random.shuffle(runtype)
-            # for each datapoint within a chunk, assign the same runtype
-            evds.sa['runtype'] = np.repeat(runtype,len(evds.sa.chunks)/len(evds.UC))
-            # create an average per target per chunk (per voxel)
-            run_averager = mvpa2.suite.mean_group_sample(['targets','chunks'])
-            evds_avg = evds.get_mapped(run_averager)
+        # create an average per target per chunk (per voxel); splits only
+        # relabel chunks, so this is done once
+        run_averager = mvpa2.suite.mean_group_sample(['targets','chunks'])
+        evds_avg = evds.get_mapped(run_averager)
+        samples = evds_avg.samples
+        sample_targets = evds_avg.sa.targets
+        targets = evds_avg.UT
+        # we want each iteration to have a different (random) split, with
+        # the same runtype for each datapoint within a chunk
+        chunk_ind = np.searchsorted(evds_avg.UC, evds_avg.sa.chunks)
+        splits = get_splits(runtype, nIter)[:, chunk_ind]
+        plan = PairPlan(sample_targets, splits, targets)
 
+        for n, split in enumerate(splits):
+            print n,
             # calculate mean and standard deviation across conditions per voxel
-            ds_split_train = evds_avg[np.array([i==0 for i in evds_avg.sa.runtype])]
-            mean_train = np.mean(ds_split_train,0)  # mean per voxel
-            sd_train = np.std(ds_split_train, axis=0, ddof=1)
-
-            ds_split_test = evds_avg[np.array([i==1 for i in evds_avg.sa.runtype])]
-            mean_test = np.mean(ds_split_test,0)
-            sd_test = np.std(ds_split_test, axis=0, ddof=1)
-
-            targets = ds_split_train.UT
-            if np.sum(targets != ds_split_test.UT)>0:
+            train = split == 0
+            samples_train = samples - np.mean(samples[train], 0)
+            samples_train /= np.std(samples[train], axis=0, ddof=1)
+            test = split == 1
+            samples_test = samples - np.mean(samples[test], 0)
+            samples_test /= np.std(samples[test], axis=0, ddof=1)
+
+            if np.any(np.unique(sample_targets[train]) !=
+                      np.unique(sample_targets[test])):
                 sys.exit("Targets on the two splits don't match. Unbalanced design?")
 
             # filling in the results matrix
             for index,value in np.ndenumerate(results[n]):
-                # target pair for that particular matrix cell
-                indexT = (targets[index[0]],  targets[index[1]])
-
-                ind_train = np.array([i in indexT  for i in ds_split_train.sa.targets])
-                ds_train = ds_split_train[ind_train]
-                ds_train.samples -= mean_train
-                ds_train.samples /= sd_train
-
-                ind_test = np.array([i in indexT  for i in ds_split_test.sa.targets])
-                ds_test = ds_split_test[ind_test]
-                ds_test.samples -= mean_test
-                ds_test.samples /= sd_test
-
-    #            if index[0] == index[1]:
-    #                # import pdb; pdb.set_trace()
-    #                halfT1 = len(ds_train.sa.targets)/2
-    #                ds_train.sa.targets = np.array([1,2]*halfT1)
-    #                halfT2 = len(ds_test.sa.targets)/2
-    #                ds_test.sa.targets = np.array([1,2]*halfT2)
+                # rows of the target pair for that particular matrix cell
+                i, j = min(index), max(index)
+                if i == j:
+                    ind_train, ind_test = plan.get_cond(n, i)
+                else:
+                    ind_train, test_i, test_j = plan.get(n, i, j)
+                    ind_test = np.sort(np.concatenate([test_i, test_j]))
+                ds_train = samples_train[ind_train]
+                ds_test = samples_test[ind_test]
 
                 if method=='corr':
-                    cr = mvpa2.clfs.distance.one_minus_correlation(ds_train.samples,ds_test.samples)
+                    cr = mvpa2.clfs.distance.one_minus_correlation(ds_train,ds_test)
                     # if one target then there's one correlation only
                     if index[0] == index[1]: acc = cr
                     else: acc = np.mean([ cr[0,1], cr[1,0] ])
@@ -981,16 +1144,11 @@ class Analysis(object):
                         results[n,index[0],index[1]] = 1
                     else:
                         clf = mvpa2.suite.LinearNuSVMC()
-                        clf.train(ds_train)
-                        predictions = clf.predict(ds_test.samples)
-                        results[n,index[0],index[1]] = np.mean(predictions == ds_test.sa.targets)
-
-
-                    # nfold = mvpa2.suite.NFoldPartitioner(cvtype=5,count=10,selection_strategy='equidistant')
-                    # cvte = mvpa2.suite.CrossValidation(clf, HalfPartitioner(attr='runtype'),
-                        # errorfx = lambda p, t: np.mean(p == t),  # this makes it report accuracy, not error
-                        # enable_ca=['stats'])
-                    # cvte(ds_pair)
+                        clf.train(mvpa2.suite.dataset_wizard(ds_train,
+                                        targets=sample_targets[ind_train]))
+                        predictions = clf.predict(ds_test)
+                        results[n,index[0],index[1]] = np.mean(
+                            predictions == sample_targets[ind_test])
 
 
         print
@@ -1550,6 +1708,181 @@ class Preproc(object):
         f.close()
 
 
+def get_splits(runtype, nIter, seed=None):
+    """
+    Randomly shuffles a split assignment for each iteration.
+
+    Each iteration is shuffled with its own random generator seeded with
+    `seed` and the iteration number, so splits do not depend on the order
+    in which iterations are processed.
+
+    :Args:
+        - runtype (list)
+            Assignment of chunks to splits, e.g., 0 for training, 1 for
+            testing, and -1 for unused chunks
+        - nIter (int)
+            Number of iterations
+
+    :Kwargs:
+        seed (int, default: None)
+            Seed for random splits. If None, it is drawn from `np.random`,
+            so `np.random.seed` still makes splits reproducible.
+
+    :Returns:
+        A split-assignment matrix of shape (nIter, len(runtype))
+    """
+    if seed is None:
+        seed = np.random.randint(2**31)
+    return np.array([np.random.RandomState([seed, n]).permutation(runtype)
+                     for n in range(nIter)], dtype=int).reshape(
+                                                    (nIter, len(runtype)))
+
+
+def split_half_correlation(samples, sample_targets, sample_chunks, nIter=100,
+                           seed=None, fisher=False, compact=False):
+    """
+    Computes correlations between random splits in half of the data (see
+    :func:`Analysis.correlation`).
+
+    :Args:
+        - samples (numpy.array)
+            Patterns averaged per target per chunk, of shape (rows, voxels)
+        - sample_targets (numpy.array)
+            Target (condition) of each row
+        - sample_chunks (numpy.array)
+            Chunk (run) of each row
+
+    :Kwargs:
+        The same as in :func:`Analysis.correlation`
+
+    :Returns:
+        The same as :func:`Analysis.correlation`
+    """
+    targets = np.unique(sample_targets)
+    chunks = np.unique(sample_chunks)
+    numT = len(targets)
+
+    # patterns of shape (chunks, targets, voxels)
+    patterns = np.zeros((len(chunks), numT, samples.shape[1]))
+    count = np.zeros((len(chunks), numT), dtype=int)
+    chunk_ind = np.searchsorted(chunks, sample_chunks)
+    target_ind = np.searchsorted(targets, sample_targets)
+    patterns[chunk_ind, target_ind] = samples
+    count[chunk_ind, target_ind] += 1
+    if np.any(count != 1):
+        raise ValueError('Each condition must occur in each chunk. '
+                         'Unbalanced design?')
+    # subtract the mean across conditions chunk-wise
+    patterns -= np.mean(patterns, axis=1)[:, np.newaxis]
+
+    runtype = [0,1] * (len(chunks)//2) + [-1] * (len(chunks)%2)
+               # for odd number of chunks (will get rid of one)
+    splits = get_splits(runtype, nIter, seed=seed)
+    # split means as matrix products
+    patterns = patterns.reshape((len(chunks), -1))
+    means = []
+    for half in [0, 1]:
+        weights = (splits == half).astype(float)
+        weights /= np.sum(weights, axis=1)[:, np.newaxis]
+        mean = np.dot(weights, patterns).reshape((nIter, numT, -1))
+        # normalize so that dot products are correlations
+        mean -= np.mean(mean, axis=2)[:, :, np.newaxis]
+        mean /= np.sqrt(np.sum(mean**2, axis=2))[:, :, np.newaxis]
+        means.append(mean)
+    corr = np.einsum('nik,njk->nij', means[0], means[1])
+
+    if fisher:
+        corr = np.clip(corr, -1 + 1e-12, 1 - 1e-12)
+        corr = np.tanh(np.mean(np.arctanh(corr), axis=0))[np.newaxis]
+    dis = (1 - corr) / 2.
+
+    if compact:
+        return targets, dis[0] if fisher else dis
+    header = ['iter', 'stim1.cond', 'stim2.cond', 'subjResp']
+    results = [[n, targets[i], targets[j], dis[n,i,j]]
+               for n in range(len(dis))
+               for i in range(numT) for j in range(numT)]
+    return header, results
+
+
+def _run_job_worker(args):
+    """Runs a single job of :func:`Analysis.run_method` in a process pool"""
+    return args[0].run_job(*args[1:])
+
+
+_svm_state = {}
+
+def _svm_init(samples, sample_targets, plan, clf):
+    """Receives data and a classifier once per process"""
+    _svm_state['args'] = (samples, sample_targets, plan, clf)
+
+def _svm_worker(task):
+    """Trains and tests a classifier on a single pair in a single split"""
+    return _svm_pair(*(_svm_state['args'] + task))
+
+def _svm_pair(samples, sample_targets, plan, clf, n, i, j):
+    """
+    Trains a classifier on a pair of conditions (i, j) in the training set of
+    split `n` and returns its accuracy on the averaged testing set.
+    """
+    train, test_i, test_j = plan.get(n, i, j)
+    clf.train(mvpa2.suite.dataset_wizard(samples[train],
+                                         targets=sample_targets[train]))
+    # boost results by averaging test patterns over chunks
+    test = np.array([np.mean(samples[test_i], axis=0),
+                     np.mean(samples[test_j], axis=0)])
+    predictions = clf.predict(test)
+    pair = np.array([plan.targets[i], plan.targets[j]])
+    return np.mean(np.array(predictions) == pair)
+
+
+class PairPlan(object):
+    """
+    Precomputed row indices for pairwise analyses over many splits.
+
+    For every split and every unordered pair of conditions, integer indices
+    of the training rows of the pair and of the testing rows of each
+    condition are computed once, so that decoding loops only index arrays.
+
+    :Args:
+        - sample_targets (numpy.array)
+            Condition of each row
+        - splits (numpy.array)
+            Runtype of each row (0: training, 1: testing, -1: not used) in
+            each split, of shape (number of splits, number of rows)
+        - targets (numpy.array)
+            Conditions; pairs (i, j) refer to their positions here
+    """
+    def __init__(self, sample_targets, splits, targets):
+        self.targets = targets
+        self.pairs = [(i,j) for i in range(len(targets))
+                      for j in range(i+1, len(targets))]
+        sample_targets = np.asarray(sample_targets)
+        cond_rows = [np.flatnonzero(sample_targets == t) for t in targets]
+        self.train = {}
+        self.train_cond = []
+        self.test = []
+        for n, split in enumerate(np.asarray(splits)):
+            train = [rows[split[rows] == 0] for rows in cond_rows]
+            self.train_cond.append(train)
+            self.test.append([rows[split[rows] == 1] for rows in cond_rows])
+            for i, j in self.pairs:
+                # keep the original order of rows
+                self.train[(n,i,j)] = np.sort(np.concatenate([train[i],
+                                                              train[j]]))
+
+    def get(self, n, i, j):
+        """
+        Returns training rows of the pair (i, j) in split `n` and testing
+        rows of conditions i and j
+        """
+        return self.train[(n,i,j)], self.test[n][i], self.test[n][j]
+
+    def get_cond(self, n, i):
+        """Returns training and testing rows of condition i in split `n`"""
+        return self.train_cond[n][i], self.test[n][i]
+
+
 def make_full(distance):
     res = np.nan*np.ones(distance.shape)
     iu = np.triu_indices(len(distance),k=1)  # upper triangle less diagonal
@@ -7,19 +7,573 @@
 
 """A library of simple models of vision"""
 
-import sys
+import sys, os, re, glob, shutil, tempfile
 import itertools
+import hashlib
+import threading, multiprocessing
+import timeit
+import Queue
 import cPickle as pickle
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 import numpy as np
 import matplotlib.pyplot as plt
 from mpl_toolkits.axes_grid1 import make_axes_locatable
 import scipy.misc
 import scipy.ndimage
+import scipy.fftpack
+import scipy.sparse
+
+
+class FeatureCache(object):
+    """
+    A persistent on-disk store of model outputs.
+
+    Outputs are stored per image in `.npz` files, keyed by a hash of the
+    image array together with the model class and its parameters, so
+    rerunning a model on the same stimuli only loads previously computed
+    features. Images read from files by :func:`Model.imread` are stored as
+    well, keyed by file name and modification time. When the store grows
+    over `max_size` bytes, least recently used entries are removed.
+
+    To use it, assign it to a model::
+
+        m = HMAX()
+        m.cache = FeatureCache('features/')
+
+    :Args:
+        path (str)
+            Directory where features are stored
+
+    :Kwargs:
+        max_size (int, default: 2**30)
+            Maximal size of the store in bytes (1 GB by default)
+    """
+    def __init__(self, path, max_size=2**30):
+        self.path = path
+        self.max_size = max_size
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self.size = sum([os.path.getsize(f) for f in self._files()])
+
+    def _files(self):
+        return glob.glob(os.path.join(self.path, '*.npz'))
+
+    def key(self, model, im, **kwargs):
+        """
+        Computes a key for an image processed by a given model
+
+        :Args:
+            - model (Model)
+                Model instance; its class and parameters (see
+                :func:`Model.get_params`) are used in the key
+            - im (numpy.array)
+                Input image
+
+        :Kwargs:
+            Any other parameters that affect the output
+        """
+        im = np.ascontiguousarray(im)
+        params = model.get_params()
+        params.update(kwargs)
+        sha = hashlib.sha1()
+        sha.update(im)
+        sha.update(repr((im.dtype.str, im.shape, model.__class__.__name__,
+                         sorted(params.items()))).encode('utf-8'))
+        return sha.hexdigest()
+
+    def file_key(self, fname):
+        """
+        Computes a key for an image file, based on its path, size and
+        modification time, so that a changed file gets a new key
+        """
+        fname = os.path.abspath(fname)
+        st = os.stat(fname)
+        sha = hashlib.sha1()
+        sha.update(repr(('imread', fname, st.st_size,
+                         st.st_mtime)).encode('utf-8'))
+        return sha.hexdigest()
+
+    def _fname(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns stored outputs as a dict of arrays or None if there are none
+        """
+        fname = self._fname(key)
+        try:
+            f = np.load(fname)
+            out = dict([(k, f[k]) for k in f.files])
+            f.close()
+        except (IOError, OSError, ValueError):
+            self.stats['misses'] += 1
+            return None
+        os.utime(fname, None)  # mark as recently used
+        self.stats['hits'] += 1
+        return out
+
+    def set(self, key, **outputs):
+        """Stores outputs (given as keyword arguments) under a key"""
+        fname = self._fname(key)
+        if os.path.isfile(fname):
+            self.size -= os.path.getsize(fname)
+            os.remove(fname)
+        # write to a temporary file first so that readers never see a
+        # partially written entry
+        tmp_fname = fname + '.tmp'
+        f = open(tmp_fname, 'wb')
+        np.savez(f, **outputs)
+        f.close()
+        os.rename(tmp_fname, fname)
+        self.size += os.path.getsize(fname)
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        """Removes least recently used entries until the store fits"""
+        files = sorted(self._files(), key=os.path.getmtime)
+        while self.size > self.max_size and len(files) > 0:
+            fname = files.pop(0)
+            self.size -= os.path.getsize(fname)
+            os.remove(fname)
+            self.stats['evictions'] += 1
+
+    def clear(self):
+        """Removes all entries"""
+        for fname in self._files():
+            os.remove(fname)
+        self.size = 0
+
+    def summary(self):
+        """Returns a string with hit/miss statistics"""
+        total = self.stats['hits'] + self.stats['misses']
+        rate = 100. * self.stats['hits'] / total if total > 0 else 0.
+        return ('%d hits, %d misses (%.1f%% hit rate), %d evictions, '
+                '%.1f MB stored' % (self.stats['hits'], self.stats['misses'],
+                rate, self.stats['evictions'], self.size / 2.**20))
+
+
+class Profiler(object):
+    """
+    Records how much time and memory each layer of a model takes and how
+    large its outputs are.
+
+    To use it, assign it to a model, run the model and inspect records::
+
+        m = HMAX()
+        m.profiler = Profiler()
+        m.run(ims)
+        print m.profiler.summary()
+
+    Each record is a dict with the following keys:
+        - layer: layer name, e.g., 'S1'
+        - band: scale band (None if not applicable)
+        - image: image number (None if not applicable)
+        - time: wall time in seconds
+        - out_bytes: size of the layer's output in bytes
+        - peak_bytes: how much the peak resident memory of the process grew
+          while computing the layer, in bytes (None where the `resource`
+          module is not available). Peak memory only grows when a layer
+          needs more than any computation before it, so this shows which
+          layers drive the memory use of a run.
+        - shape: shape of the layer's output
+    """
+    def __init__(self):
+        self.records = []
+
+    def call(self, layer, band, image, func, *args, **kwargs):
+        """Calls `func` with given arguments and records its cost"""
+        start_peak = _peak_memory()
+        start = timeit.default_timer()
+        out = func(*args, **kwargs)
+        dur = timeit.default_timer() - start
+        if start_peak is None:
+            peak = None
+        else:
+            peak = _peak_memory() - start_peak
+        if isinstance(out, dict):  # e.g., image spectra
+            nbytes = sum([v.nbytes for v in out.values()
+                          if isinstance(v, np.ndarray)])
+            shape = None
+        else:
+            arr = np.asarray(out)
+            nbytes = arr.nbytes
+            shape = arr.shape
+        self.records.append({'layer': layer, 'band': band, 'image': image,
+                             'time': dur, 'out_bytes': nbytes,
+                             'peak_bytes': peak, 'shape': shape})
+        return out
+
+    def to_df(self):
+        """Returns records as a `pandas.DataFrame`"""
+        import pandas
+        return pandas.DataFrame(self.records, columns=['layer', 'band',
+                                'image', 'time', 'out_bytes', 'peak_bytes',
+                                'shape'])
+
+    def summary(self):
+        """
+        Returns a table of total time, output size and peak memory growth
+        per layer
+        """
+        layers = []
+        agg = {}
+        for rec in self.records:
+            if rec['layer'] not in agg:
+                layers.append(rec['layer'])
+                agg[rec['layer']] = {'n': 0, 'time': 0., 'out_bytes': 0,
+                                     'peak_bytes': 0}
+            agg[rec['layer']]['n'] += 1
+            agg[rec['layer']]['time'] += rec['time']
+            agg[rec['layer']]['out_bytes'] += rec['out_bytes']
+            if rec['peak_bytes'] is None:
+                agg[rec['layer']]['peak_bytes'] = None
+            elif agg[rec['layer']]['peak_bytes'] is not None:
+                agg[rec['layer']]['peak_bytes'] += rec['peak_bytes']
+        total = sum([a['time'] for a in agg.values()])
+        lines = ['%-8s %6s %10s %10s %7s %10s %10s' % ('layer', 'calls',
+                 'total, s', 'mean, ms', 'time, %', 'out, MB', 'peak+, MB')]
+        for layer in layers:
+            a = agg[layer]
+            if a['peak_bytes'] is None:
+                peak = '%10s' % '-'
+            else:
+                peak = '%10.1f' % (a['peak_bytes'] / 2.**20)
+            lines.append('%-8s %6d %10.3f %10.2f %7.1f %10.1f %s' % (layer,
+                         a['n'], a['time'], 1000 * a['time'] / a['n'],
+                         100 * a['time'] / total if total > 0 else 0,
+                         a['out_bytes'] / 2.**20, peak))
+        return '\n'.join(lines)
+
+
+class FeatureIndex(object):
+    """
+    An approximate nearest neighbour index over model outputs.
+
+    Finds the stimuli most similar to a query without computing the full
+    dissimilarity matrix. Outputs are hashed with random-projection
+    locality-sensitive hashing (LSH): each of `n_tables` tables stores the
+    signs of `n_bits` random projections, so similar outputs tend to fall
+    into the same bucket. Stimuli sharing a bucket with a query in any
+    table are then ranked by the exact dissimilarity, as defined in
+    :func:`Model.dissimilarity`.
+
+    Stimuli can be added at any time, and the index can be saved to disk::
+
+        index = FeatureIndex(kind='gaborjet')
+        index.add(GaborJet().run(ims))
+        inds, dis = index.query(GaborJet().run(new_ims), k=5)
+        index.save('stimuli_index.npz')
+
+    :Kwargs:
+        - kind (str, default: 'simple')
+            Dissimilarity measure, either 'simple' (root mean square
+            difference) or 'gaborjet' (one minus the cosine of the angle
+            between outputs)
+        - n_tables (int, default: 8)
+            Number of hash tables. More tables find more true neighbours
+            at the cost of more candidates to rank.
+        - n_bits (int, default: 12)
+            Number of random projections per table. More bits make buckets
+            smaller and queries faster but miss more neighbours.
+        - seed (int, default: 0)
+            Seed for random projections
+        - dtype (str, default: 'float64')
+            Precision in which outputs are stored and compared
+    """
+    def __init__(self, kind='simple', n_tables=8, n_bits=12, seed=0,
+                 dtype='float64'):
+        if kind == 'gaborjet-fast':
+            kind = 'gaborjet'
+        if kind not in ['simple', 'gaborjet']:
+            raise ValueError('Dissimilarity of %s not recognized' % kind)
+        self.kind = kind
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.seed = seed
+        self.dtype = dtype
+        self.n = 0
+        self.planes = None
+        self.center = None
+        self._model = Model()
+        self._model.dtype = dtype
+        self._feats = None
+        self._sq = None
+        self._codes = None
+        self._tables = None
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def features(self):
+        """Stored outputs, one row per stimulus"""
+        if self._feats is None:
+            return None
+        return self._feats[:self.n]
+
+    def _hash(self, rows):
+        """Computes bucket codes of rows in each table"""
+        rows = self._hash_rows(rows)
+        proj = np.dot(rows - self.center, self.planes) > 0
+        proj = proj.reshape((len(rows), self.n_tables, self.n_bits))
+        return np.dot(proj, 2**np.arange(self.n_bits)).astype(np.int64)
+
+    def _hash_rows(self, rows):
+        if self.kind == 'gaborjet':
+            # cosines do not depend on lengths
+            norm = np.sqrt(np.sum(rows * rows, axis=1))
+            norm = np.maximum(norm, np.finfo(rows.dtype).tiny)
+            rows = rows / norm[:, np.newaxis]
+        return rows
+
+    def add(self, outputs):
+        """
+        Adds outputs to the index.
+
+        :Args:
+            outputs (list or numpy.array)
+                Model outputs, one row per stimulus. Outputs with more than
+                two dimensions are flattened per stimulus.
+
+        :Returns:
+            Indices of the added stimuli
+        """
+        rows, sq = self._model._dis_prepare(self._model._dis_rows(outputs),
+                                            self.kind)
+        if self.planes is None:
+            rng = np.random.RandomState(self.seed)
+            self.planes = rng.randn(rows.shape[1],
+                        self.n_tables * self.n_bits).astype(self.dtype)
+            # hyperplanes go through the center of the first outputs so
+            # that they cut through the data (e.g., model outputs are
+            # often all positive)
+            self.center = np.mean(self._hash_rows(rows), axis=0)
+            self._feats = np.zeros((0, rows.shape[1]), dtype=self.dtype)
+            self._sq = np.zeros(0, dtype=self.dtype)
+            self._codes = np.zeros((0, self.n_tables), dtype=np.int64)
+        elif rows.shape[1] != self.planes.shape[0]:
+            raise ValueError('Outputs must have %d features' %
+                             self.planes.shape[0])
+
+        new_n = self.n + len(rows)
+        if new_n > len(self._feats):
+            # grow storage geometrically so that adding one stimulus at a
+            # time does not copy the whole index every time
+            size = max(new_n, 2 * len(self._feats))
+            self._feats = self._grow(self._feats, size)
+            self._sq = self._grow(self._sq, size)
+            self._codes = self._grow(self._codes, size)
+        self._feats[self.n:new_n] = rows
+        self._sq[self.n:new_n] = sq
+        self._codes[self.n:new_n] = self._hash(rows)
+        inds = np.arange(self.n, new_n)
+        self.n = new_n
+        self._tables = None
+        return inds
+
+    def _grow(self, arr, size):
+        new = np.zeros((size,) + arr.shape[1:], dtype=arr.dtype)
+        new[:self.n] = arr[:self.n]
+        return new
+
+    def _get_tables(self):
+        """Returns stimuli sorted by their codes in each table"""
+        if self._tables is None:
+            codes = self._codes[:self.n]
+            order = np.argsort(codes, axis=0, kind='mergesort')
+            self._tables = (order, codes[order, np.arange(self.n_tables)])
+        return self._tables
+
+    def candidates(self, outputs):
+        """
+        Returns, for each query, indices of stimuli sharing a bucket with
+        it in at least one table
+        """
+        rows = self._model._dis_rows(outputs).astype(self.dtype)
+        codes = self._hash(rows)
+        order, sorted_codes = self._get_tables()
+        lo = np.zeros(codes.shape, dtype=int)
+        hi = np.zeros(codes.shape, dtype=int)
+        for t in range(self.n_tables):
+            lo[:, t] = np.searchsorted(sorted_codes[:, t], codes[:, t], 'left')
+            hi[:, t] = np.searchsorted(sorted_codes[:, t], codes[:, t],
+                                       'right')
+        cands = []
+        for i in range(len(rows)):
+            cands.append(np.unique(np.concatenate([order[lo[i, t]:hi[i, t], t]
+                                   for t in range(self.n_tables)])))
+        return cands
+
+    def query(self, outputs, k=10, exact=False):
+        """
+        Finds the most similar stored stimuli for each query.
+
+        :Args:
+            outputs (list or numpy.array)
+                Model outputs of query stimuli, one row per stimulus
+
+        :Kwargs:
+            - k (int, default: 10)
+                Number of neighbours per query
+            - exact (bool, default: False)
+                If True, all stored stimuli are ranked, not only those
+                sharing a bucket with the query
+
+        :Returns:
+            A tuple of two (number of queries, k) arrays: indices of
+            neighbours and their dissimilarities to the query, from the
+            most to the least similar. If fewer than `k` candidates are
+            found for a query, all stimuli are ranked for it.
+        """
+        if self.n == 0:
+            raise ValueError('The index is empty')
+        rows, sqx = self._model._dis_prepare(self._model._dis_rows(outputs),
+                                             self.kind)
+        if rows.shape[1] != self.planes.shape[0]:
+            raise ValueError('Outputs must have %d features' %
+                             self.planes.shape[0])
+        k = min(k, self.n)
+        if exact:
+            cands = [None] * len(rows)
+        else:
+            cands = self.candidates(rows)
+        inds = np.zeros((len(rows), k), dtype=int)
+        dis = np.zeros((len(rows), k), dtype=self.dtype)
+        for i, cand in enumerate(cands):
+            if cand is None or len(cand) < k:
+                cand = np.arange(self.n)
+            block = self._model._dis_block(rows[i:i+1], sqx[i:i+1],
+                                self._feats[cand], self._sq[cand], self.kind,
+                                rows.shape[1])[0]
+            if len(cand) > k:
+                top = np.argpartition(block, k - 1)[:k]
+            else:
+                top = np.arange(len(cand))
+            top = top[np.argsort(block[top], kind='mergesort')]
+            inds[i] = cand[top]
+            dis[i] = block[top]
+        return inds, dis
+
+    def save(self, filename):
+        """Saves the index to a `.npz` file"""
+        if self.n == 0:
+            raise ValueError('The index is empty')
+        np.savez(filename, features=self.features, codes=self._codes[:self.n],
+                 planes=self.planes, center=self.center,
+                 kind=self.kind, n_tables=self.n_tables, n_bits=self.n_bits,
+                 seed=self.seed, dtype=self.dtype)
+
+    @classmethod
+    def load(cls, filename):
+        """Loads an index saved with :func:`FeatureIndex.save`"""
+        f = np.load(filename)
+        index = cls(kind=str(f['kind']), n_tables=int(f['n_tables']),
+                    n_bits=int(f['n_bits']), seed=int(f['seed']),
+                    dtype=str(f['dtype']))
+        index.planes = f['planes']
+        index.center = f['center']
+        index._feats = f['features']
+        index._codes = f['codes']
+        f.close()
+        index._sq = np.sum(index._feats * index._feats, axis=1)
+        index.n = len(index._feats)
+        return index
 
 
 class Model(object):
 
+    # a FeatureCache to store outputs in; None means no caching
+    cache = None
+    # a Profiler to record costs of each layer; None means no profiling
+    profiler = None
+    # attributes that do not affect model outputs
+    _nonparams = ('distortion',)
+    # distortion of the last approximate dissimilarities (see :func:`project`)
+    distortion = None
+    # floating point type of computations and outputs; set it per model
+    # instance or for all models (Model.dtype = 'float32'); 'float32' halves
+    # memory use at the cost of accuracy (see :func:`precision_delta`)
+    dtype = 'float64'
+
+    def get_params(self):
+        """
+        Returns model parameters that may affect its outputs.
+
+        These are all public attributes that are numbers, strings or
+        (nested) lists of them, and `dtype`. They are used to identify
+        stored outputs (see :class:`FeatureCache`).
+        """
+        def is_param(value):
+            if isinstance(value, (list, tuple)):
+                return all([is_param(v) for v in value])
+            else:
+                return isinstance(value, (int, long, float, str, bool)) or \
+                    value is None
+        params = dict([(k,v) for k,v in self.__dict__.items()
+                       if not k.startswith('_') and k not in self._nonparams
+                       and is_param(v)])
+        params['dtype'] = np.dtype(self.dtype).name
+        return params
+
+    def get_complex_dtype(self):
+        """Returns the complex type matching `dtype`"""
+        return np.result_type(self.dtype, np.complex64)
+
+    def precision_delta(self, ims=None, dtype='float32', ref=None):
+        """
+        Measures how much model outputs change when they are computed with
+        a lower precision than the default 'float64'.
+
+        :Kwargs:
+            - ims (list or numpy.array, default: None)
+                Input images. If None, a test image is used.
+            - dtype (str, default: 'float32')
+                Floating point type to compare against 'float64'
+            - ref (dict, default: None)
+                Reference outputs, such as those of the MatLab
+                implementations for the test image (see `tests/*.txt`).
+                Only the outputs in `ref` are then compared, and nothing
+                is computed in 'float64'.
+
+        :Returns:
+            A dict with (maximal absolute difference, maximal difference
+            relative to the largest reference output) for each output
+        """
+        if ims is None:
+            ims = [self.get_testim()]
+        saved = dict([(k, self.__dict__[k]) for k in ['dtype', 'cache']
+                      if k in self.__dict__])
+        self.cache = None  # outputs must be computed
+        try:
+            self.dtype = 'float64'
+            ims = self.input2array(ims)
+            if ref is None:
+                ref = self._batch_outputs(ims)
+            self.dtype = dtype
+            out = self._batch_outputs(ims.astype(dtype))
+        finally:
+            for k in ['dtype', 'cache']:
+                if k in saved:
+                    self.__dict__[k] = saved[k]
+                else:
+                    del self.__dict__[k]
+        delta = {}
+        for name in ref:
+            if not isinstance(ref[name], np.ndarray):
+                continue  # e.g., a list of S2 responses
+            # references may come in a different shape, e.g., from text files
+            diff = np.max(np.abs(out[name].astype(float).ravel() -
+                                 np.ravel(ref[name])))
+            scale = np.max(np.abs(ref[name]))
+            delta[name] = (diff, diff / scale if scale > 0 else diff)
+        return delta
+
     def get_testim(self, size=(256, 256)):
         """
         Opens Lena image and resizes it to the specified size ((256, 256) by
@@ -45,29 +599,332 @@ class Model(object):
         """
         pass
 
-    def dissimilarity(self, outputs, kind='simple'):
-        if kind == 'simple':
-            dis = self._dis_simple(outputs)
-        elif kind == 'gaborjet':
-            dis = self._dis_gj_simple(outputs)
-        elif kind == 'gaborjet-fast':
-            dis = self._dis_gj_fast(outputs)
-        elif kind == 'corr':
-            #self._dis_corr(outputs)
-            raise NotImplemented
-        else:
+    def dissimilarity(self, outputs, kind='simple', other=None,
+                      tile_size=None, filename=None, n_components=None,
+                      projection='sparse', seed=0):
+        """
+        Computes pairwise dissimilarities between model outputs.
+
+        Dissimilarities are computed via dot products (the Gram matrix) in
+        tiles of rows, so `outputs` can be a memory-mapped array that does
+        not fit in memory (e.g., loaded with `np.load(..., mmap_mode='r')`).
+
+        :Args:
+            outputs (list or numpy.array)
+                Model outputs, one row per stimulus. Outputs with more than
+                two dimensions are flattened per stimulus.
+
+        :Kwargs:
+            - kind (str, default: 'simple')
+                Dissimilarity measure:
+                    - 'simple': root mean square difference, as used in
+                      Grill-Spector et al. (1999), Op de Beeck et al. (2001),
+                      Panis et al. (2011)
+                    - 'euclidean': Euclidean distance
+                    - 'sqeuclidean': squared Euclidean distance
+                    - 'gaborjet' (or 'gaborjet-fast'): one minus the cosine
+                      of the angle between outputs
+                    - 'corr': one minus Pearson correlation, divided by two
+                      so that it ranges from 0 to 1
+            - other (list or numpy.array, default: None)
+                If given, dissimilarities between `outputs` (rows) and
+                `other` (columns) are computed instead.
+            - tile_size (int, default: None)
+                How many stimuli to process at once. By default, tiles are
+                chosen to hold about 128 MB of features each.
+            - filename (str, default: None)
+                If given, the result is written to a `.npy` file that is
+                memory-mapped instead of being held in memory.
+            - n_components (int, default: None)
+                If given, outputs are first projected to this many
+                dimensions and approximate dissimilarities are computed
+                from the projections, so their cost does not depend on the
+                number of features (e.g., image resolution for
+                :class:`Pixelwise`). How much distances may be distorted is
+                stored in `self.distortion` (see :func:`Model.project`).
+            - projection ({'sparse', 'pca'}, default: 'sparse')
+                Projection used with `n_components`
+            - seed (int, default: 0)
+                Seed for the 'sparse' projection
+
+        :Returns:
+            A matrix of dissimilarities (0: similar, larger: dissimilar)
+        """
+        if kind == 'gaborjet-fast':
+            kind = 'gaborjet'
+        if kind not in ['simple', 'euclidean', 'sqeuclidean', 'gaborjet',
+                        'corr']:
             raise ValueError('Dissimilarity of %s not recognized' % kind)
+
+        outputs = self._dis_rows(outputs)
+        if other is None:
+            other_rows = outputs
+        else:
+            other_rows = self._dis_rows(other)
+            if other_rows.shape[1] != outputs.shape[1]:
+                raise ValueError('Outputs must have the same number of '
+                                 'features')
+        nfeat = outputs.shape[1]
+        itemsize = np.dtype(self.dtype).itemsize
+        if tile_size is None:
+            tile_size = max(1, 2**27 // (itemsize * max(nfeat, 1)))
+
+        approx_kind = None
+        if n_components is not None and n_components < nfeat:
+            projected = self.project(outputs, n_components,
+                            method=projection, seed=seed, other=other,
+                            center=(kind == 'corr'), tile_size=tile_size)
+            if other is None:
+                outputs = other_rows = projected
+            else:
+                outputs, other_rows = projected
+            # projections preserve squared distances and dot products, from
+            # which the requested measure is computed at the end
+            approx_kind = kind
+            if kind in ['simple', 'euclidean', 'sqeuclidean']:
+                kind = 'sqeuclidean'
+            else:  # rows are already centered for 'corr'
+                kind = 'gaborjet'
+
+        shape = (len(outputs), len(other_rows))
+        if filename is None:
+            dis = np.zeros(shape, dtype=self.dtype)
+        else:
+            dis = np.lib.format.open_memmap(filename, mode='w+',
+                                            dtype=self.dtype, shape=shape)
+
+        for i in range(0, shape[0], tile_size):
+            x, sqx = self._dis_prepare(outputs[i:i+tile_size], kind)
+            # for symmetric matrices, only the upper triangle is computed
+            start = i if other is None else 0
+            for j in range(start, shape[1], tile_size):
+                if other is None and j == i:
+                    y, sqy = x, sqx
+                else:
+                    y, sqy = self._dis_prepare(other_rows[j:j+tile_size], kind)
+                block = self._dis_block(x, sqx, y, sqy, kind, nfeat)
+                if other is None and j == i:
+                    # avoid round-off errors on the diagonal
+                    np.fill_diagonal(block, 0)
+                dis[i:i+tile_size, j:j+tile_size] = block
+                if other is None and j != i:
+                    dis[j:j+tile_size, i:i+tile_size] = block.T
+
+        if approx_kind == 'simple':
+            np.sqrt(dis / nfeat, out=dis)
+        elif approx_kind == 'euclidean':
+            np.sqrt(dis, out=dis)
+        elif approx_kind == 'corr':
+            dis /= 2.
+
+        if filename is not None:
+            dis.flush()
+        return dis
+
+    def project(self, outputs, n_components, method='sparse', seed=0,
+                other=None, center=False, tile_size=None):
+        """
+        Projects outputs to fewer dimensions, approximately preserving
+        distances and dot products between them.
+
+        Outputs are processed in tiles of rows, so they can be memory-mapped
+        arrays that do not fit in memory. After projecting,
+        `self.distortion` tells how much distances may be distorted.
+
+        :Args:
+            - outputs (list or numpy.array)
+                Model outputs, one row per stimulus
+            - n_components (int)
+                Number of dimensions to project to
+
+        :Kwargs:
+            - method ({'sparse', 'pca'}, default: 'sparse')
+                - 'sparse': a random projection with mostly zero weights
+                  (Li, Hastie, & Church, 2006). By the Johnson-Lindenstrauss
+                  lemma, squared distances between all pairs of the
+                  projected stimuli are within a factor of
+                  1 +/- `self.distortion` of the original ones with a high
+                  probability (see :func:`Model.get_jl_distortion`). For
+                  such sparse projections, the bound holds asymptotically,
+                  i.e., unless a few features dominate the distances.
+                - 'pca': principal components, fitted incrementally in tiles
+                  of rows (Ross et al., 2008). Distances can only shrink;
+                  `self.distortion` is the fraction of variance (the mean
+                  squared distance between stimuli) that is discarded.
+            - seed (int, default: 0)
+                Seed for the 'sparse' projection
+            - other (list or numpy.array, default: None)
+                Other outputs that are projected in the same way
+            - center (bool, default: False)
+                Whether to subtract the mean of each row before projecting
+                (used for correlations)
+            - tile_size (int, default: None)
+                How many stimuli to process at once
+
+        :Returns:
+            Projected outputs or, if `other` is given, a tuple of projected
+            `outputs` and `other`
+        """
+        outputs = self._dis_rows(outputs)
+        rows = [outputs]
+        if other is not None:
+            rows.append(self._dis_rows(other))
+        nfeat = outputs.shape[1]
+        if tile_size is None:
+            tile_size = max(1, 2**27 // (np.dtype(self.dtype).itemsize *
+                                         max(nfeat, 1)))
+
+        def tiles(arr):
+            for i in range(0, len(arr), tile_size):
+                tile = np.asarray(arr[i:i+tile_size], dtype=self.dtype)
+                if center:
+                    tile = tile - np.mean(tile, axis=1)[:, np.newaxis]
+                yield tile
+
+        if method == 'sparse':
+            proj = self._get_sparse_projection(nfeat, n_components, seed)
+            transform = lambda tile: np.asarray(proj.T.dot(tile.T)).T
+            self.distortion = self.get_jl_distortion(sum(map(len, rows)),
+                                                     n_components)
+        elif method == 'pca':
+            mean, comps, extra, discarded = self._fit_pca(tiles(outputs),
+                                                          n_components)
+            # coordinates in the subspace spanned by components and the
+            # mean, so that dot products are preserved too
+            transform = lambda tile: np.hstack([np.dot(tile, comps.T),
+                            np.tile(extra, (len(tile), 1))])
+            self.distortion = discarded
+        else:
+            raise ValueError('Projection %s not recognized' % method)
+
+        projected = []
+        for arr in rows:
+            projected.append(np.vstack([transform(tile)
+                                        for tile in tiles(arr)]))
+            projected[-1] = projected[-1].astype(self.dtype)
+        if other is None:
+            return projected[0]
+        else:
+            return tuple(projected)
+
+    def _get_sparse_projection(self, nfeat, n_components, seed):
+        """
+        Creates a sparse random projection matrix of shape
+        (nfeat, n_components) with weights of +/- sqrt(s / n_components)
+        with probability of 1/(2s) each and zeros otherwise, s = sqrt(nfeat)
+        """
+        rng = np.random.RandomState(seed)
+        s = np.sqrt(nfeat)
+        nnz = rng.binomial(nfeat * n_components, 1. / s)
+        inds = np.unique(rng.randint(0, nfeat * n_components, size=nnz))
+        vals = np.sqrt(s / n_components) * rng.choice([-1, 1], size=len(inds))
+        return scipy.sparse.csc_matrix((vals.astype(self.dtype),
+                    (inds // n_components, inds % n_components)),
+                    shape=(nfeat, n_components))
+
+    def get_jl_distortion(self, n_samples, n_components):
+        """
+        Computes the smallest distortion `eps` guaranteed by the
+        Johnson-Lindenstrauss lemma for `n_samples` projected to
+        `n_components` dimensions, i.e., the solution of
+        n_components = 4 * ln(n_samples) / (eps**2 / 2 - eps**3 / 3)
+        (Dasgupta & Gupta, 2003). Returns `np.inf` if there is no guarantee.
+        """
+        target = 4 * np.log(max(n_samples, 2)) / n_components
+        if target > 1/6.:  # the maximum of eps**2 / 2 - eps**3 / 3
+            return np.inf
+        lo, hi = 0., 1.
+        for i in range(60):
+            eps = (lo + hi) / 2.
+            if eps**2 / 2. - eps**3 / 3. < target:
+                lo = eps
+            else:
+                hi = eps
+        return hi
+
+    def _fit_pca(self, tiles, n_components):
+        """
+        Fits principal components incrementally, one tile of rows at a time.
+
+        :Returns:
+            mean, components (n_components by nfeat), norm of the mean
+            outside the components, and the fraction of variance that the
+            components do not explain
+        """
+        n = 0
+        mean = None
+        sv = comps = None
+        total = 0.
+        for tile in tiles:
+            tile_mean = np.mean(tile, axis=0)
+            new_n = n + len(tile)
+            diff = tile - tile_mean
+            total += np.sum(diff * diff)
+            if n == 0:
+                stack = diff
+                mean = tile_mean
+            else:
+                correction = np.sqrt(n * len(tile) / float(new_n)) * \
+                             (mean - tile_mean)
+                total += np.sum(correction * correction)
+                stack = np.vstack([sv[:, np.newaxis] * comps, diff,
+                                   correction])
+                mean = mean + (tile_mean - mean) * len(tile) / float(new_n)
+            # SVD of a short and wide stack via its small Gram matrix
+            eigval, eigvec = np.linalg.eigh(np.dot(stack, stack.T))
+            order = np.argsort(eigval)[::-1][:n_components]
+            sv = np.sqrt(np.maximum(eigval[order], 0))
+            keep = sv > sv[0] * 1e-10  # drop empty directions
+            sv = sv[keep]
+            comps = np.dot(eigvec[:, order[keep]].T, stack) / sv[:, np.newaxis]
+            n = new_n
+        extra = mean - np.dot(np.dot(comps, mean), comps)
+        extra = np.sqrt(np.sum(extra * extra))
+        discarded = 1 - np.sum(sv**2) / total if total > 0 else 0.
+        return mean, comps, extra, max(discarded, 0.)
+
+    def _dis_rows(self, outputs):
+        """Makes sure outputs are a 2D array without copying memmaps"""
+        if not isinstance(outputs, np.ndarray):
+            outputs = np.array(outputs)
+        if outputs.ndim == 1:
+            raise ValueError('At least 2 dimensions expected')
+        return outputs.reshape((outputs.shape[0], -1))
+
+    def _dis_prepare(self, rows, kind):
+        """Loads a tile of rows and computes their squared lengths"""
+        rows = np.asarray(rows, dtype=self.dtype)
+        if kind == 'corr':
+            rows = rows - np.mean(rows, axis=1)[:, np.newaxis]
+        return rows, np.sum(rows*rows, axis=1)
+
+    def _dis_block(self, x, sqx, y, sqy, kind, nfeat):
+        """
+        Computes dissimilarities between two tiles of rows.
+
+        Distances use |x-y|**2 = |x|**2 + |y|**2 - 2*np.dot(x,y), and
+        angular measures use np.dot(x,y) / (|x| * |y|).
+        """
+        dot = np.dot(x, y.T)
+        if kind in ['simple', 'euclidean', 'sqeuclidean']:
+            dis = sqx[:, np.newaxis] + sqy - 2*dot
+            dis = np.maximum(dis, 0)  # round-off might give negative values
+            if kind == 'simple':
+                dis = np.sqrt(dis / nfeat)
+            elif kind == 'euclidean':
+                dis = np.sqrt(dis)
+        else:
+            cos = dot / np.sqrt(sqx[:, np.newaxis] * sqy)
+            if kind == 'gaborjet':
+                dis = 1 - cos
+            else:
+                dis = (1 - cos) / 2.
         return dis
 
     def _dis_simple(self, outputs):
         # used in Grill-Spector et al. (1999), Op de Beeck et al. (2001),
         # Panis et al. (2011)
-        outputs = np.array(outputs)
-        dis = np.zeros((outputs.shape[0],outputs.shape[0]))
-        for (i,j), value in np.ndenumerate(dis):
-            dis[i,j] = np.sqrt(np.sum((outputs[i] - outputs[j])**2) / outputs.shape[1])
-        return dis
-
+        return self.dissimilarity(outputs, kind='simple')
 
     def _dis_gj_simple(self, outputs):
         """
@@ -76,56 +933,17 @@ class Model(object):
         It may look complex but this is just a linear algebra implementation of
         1 - np.dot(f,g) / (np.sqrt(np.dot(g,g)) * np.sqrt(np.dot(f,f)) )
         """
-        outputs = np.array(outputs)
-        if outputs.ndim != 2:
-            raise Exception('ERROR: 2 dimensions expected')
-        length = np.sqrt(np.sum(outputs*outputs, axis=1))
-        length = np.tile(length, (len(length), 1))  # make a square matrix
-        return 1 - np.dot(outputs,outputs.T) / (length * length.T)
+        return self.dissimilarity(outputs, kind='gaborjet')
 
     def _dis_corr(self, outputs):
         """
-        Calculate a correlation between magnitudes of gabor jet.
-
-        DOESN'T WORK YET
+        Calculate one minus a correlation between outputs, divided by two.
         """
-        outputs = np.array(outputs)
-        outputs -= np.tile(np.mean(outputs, axis=1), (outputs.shape[1],1)).T
-        if outputs.ndim != 2:
-            sys.exit('ERROR: 2 dimensions expected')
-        length = np.sqrt(np.sum(outputs*outputs, axis=1))
-        length = np.tile(length, (len(length), 1))  # make a square matrix
-        return .5 - np.dot(outputs,outputs.T) / (2 * length * length.T)
-
-    def _dis_corr2(self, outputs):
-        """
-        Calculate a correlation between magnitudes of gabor jet.
-
-        DOESN'T WORK YET
-        """
-        outputs = np.array(outputs)
-        import pdb; pdb.set_trace()
-        outputs -= np.tile(np.mean(outputs, axis=0), (outputs.shape[0],1))
-        if outputs.ndim != 2:
-            sys.exit('ERROR: 2 dimensions expected')
-        length = np.sqrt(np.sum(outputs*outputs, axis=1))
-        length = np.tile(length, (len(length), 1))  # make a square matrix
-        return 1 - np.dot(outputs,outputs.T) / (2 * length * length.T)
+        return self.dissimilarity(outputs, kind='corr')
 
     def _dis_fast(self, outputs):
-        outputs = np.array(outputs)
-        if outputs.ndim != 2:
-            sys.exit('ERROR: 2 dimensions expected')
-        def sq(c):
-            return np.dot(c,c)
-        def func(row):
-            # difference between tuning and each C2 response
-            diff = outputs - \
-                    np.tile(row,(outputs.shape[0],1))
-            # import pdb; pdb.set_trace()
-            # this difference is then square-summed and then exponentiated :)
-            return np.apply_along_axis(sq,1,diff)
-        return np.apply_along_axis(func, 1, outputs)
+        """Calculate squared Euclidean distances between outputs."""
+        return self.dissimilarity(outputs, kind='sqeuclidean')
 
     def input2array(self, names):
         try:
@@ -134,10 +952,10 @@ class Model(object):
             pass
 
         if type(names) == str:
-            array = scipy.misc.imread(names)
+            array = self.imread(names)
         elif type(names) in [list, tuple]:
             if type(names[0]) == str:
-                array = np.array([scipy.misc.imread(n) for n in names])
+                array = np.array([self.imread(n) for n in names])
             else:
                 array = np.array(names)
         elif type(names) == np.ndarray:
@@ -145,9 +963,131 @@ class Model(object):
         else:
             raise ValueError('input type not recognized')
 
-        array = array.astype(float)
+        array = array.astype(self.dtype)
         return array
 
+    def imread(self, fname):
+        """
+        Reads an image from a file.
+
+        If a cache is assigned, decoded images are stored in it, so files
+        are decoded only once as long as they are not modified.
+        """
+        if self.cache is None:
+            return scipy.misc.imread(fname)
+        key = self.cache.file_key(fname)
+        out = self.cache.get(key)
+        if out is None:
+            out = {'im': scipy.misc.imread(fname)}
+            self.cache.set(key, **out)
+        return out['im']
+
+    def _run_cached(self, ims, func, **kwargs):
+        """
+        Calls `func` only on those images whose outputs are not in the cache
+        yet.
+
+        :Args:
+            - ims (numpy.array)
+                A stack of images
+            - func
+                A function that takes a stack of images and returns a dict
+                of outputs with images in the first dimension
+
+        :Kwargs:
+            Any other parameters that affect the outputs (used in keys)
+
+        :Returns:
+            A dict of outputs for all images
+        """
+        if self.cache is None:
+            return func(ims)
+        keys = [self.cache.key(self, im, **kwargs) for im in ims]
+        stored = [self.cache.get(key) for key in keys]
+        missing = [i for i, out in enumerate(stored) if out is None]
+        if len(missing) > 0:
+            out = func(ims[missing])
+            for j, i in enumerate(missing):
+                stored[i] = dict([(k, v[j]) for k, v in out.items()])
+                self.cache.set(keys[i], **stored[i])
+        return dict([(k, np.array([out[k] for out in stored]))
+                     for k in stored[0]])
+
+
+    def iter_images(self, source):
+        """
+        Yields images one by one, reading them from files only when needed.
+
+        :Args:
+            source (str, list or iterable)
+                A glob pattern of image files (e.g., 'stim/*.png'), or an
+                iterable of file names and/or image arrays
+        """
+        if isinstance(source, str):
+            source = sorted(glob.glob(source))
+        for im in source:
+            if isinstance(im, str):
+                im = self.imread(im)
+            yield np.asarray(im, dtype=self.dtype)
+
+    def run_batches(self, source, batch_size=64, output=None, read_ahead=2):
+        """
+        Runs the model on batches of images without holding all of them (or
+        all outputs) in memory.
+
+        Images are read by a background thread up to `read_ahead` batches in
+        advance, so that reading overlaps with computations.
+
+        :Args:
+            source (str, list or iterable)
+                Images; see :func:`iter_images`
+
+        :Kwargs:
+            - batch_size (int, default: 64)
+                Number of images per batch
+            - output (str, default: None)
+                If given, outputs of each batch are appended to this file.
+                If the name ends with '.h5' or '.hdf5', an HDF5 file with
+                one dataset per output is written (requires `h5py`).
+                Otherwise `output` is a folder where each output of each
+                batch is saved in a separate `.npy` file; use
+                :func:`load_batches` to read them back. Batches saved in
+                the same file or folder before are overwritten.
+            - read_ahead (int, default: 2)
+                How many batches to read in advance
+
+        :Yields:
+            A dict of outputs for each batch, with images in the first
+            dimension of each output
+        """
+        ims = _read_ahead(self.iter_images(source), read_ahead*batch_size)
+        writer = None if output is None else _BatchWriter(output)
+        try:
+            batch = []
+            for im in ims:
+                batch.append(im)
+                if len(batch) == batch_size:
+                    out = self._batch_outputs(np.array(batch))
+                    if writer is not None:
+                        writer.append(out)
+                    yield out
+                    batch = []
+            if len(batch) > 0:
+                out = self._batch_outputs(np.array(batch))
+                if writer is not None:
+                    writer.append(out)
+                yield out
+        finally:
+            ims.close()
+            if writer is not None:
+                writer.close()
+
+    def _batch_outputs(self, ims):
+        """
+        Runs the model on a batch of images and returns a dict of outputs.
+        Override this method if `run` does not accept a batch of images.
+        """
+        return {'output': np.asarray(self.run(ims))}
 
     def compare(self, ims):
         output = []
@@ -155,7 +1095,7 @@ class Model(object):
         for imno, im in enumerate(ims):
             print imno,
             if type(im) == str:
-                im = scipy.misc.imread(im)
+                im = self.imread(im)
             out = self.run(im)
             output.append(out)
         dis = self.dissimilarity(output)
@@ -163,6 +1103,8 @@ class Model(object):
         print 'Dissimilarity across stimuli'
         print '0: similar, 1: dissimilar'
         print dis
+        if self.cache is not None:
+            print 'Feature cache: ' + self.cache.summary()
 
         ax = plt.subplot(111)
         matrix = ax.imshow(dis, interpolation='none')
@@ -179,6 +1121,7 @@ class Pixelwise(Model):
         ims = self.input2array(test_ims)
         if ims.ndim != 3:
             sys.exit('ERROR: Input images must be two-dimensional')
+        # outputs are the pixels themselves, so they are not cached
         return ims.reshape((ims.shape[0], -1))
 
 
@@ -191,9 +1134,25 @@ class Zoccolan(Model):
         #self.rfs = np.array([.6,.8,1.])
         self.rfs = np.array([.2,.35,.5])
         # window size will be fixed in pixels and we'll adjust degrees accordingly
-        # self.win_size_px = 300
+        # so this is how many degrees an image spans
+        self.im_deg = 1.
+        # number of tile positions in each direction
+        self.num_tiles = (15,15)
+        # gabor banks are cached per receptive field size in pixels and dtype
+        self._gabors = {}
 
     def get_gabors(self, rf):
+        """
+        Returns a bank of gabors of a given receptive field size in pixels.
+
+        The bank is computed once per receptive field size and then cached.
+
+        :Returns:
+            A (orientations, phases, wavelengths, rf[0], rf[1]) array
+        """
+        key = (tuple(rf), np.dtype(self.dtype).name)
+        if key in self._gabors:
+            return self._gabors[key]
 
         oris = np.linspace(0,np.pi,12)
         phases = [0,np.pi]
@@ -203,9 +1162,9 @@ class Zoccolan(Model):
         # rf = [100,100]
         gabors = np.zeros(( len(oris),len(phases),len(lams), rf[0], rf[1] ))
 
-        i = np.arange(-rf[0]/2+1,rf[0]/2+1)
+        i = np.arange(-rf[0]//2+1,rf[0]//2+1)
         #print i
-        j = np.arange(-rf[1]/2+1,rf[1]/2+1)
+        j = np.arange(-rf[1]//2+1,rf[1]//2+1)
         ii,jj = np.meshgrid(i,j)
         for o, theta in enumerate(oris):
             x = ii*np.cos(theta) + jj*np.sin(theta)
@@ -215,74 +1174,124 @@ class Zoccolan(Model):
                 for s, lam in enumerate(lams):
                     sigmaq = sigma#.56*lam
                     fxx = np.cos(2*np.pi*x/lam + phase) * np.exp(-(x**2+y**2)/(2*sigmaq**2))
-                    # import pdb; pdb.set_trace()
 
                     fxx -= np.mean(fxx)
                     fxx /= np.linalg.norm(fxx)
 
-                    #if p==0:
-                        #plt.subplot(len(oris),len(lams),count+1)
-                        #plt.imshow(fxx,cmap=mpl.cm.gray,interpolation='bicubic')
-                        #count+=1
-
                     gabors[o,p,s,:,:] = fxx
-        plt.show()
+        gabors = gabors.astype(self.dtype)
+        self._gabors[key] = gabors
         return gabors
 
-    def run(self, im):
-        field = im.shape
-        # import pdb; pdb.set_trace()
-        num_tiles = (15,15)#[field[0]/10.,field[0]/10.]
-        size = (field[0]/num_tiles[0], field[0]/num_tiles[0])
-
-        V1 = []#np.zeros( gabors.shape + num_tiles )
-
-    #    tiled_im = im.reshape((num_tiles[0],size[0],num_tiles[1],size[1]))
-    #    tiled_im = np.rollaxis(tiled_im, 1, start=3)
-    #    flat_im = im.reshape((num_tiles[0],num_tiles[1],-1))
-
-        for r, rf in enumerate(self.rfs):
-
-            def apply_filter(window, this_filter):
-                this_resp = np.dot(this_filter,window)/np.linalg.norm(this_filter)
-    #            import pdb; pdb.set_trace()
-                return np.max((0,this_resp)) # returns at least zero
-
-            def filter_bank(this_filter,rf):
-                #print 'done0'
-                resp = scipy.ndimage.filters.generic_filter(
-                                im, apply_filter, size=rf,mode='nearest',
-                                extra_arguments = (this_filter,))
-    #            import pdb; pdb.set_trace()
-                #print 'done1'
-                ii,jj = np.meshgrid(np.arange(0,field[0],size[0]),
-                                        np.arange(0,field[1],size[1]) )
-                selresp = resp[jj,ii]
-
-    #            maxresp = scipy.ndimage.filters.maximum_filter(
-    #                resp,
-    #                size = size,
-    #                mode = 'nearest'
-    #            )
-                return np.ravel(selresp)
+    def get_rf_px(self, rf, field):
+        """Converts a receptive field size from degrees to pixels"""
+        size = int(round(rf / self.im_deg * field[0]))
+        return (size, size)
+
+    def get_windows(self, ims, rf, size):
+        """
+        Returns a strided view (no copy) of all windows over which V1
+        responses are computed.
+
+        :Args:
+            - ims (numpy.array)
+                A (N, height, width) array of images
+            - rf (tuple of int)
+                Receptive field (window) size in pixels
+            - size (tuple of int)
+                Step between windows in pixels
+
+        :Returns:
+            A (N, rows, columns, rf[0], rf[1]) array
+        """
+        ims = np.ascontiguousarray(ims)
+        field = ims.shape[1:]
+        # number of window positions, capped by the number of tiles
+        nrows = min(len(np.arange(0, field[0]-rf[0], size[0])),
+                    self.num_tiles[0])
+        ncols = min(len(np.arange(0, field[1]-rf[1], size[1])),
+                    self.num_tiles[1])
+        strides = ims.strides
+        return np.lib.stride_tricks.as_strided(ims,
+            shape=(len(ims), nrows, ncols, rf[0], rf[1]),
+            strides=(strides[0], size[0]*strides[1], size[1]*strides[2],
+                     strides[1], strides[2]))
+
+    def test_batch(self, ims):
+        """
+        Computes V1 responses for a stack of images, skipping those that
+        are already in the cache (see :func:`_test_batch`).
+        """
+        ims = np.asarray(ims, dtype=self.dtype)
+        # receptive field sizes are an array, so they are not picked up by
+        # get_params
+        out = self._run_cached(ims, self._test_outputs, rfs=self.rfs.tolist())
+        return [out['V1_%d' % i] for i in range(len(self.rfs))]
+
+    def _test_outputs(self, ims):
+        """Returns V1 responses of :func:`_test_batch` as a dict"""
+        return dict([('V1_%d' % i, V1resp)
+                     for i, V1resp in enumerate(self._test_batch(ims))])
+
+    def _test_batch(self, ims):
+        """
+        Computes V1 responses for a stack of images.
 
+        For each receptive field size, responses of all orientations,
+        phases and scales in all images are computed with one matrix
+        product between the gabor bank and a strided view of windows per
+        row of tiles.
+
+        :Args:
+            ims (numpy.array)
+                A (N, height, width) array of images
+
+        :Returns:
+            A list (one per receptive field size) of (N, orientations,
+            phases, wavelengths, num_tiles[0], num_tiles[1]) arrays
+        """
+        ims = np.asarray(ims, dtype=self.dtype)
+        field = ims.shape[1:]
+        size = (field[0]//self.num_tiles[0], field[0]//self.num_tiles[0])
+
+        V1 = []
+        for rf_deg in self.rfs:
+            rf = self.get_rf_px(rf_deg, field)
             gabors = self.get_gabors(rf)
-            #import pdb; pdb.set_trace()
-            gabors = gabors.reshape(gabors.shape[:3]+(-1,))
-    #        gabors_norms = np.apply_along_axis(np.linalg.norm, -1, gabors)
-    #        import pdb; pdb.set_trace()
-    #        V1.append( np.apply_along_axis(filter_bank, -1, gabors,rf) )
-            V1resp = np.zeros(gabors.shape[:-1]+num_tiles)
-    #        import pdb; pdb.set_trace()
-            for i,wi in enumerate(np.arange(0,field[0]-rf[0],size[0])):
-                for j,wj in enumerate(np.arange(0,field[1]-rf[1],size[1])):
-                    window = im[wi:wi+rf[0],wj:wj+rf[1]]
-                    resp = np.inner(gabors,np.ravel(window))
-                    resp[resp<0] = 0
-                    V1resp[:,:,:,i,j] = resp #/gabors_norms
-    #                print 'done'
+            windows = self.get_windows(ims, rf, size)
+            # one row of tiles at a time: tensordot copies its input, and a
+            # copy of all windows would be rf[0]*rf[1]/size**2 times larger
+            # than the images
+            resp = np.zeros(windows.shape[:3] + gabors.shape[:3],
+                            dtype=self.dtype)
+            for row in range(windows.shape[1]):
+                resp[:, row] = np.tensordot(windows[:, row], gabors,
+                                            axes=([2,3],[3,4]))
+            resp[resp<0] = 0
+            # move tiles to the end as (N, ori, phase, lambda, rows, cols)
+            resp = np.rollaxis(np.rollaxis(resp, 1, 6), 1, 6)
+            V1resp = np.zeros((len(ims),) + gabors.shape[:3] + self.num_tiles,
+                              dtype=self.dtype)
+            V1resp[..., :resp.shape[-2], :resp.shape[-1]] = resp
             V1.append(V1resp)
-        return [V1]
+        return V1
+
+    def run(self, im):
+        """
+        Computes V1 responses to a single image.
+
+        :Returns:
+            [V1], where V1 is a list (one per receptive field size) of
+            (orientations, phases, wavelengths, num_tiles[0], num_tiles[1])
+            arrays
+        """
+        V1 = self.test_batch(np.asarray(im)[np.newaxis])
+        return [[V1resp[0] for V1resp in V1]]
+
+    def _batch_outputs(self, ims):
+        V1 = self.test_batch(ims)
+        return {'V1': np.hstack([V1resp.reshape((len(ims), -1))
+                                 for V1resp in V1])}
 
 
 class GaborJet(Model):
@@ -294,54 +1303,124 @@ class GaborJet(Model):
 
     Original implementation copyright 2004 Xiaomin Yue
     """
-    def run(self, ims=None):
+    # relative cost of an inverse FFT per pixel and per log2(pixels) with
+    # respect to a single complex multiply-add in the sparse mode
+    fft_cost = .5
+
+    def __init__(self, nScale=5, nOrientation=8):
+        """
+        Initializes the Gabor-Jet model
+
+        :Kwargs:
+            - nScale (int, default: 5)
+                Number of spatial frequency scales
+            - nOrientation (int, default: 8)
+                Number of orientations; angle = np.pi/nOrientation
+        """
+        self.nScale = nScale
+        self.nOrientation = nOrientation
+        # frequency kernel banks are costly to build, so we keep them
+        # around, keyed by (image shape, sigma, nScale, nOrientation, dtype)
+        self._kernels = {}
+        # plans for evaluating jets at grid positions only
+        self._sparse_plans = {}
+
+    def run(self, ims=None, batch_size=64, **kwargs):
+        """
+        Computes gabor jets for a list or an array of images.
+
+        Images are processed in batches of `batch_size` using
+        :func:`test_batch`, so the frequency kernel bank is built only once.
+
+        :Kwargs:
+            - ims (list or numpy.array, default: None)
+                Input images. If None, a test image is used.
+            - batch_size (int, default: 64)
+                How many images to transform at once. Larger batches are
+                faster but need about `batch_size*im.size*16` bytes of memory.
+            - all other keyword arguments are passed to :func:`test_batch`
+
+        :Returns:
+            (JetsMagnitudes, JetsPhases, grid_position), where magnitudes and
+            phases are flattened per image into rows of a 2D array
+        """
         if ims is None:
             ims = [self.get_testim()]
+        elif isinstance(ims, str) or np.ndim(ims) == 2:  # a single image
+            ims = [ims]
         JetsMagnitudes = []
         JetsPhases = []
-        for im in ims:
-            JetsMagnitude, JetsPhase, grid_position = self.test(im)
-            JetsMagnitudes.append(JetsMagnitude.ravel())
-            JetsPhases.append(JetsPhase.ravel())
-        return (np.array(JetsMagnitudes), np.array(JetsPhases), grid_position)
+        for start in range(0, len(ims), batch_size):
+            ims_batch = self.input2array(ims[start:start+batch_size])
+            JetsMagnitude, JetsPhase, grid_position = self._test_cached(
+                                                        ims_batch, **kwargs)
+            JetsMagnitudes.append(JetsMagnitude.reshape((len(ims_batch), -1)))
+            if JetsPhase is not None:
+                JetsPhases.append(JetsPhase.reshape((len(ims_batch), -1)))
+        if len(JetsPhases) > 0:
+            JetsPhases = np.vstack(JetsPhases)
+        else:  # phases were not computed
+            JetsPhases = None
+        return (np.vstack(JetsMagnitudes), JetsPhases, grid_position)
+
+    def _test_cached(self, ims, **kwargs):
+        """
+        Calls :func:`test_batch` only on those images whose outputs are not
+        in the cache yet
+        """
+        if self.cache is None:
+            return self.test_batch(ims, **kwargs)
+        # all modes give the same outputs
+        key_kwargs = dict([(k,v) for k,v in kwargs.items() if k != 'mode'])
+        keys = [self.cache.key(self, im, **key_kwargs) for im in ims]
+        stored = [self.cache.get(key) for key in keys]
+        missing = [i for i, out in enumerate(stored) if out is None]
+        if len(missing) > 0:
+            JetsMagnitude, JetsPhase, grid_position = self.test_batch(
+                                                    ims[missing], **kwargs)
+            for j, i in enumerate(missing):
+                stored[i] = {'mag': JetsMagnitude[j]}
+                if JetsPhase is not None:
+                    stored[i]['phase'] = JetsPhase[j]
+                self.cache.set(keys[i], **stored[i])
+        else:
+            grid_position = self.get_grid(ims.shape[1],
+                                          kwargs.get('grid_size', 0))[1]
+        if kwargs.get('phase', True):
+            JetsPhase = np.array([out['phase'] for out in stored])
+        else:
+            JetsPhase = None
+        return (np.array([out['mag'] for out in stored]), JetsPhase,
+                grid_position)
 
-    def test(self,
-            im,
-            cell_type = 'complex',  # 'complex': 40 output values
-                                    # 'simple': 80 values
-            grid_size = 0,  # how many positions within an image to take
-            sigma = 2*np.pi,  # control the size of gaussian envelope
-            ):
+    def _batch_outputs(self, ims):
+        JetsMagnitude, JetsPhase, grid_position = self._test_cached(ims)
+        return {'magnitude': JetsMagnitude.reshape((len(ims), -1)),
+                'phase': JetsPhase.reshape((len(ims), -1))}
+
+    def get_grid(self, size, grid_size=0):
         """
+        Returns grid positions where jets are sampled
+
         :Args:
-            im (numpy.array)
-                input image; can be (128,128) or (256,256) px size
+            size (int)
+                Image size; can be 128 or 256 px
 
         :Kwargs:
-            - cell_type (str, default: 'complex')
-                Choose between 'complex'(40 output values) and 'simple'
-                (80 values, NOT FULLY WORKING, FIX)
-            - grid_size (int, default: 0)
+            grid_size (int, default: 0)
                 How many positions within an image to take
-            - sigma (float, default: 2*np.pi)
-                Control the size of gaussian envelope
 
         :Returns:
-            (JetsMagnitude, JetsPhase, grid_position)
-
+            (rangeXY, grid_position)
         """
-        if im.shape[0]!=im.shape[1]:
-            sys.exit('The image has to be square. Please try again')
-
-        # generate the grid
-        if len(im) in [128, 256]:
+        if size in [128, 256]:
             if grid_size == 0:
                 rangeXY = np.arange(20, 110+1, 10)  # 10x10
             elif grid_size == 1:
                 rangeXY = np.arange(10, 120+1, 10)  # 12x12
             else:
                 rangeXY = np.arange(1, 128+1)  # 128x128
-            rangeXY *= len(im) / 128  # if len(im)==256, scale up by two
+            rangeXY *= size // 128  # if size==256, scale up by two
             rangeXY -= 1  # shift from MatLab indexing to Python
         else:
             sys.exit('The image has to be 256*256 px or 128*128 px. Please try again')
@@ -351,35 +1430,48 @@ class GaborJet(Model):
         grid = xx + 1j*yy
         grid = grid.T.ravel()  # transpose just to match MatLab's grid(:) behavior
         grid_position = np.hstack([grid.imag, grid.real]).T
+        return rangeXY, grid_position
+
+    def get_kernels(self, shape, sigma=2*np.pi):
+        """
+        Returns a bank of Morlet wavelets in the frequency domain
+
+        The bank is computed once per image shape and sigma and then cached.
 
-        # FFT of the image
-        im_freq = np.fft.fft2(im)
+        :Args:
+            shape (tuple of int)
+                Image shape
+
+        :Kwargs:
+            sigma (float, default: 2*np.pi)
+                Control the size of gaussian envelope
+
+        :Returns:
+            A (nScale*nOrientation, shape[0], shape[1]) array of kernels with
+            DC in the corners
+        """
+        key = (tuple(shape), sigma, self.nScale, self.nOrientation,
+               np.dtype(self.dtype).name)
+        if key in self._kernels:
+            return self._kernels[key]
 
         # setup the paramers
-        nScale = 5  # spatial frequency scales
-        nOrientation = 8  # orientation spacing; angle = np.pi/nOrientations
-        xHalfResL = im.shape[0]/2
-        yHalfResL = im.shape[1]/2
-        kxFactor = 2*np.pi/im.shape[0]
-        kyFactor = 2*np.pi/im.shape[1]
+        xHalfResL = shape[0] // 2
+        yHalfResL = shape[1] // 2
+        kxFactor = 2*np.pi/shape[0]
+        kyFactor = 2*np.pi/shape[1]
 
         # setup space coordinate
         [tx,ty] = np.meshgrid(np.arange(-xHalfResL,xHalfResL),np.arange(-yHalfResL,yHalfResL))
         tx = kxFactor*tx
         ty = kyFactor*(-ty)
 
-        # initiallize useful variables
-        if cell_type == 'complex':
-            JetsMagnitude  = np.zeros((len(grid),nScale*nOrientation))
-            JetsPhase      = np.zeros((len(grid),nScale*nOrientation))
-        else:
-            JetsMagnitude  = np.zeros((len(grid),2*nScale*nOrientation))
-            JetsPhase      = np.zeros((len(grid),nScale*nOrientation))
-
-        for LevelL in range(nScale):
+        kernels = np.zeros((self.nScale*self.nOrientation,) + tuple(shape),
+                           dtype=self.dtype)
+        for LevelL in range(self.nScale):
             k0 = np.pi/2 * (1/np.sqrt(2))**LevelL
-            for DirecL in range(nOrientation):
-                kA = np.pi * DirecL / nOrientation
+            for DirecL in range(self.nOrientation):
+                kA = np.pi * DirecL / self.nOrientation
                 k0x = k0 * np.cos(kA)
                 k0y = k0 * np.sin(kA)
                 # generate a kernel specified scale and orientation, which has DC on the center
@@ -389,58 +1481,188 @@ class GaborJet(Model):
                     np.exp( -(sigma/k0)**2/2 * (k0**2+tx**2+ty**2) )
                     )
                 # use fftshift to change DC to the corners
-                freq_kernel = np.fft.fftshift(freq_kernel)
-
-                # convolve the image with a kernel of the specified scale and orientation
-                TmpFilterImage = im_freq*freq_kernel
-                #
-                # calculate magnitude and phase
-                iTmpFilterImage = np.fft.ifft2(TmpFilterImage)
-                #
-                #eps = np.finfo(float).eps**(3./4)
-                #real = np.real(iTmpFilterImage)
-                #real[real<eps] = 0
-                #imag = np.imag(iTmpFilterImage)
-                #imag[imag<eps] = 0
-                #iTmpFilterImage = real + 1j*imag
-
-                TmpGWTPhase = np.angle(iTmpFilterImage)
-                tmpPhase = TmpGWTPhase[rangeXY,:][:,rangeXY] + np.pi
-                JetsPhase[:,LevelL*nOrientation+DirecL] = tmpPhase.ravel()
-                #import pdb; pdb.set_trace()
-
-                if cell_type == 'complex':
-                    TmpGWTMag = np.abs(iTmpFilterImage)
-                    # get magnitude and phase at specific positions
-                    tmpMag = TmpGWTMag[rangeXY,:][:,rangeXY]
-                    JetsMagnitude[:,LevelL*nOrientation+DirecL] = tmpMag.ravel()
-                else:
-                    TmpGWTMag_real = np.real(iTmpFilterImage)
-                    TmpGWTMag_imag = np.imag(iTmpFilterImage)
-                    # get magnitude and phase at specific positions
-                    tmpMag_real = TmpGWTMag_real[rangeXY,:][:,rangeXY]
-                    tmpMag_imag = TmpGWTMag_imag[rangeXY,:][:,rangeXY]
-                    JetsMagnitude_real[:,LevelL*nOrientation+DirecL] = tmpMag_real.ravel()
-                    JetsMagnitude_imag[:,LevelL*nOrientation+DirecL] =  tmpMag_imag.ravel()
-
-        if cell_type == 'simple':
-            JetsMagnitude = np.vstack((JetsMagnitude_real, JetsMagnitude_imag))
+                kernels[LevelL*self.nOrientation+DirecL] = np.fft.fftshift(freq_kernel)
+
+        self._kernels[key] = kernels
+        return kernels
+
+    def test(self,
+            im,
+            cell_type = 'complex',  # 'complex': 40 output values
+                                    # 'simple': 80 values
+            grid_size = 0,  # how many positions within an image to take
+            sigma = 2*np.pi,  # control the size of gaussian envelope
+            mode = 'auto',  # how to compute responses at grid positions
+            phase = True,  # whether to compute phases
+            ):
+        """
+        :Args:
+            im (numpy.array)
+                input image; can be (128,128) or (256,256) px size
+
+        :Kwargs:
+            - cell_type (str, default: 'complex')
+                Choose between 'complex'(40 output values) and 'simple'
+                (80 values)
+            - grid_size (int, default: 0)
+                How many positions within an image to take
+            - sigma (float, default: 2*np.pi)
+                Control the size of gaussian envelope
+            - mode ({'auto', 'fft', 'sparse'}, default: 'auto')
+                How responses are computed; see :func:`test_batch`
+            - phase (bool, default: True)
+                Whether phases should be computed. If False, JetsPhase is
+                None.
+
+        :Returns:
+            (JetsMagnitude, JetsPhase, grid_position)
+
+        """
+        JetsMagnitude, JetsPhase, grid_position = self.test_batch(
+            np.asarray(im)[np.newaxis], cell_type=cell_type,
+            grid_size=grid_size, sigma=sigma, mode=mode, phase=phase)
+        if JetsPhase is not None:
+            JetsPhase = JetsPhase[0]
         # use magnitude for dissimilarity measures
+        return (JetsMagnitude[0], JetsPhase, grid_position)
+
+    def test_batch(self,
+            ims,
+            cell_type = 'complex',
+            grid_size = 0,
+            sigma = 2*np.pi,
+            mode = 'auto',
+            phase = True,
+            ):
+        """
+        Computes gabor jets for a stack of images at once.
+
+        All images are transformed with a single FFT call. Then responses
+        at grid positions are obtained in one of two ways:
+            - 'fft': each kernel of the (cached) kernel bank is applied to
+              the whole stack and transformed back with a full inverse FFT
+            - 'sparse': the inverse transform is evaluated at grid positions
+              only and over frequencies where a kernel is non-negligible
+              (see :func:`get_sparse_plan`)
+
+        :Args:
+            ims (numpy.array)
+                A (N, size, size) array of images; size can be 128 or 256 px
+
+        :Kwargs:
+            - mode ({'auto', 'fft', 'sparse'}, default: 'auto')
+                How responses are computed. If 'auto', 'sparse' is used
+                when the grid is sparse enough for it to be cheaper.
+            - phase (bool, default: True)
+                Whether phases should be computed. If False, JetsPhase is
+                None.
+            - all other keyword arguments are the same as for :func:`test`
+
+        :Returns:
+            (JetsMagnitude, JetsPhase, grid_position), where JetsMagnitude
+            and JetsPhase are of shape (N, number of grid positions,
+            number of kernels)
+        """
+        ims = np.asarray(ims)
+        if ims.shape[1] != ims.shape[2]:
+            sys.exit('The image has to be square. Please try again')
+
+        # generate the grid
+        rangeXY, grid_position = self.get_grid(ims.shape[1], grid_size)
+        nGrid = len(rangeXY)**2
+
+        # FFT of the images; unlike np.fft, scipy.fftpack keeps single
+        # precision, so transforms run in the complex type matching dtype
+        cdtype = self.get_complex_dtype()
+        ims_freq = scipy.fftpack.fft2(ims.astype(cdtype))
+        kernels = self.get_kernels(ims.shape[1:], sigma=sigma)
+        nKernels = len(kernels)
+
+        if mode == 'auto':
+            plan = self.get_sparse_plan(ims.shape[1:], rangeXY, sigma=sigma)
+            npix = ims.shape[1] * ims.shape[2]
+            sparse_cost = sum([len(rows)*len(cols)*len(rangeXY) +
+                               len(rows)*len(rangeXY)**2
+                               for rows, cols, k, ex, ey in plan])
+            fft_cost = self.fft_cost * nKernels * npix * np.log2(npix)
+            mode = 'sparse' if sparse_cost < fft_cost else 'fft'
+
+        # complex responses at grid positions
+        resp = np.zeros((len(ims),nGrid,nKernels), dtype=cdtype)
+        if mode == 'sparse':
+            plan = self.get_sparse_plan(ims.shape[1:], rangeXY, sigma=sigma)
+            for k, (rows, cols, freq_kernel, ex, ey) in enumerate(plan):
+                # inverse DFT along columns and then rows, as matrix products
+                tmp = ims_freq[:,rows][:,:,cols] * freq_kernel
+                tmp = np.dot(tmp, ey.T)  # (N, rows, grid y)
+                tmp = np.tensordot(tmp, ex, axes=([1],[1]))  # (N, grid y, x)
+                resp[:,:,k] = np.swapaxes(tmp, 1, 2).reshape((len(ims), nGrid))
+        elif mode == 'fft':
+            for k, freq_kernel in enumerate(kernels):
+                # convolve the images with a kernel of the specified scale and orientation
+                iTmpFilterImage = scipy.fftpack.ifft2(ims_freq*freq_kernel)
+                # get values at specific positions only
+                iTmpFilterImage = iTmpFilterImage[:,rangeXY][:,:,rangeXY]
+                resp[:,:,k] = iTmpFilterImage.reshape((len(ims), nGrid))
+        else:
+            raise ValueError('mode %s not recognized' % mode)
+
+        if phase:
+            JetsPhase = np.angle(resp) + np.pi
+        else:
+            JetsPhase = None
+        if cell_type == 'complex':
+            JetsMagnitude = np.abs(resp)
+        else:
+            JetsMagnitude = np.concatenate([np.real(resp), np.imag(resp)],
+                                           axis=2)
+
         return (JetsMagnitude, JetsPhase, grid_position)
 
-    def dissimilarity(self, outputs):
+    def get_sparse_plan(self, shape, rangeXY, sigma=2*np.pi, tol=1e-12):
+        """
+        Prepares evaluation of filtered images at grid positions only.
+
+        For each kernel, only rows and columns of the spectrum where the
+        kernel exceeds `tol` times its maximum are kept, together with the
+        corresponding inverse DFT matrices. Plans are cached.
+
+        :Returns:
+            A list of (rows, cols, kernel values, row DFT matrix, column DFT
+            matrix) per kernel
+        """
+        key = (tuple(shape), sigma, self.nScale, self.nOrientation,
+               tuple(rangeXY), tol, np.dtype(self.dtype).name)
+        if key in self._sparse_plans:
+            return self._sparse_plans[key]
+
+        kernels = self.get_kernels(shape, sigma=sigma)
+        cdtype = self.get_complex_dtype()
+        # inverse DFT matrices, evaluated at grid positions only
+        ex = np.exp(2j*np.pi * np.outer(rangeXY, np.arange(shape[0])) /
+                    shape[0]) / shape[0]
+        ey = np.exp(2j*np.pi * np.outer(rangeXY, np.arange(shape[1])) /
+                    shape[1]) / shape[1]
+        plan = []
+        for freq_kernel in kernels:
+            keep = np.abs(freq_kernel) > tol * np.max(np.abs(freq_kernel))
+            rows = np.nonzero(np.any(keep, 1))[0]
+            cols = np.nonzero(np.any(keep, 0))[0]
+            plan.append((rows, cols, freq_kernel[np.ix_(rows, cols)],
+                         ex[:, rows].astype(cdtype),
+                         ey[:, cols].astype(cdtype)))
+        self._sparse_plans[key] = plan
+        return plan
+
+    def dissimilarity(self, outputs, kind='gaborjet', **kwargs):
         """
         Calculate similarity between magnitudes of gabor jet.
 
-        It may look complex but this is just a linear algebra implementation of
+        See :func:`Model.dissimilarity` for details; by default, this is
         1 - np.dot(f,g) / (np.sqrt(np.dot(g,g)) * np.sqrt(np.dot(f,f)) )
         """
-        outputs = np.array(outputs)
-        if outputs.ndim != 2:
-            sys.exit('ERROR: 2 dimensions expected')
-        length = np.sqrt(np.sum(outputs*outputs, axis=1))
-        length = np.tile(length, (len(length), 1))  # make a square matrix
-        return 1 - np.dot(outputs,outputs.T) / (length * length.T)
+        return super(GaborJet, self).dissimilarity(outputs, kind=kind,
+                                                   **kwargs)
 
     def compare(self, ims):
         output = []
@@ -454,6 +1676,8 @@ class GaborJet(Model):
         print 'Dissimilarity across stimuli'
         print '0: similar, 1: dissimilar'
         print dis
+        if self.cache is not None:
+            print 'Feature cache: ' + self.cache.summary()
 
         ax = plt.subplot(111)
         matrix = ax.imshow(dis, interpolation='none')
@@ -494,7 +1718,15 @@ class HMAX(Model):
     since it is used in Jim Mutch's latest implementation of HMAX
     http://cbcl.mit.edu/jmutch/cns/
     """
-    def __init__(self, matlab=False, filt_type='gaussian'):
+    # VTUs are computed from C2 and engines only change round-off errors
+    _nonparams = Model._nonparams + ('istrained', 'S1_engine',
+                                     'S2_block_size', 'VTU_top_k')
+    # relative cost of an FFT convolution per pixel and per log2(pixels)
+    # with respect to a single multiply-add of a direct convolution
+    fft_cost = 1.
+
+    def __init__(self, matlab=False, filt_type='gaussian', S1_engine='auto',
+                 S2_config=(2,2), S2_dict=None, S2_seed=0):
         """
         Initializes key HMAX parameters
 
@@ -504,14 +1736,52 @@ class HMAX(Model):
                 If *True*, Gaussian filters will be implemented using the
                 original models implementation which mimicks MatLab's behavior.
                 Otherwise, a more efficient numerical method is used.
+            filt_type: {'gaussian', 'gabor'}
+                Type of S1 filters (default: 'gaussian')
+            S1_engine: {'auto', 'direct', 'separable', 'fft'}
+                How S1 convolutions are computed. 'direct' uses spatial
+                convolution, 'separable' applies low-rank separable
+                approximations of filters as sequences of 1D convolutions
+                (see `S1_sep_tol`), 'fft' uses FFT convolution reusing the
+                image spectrum for all filters, and 'auto' (default) picks
+                one of them per filter size using a simple cost model.
+            S2_config: (int, int)
+                How many C1 outputs to put into one "window" in S2 in each
+                direction (default: (2,2))
+            S2_dict: None, int, or list
+                Orientation combinations of C1 afferents that S2 units are
+                tuned to. If None (default), all n_ori**(S2_config[0] *
+                S2_config[1]) combinations are used, which is only feasible
+                for small `S2_config`. If int, that many combinations are
+                sampled at random (see `S2_seed`). A list (or an array) of
+                combinations, one per row, can also be given. C2 has one
+                output per combination.
+            S2_seed: int
+                Seed of the random number generator used to sample
+                combinations (default: 0)
         """
+        self.matlab = matlab
+        self.filt_type = filt_type
         self.n_ori = 4 # number of orientations
         # S1 filter sizes for scale band 1, 2, 3, and 4
         self.filter_sizes_all = [[7, 9], [11, 13, 15], [17, 19, 21],
                                  [23, 25, 27, 29]]
         # specify (per scale band) how many S1 units will be used to pool over
         self.C1_pooling_all = [4, 6, 9, 12]
-        self.S2_config = [2,2]  # how many C1 outputs to put into one "window" in S2 in each direction
+        self.S2_config = list(S2_config)  # how many C1 outputs to put into one "window" in S2 in each direction
+        if isinstance(S2_dict, (int, long, np.integer)):
+            S2_dict = int(S2_dict)
+        elif S2_dict is not None:
+            S2_dict = np.asarray(S2_dict).tolist()  # to keep it a parameter
+        self.S2_dict = S2_dict
+        self.S2_seed = S2_seed
+        # how many S2 responses to compute at once (per position and
+        # orientation combination); bounds S2 memory to ~8 MB by default
+        self.S2_block_size = 2**20
+        # relative error (Frobenius norm) allowed for separable
+        # approximations of S1 filters; the default only drops components
+        # at the level of round-off errors
+        self.S1_sep_tol = 1e-10
 
         if filt_type == 'gaussian':  # "typically" used
             if matlab:  # exact replica of the MatLab implementation
@@ -527,7 +1797,23 @@ class HMAX(Model):
         else:
             raise ValueError, "filter type not recognized"
 
+        if S1_engine not in ['auto', 'direct', 'separable', 'fft']:
+            raise ValueError, "S1 engine not recognized"
+        self.S1_engine = S1_engine
+        # filter spectra are cached per FFT shape
+        self._filts_freq = {}
+        # separable components of filters are cached per tolerance
+        self._filts_sep = {}
+        # decompositions of normalization masks into runs of ones
+        self._mask_runs = {}
+        # S2 orientation combinations are computed once per configuration
+        self._S2_seqs = {}
+        self.get_S2_seq()
+
         self.istrained = False  # initially VTUs are not set up
+        # if set, only responses of VTUs tuned to this many prototypes
+        # nearest to each image are kept (see get_VTU)
+        self.VTU_top_k = None
 
     def run(self, test_ims=None, train_ims=None):
         """
@@ -544,70 +1830,224 @@ class HMAX(Model):
 
         return output
 
-    def train(self, train_ims):
+    def train(self, train_ims, append=False):
         """
         Train the model, i.e., supply VTUs with C2 responses to 'prototype'
         images to which these units will be maximally tuned.
+
+        If `append` is *True*, new prototypes are added to those the model
+        has already been trained on, so that C2 responses to the old ones
+        are not recomputed.
         """
         print 'training:',
+        append = append and self.istrained
+        self.istrained = False  # no VTUs while computing prototypes
         try:
-            self.tuning = pickle.load(open(train_ims,'rb'))
+            tuning = pickle.load(open(train_ims,'rb'))
             print 'done'
         except:
             train_ims = self.input2array(train_ims)
-            self.tuning = self.test(train_ims, op='training')['C2']
+            tuning = self.test(train_ims, op='training', keep_C1=False)['C2']
+        if append:
+            self.tuning = np.vstack([self.tuning, tuning])
+        else:
+            self.tuning = tuning
         self.istrained = True
 
-    def test(self, ims, op='testing'):
+    def test(self, ims, op='testing', keep_S2=False, workers=1,
+             keep_C1=True):
         """
         Test the model on the given image
+
+        **Parameters**
+
+            ims: str, list or numpy.array
+                Input images
+            op: str
+                Operation name for the progress output (default: 'testing')
+            keep_S2: boolean
+                If *True*, S2 responses of all images and bands are stored
+                in `output['S2']`. This takes a lot of memory, so by default
+                only C2 is computed, without ever storing the full S2.
+            workers: int
+                Number of processes to distribute images over (default: 1).
+                Each process gets a copy of the model once and writes its
+                C1 and C2 outputs directly to memory-mapped arrays. Outputs
+                are identical to those of a single process. Ignored if
+                `keep_S2` is *True*.
+            keep_C1: boolean
+                If *False*, full resolution C1 is not returned and C1 is
+                only computed at positions sampled by S2 (see
+                :func:`get_C1_grid`), which is much faster and takes much
+                less memory (default: *True*).
         """
         ims = self.input2array(ims)
-        # Get number of filter sizes
-        size_S1 = sum([len(fs) for fs in self.filter_sizes_all])
+        if ims.ndim == 2:
+            ims = ims[np.newaxis]
         # outputs from each layer are stored if you want to inspect them closer
-        # but note that S1 is *massive*
-        output = {}
-        # S1 will not be in the output because it's too large:
+        # but note that S1 is *massive* so it is never stored:
         # with default parameters S1 takes 256*256*12*4*64bits = 24Mb per image
-        S1 = np.zeros((ims.shape[1], ims.shape[2], size_S1, self.n_ori))
-        output['C1'] = np.zeros(ims.shape + (self.n_ori,
-                                len(self.filter_sizes_all)))
+        # (half of that if dtype is 'float32')
+        output = {}
+        if keep_C1:
+            output['C1'] = np.zeros(ims.shape + (self.n_ori,
+                            len(self.filter_sizes_all)), dtype=self.dtype)
         # S2 has an irregular shape which depends on the spatial frequency band
-        # so we'll omit it as well
+        # so it is only stored if explicitly requested
         S2 = []
-        C2_tmp = np.zeros(((self.S2_config[0]*self.S2_config[1])**self.n_ori,
-                            len(self.filter_sizes_all)))
-        output['C2'] = np.zeros((len(ims),C2_tmp.shape[0]))
+        output['C2'] = np.zeros((len(ims), len(self.get_S2_seq())),
+                                dtype=self.dtype)
 
+        # first take whatever is already stored
+        use_cache = self.cache is not None and not keep_S2
+        keys = {}
+        todo = []
         for imNo, im in enumerate(ims):
-            sys.stdout.write("\r%s: %d%%" %(op, 100*imNo/len(ims)))
-            sys.stdout.flush()
-            # Go through each scale band
-            S1_idx = 0
-            for which_band in range(len(self.filter_sizes_all)):
-                # calculate S1 responses
-                S1_tmp = self.get_S1(im, which_band)
-                num_filter = len(self.filter_sizes_all[which_band])
-                # store S1 responses for each scale band
-                S1[..., S1_idx:S1_idx + num_filter, :] = S1_tmp
-                S1_idx += num_filter
-                # calculate other layers
-                C1_tmp = self.get_C1(S1_tmp, which_band)
-                output['C1'][imNo, ..., which_band] = C1_tmp
-                S2_tmp = self.get_S2(C1_tmp, which_band)
-                S2.append(S2_tmp)
-                C2_tmp[:, which_band] = self.get_C2(S2_tmp, which_band)
-            output['C2'][imNo] = np.max(C2_tmp, -1) # max over all scale bands
-        output['S2'] = S2
+            if use_cache:
+                keys[imNo] = self.cache.key(self, im)
+                stored = self.cache.get(keys[imNo])
+                # C1 is not stored if it was not kept
+                if stored is not None and (not keep_C1 or 'C1' in stored):
+                    if keep_C1:
+                        output['C1'][imNo] = stored['C1']
+                    output['C2'][imNo] = stored['C2']
+                    continue
+            todo.append(imNo)
+
+        if workers > 1 and not keep_S2 and len(todo) > 1:
+            self._test_parallel(ims, todo, output, workers, op)
+        else:
+            for count, imNo in enumerate(todo):
+                sys.stdout.write("\r%s: %d%%" %(op, 100*count/len(todo)))
+                sys.stdout.flush()
+                C1, C2, S2_im = self.test_image(ims[imNo], keep_S2=keep_S2,
+                                                imNo=imNo, keep_C1=keep_C1)
+                if keep_C1:
+                    output['C1'][imNo] = C1
+                output['C2'][imNo] = C2
+                S2.extend(S2_im)
+
+        if use_cache:
+            for imNo in todo:
+                self.cache.set(keys[imNo], **dict([(name, output[name][imNo])
+                                                   for name in output]))
+        if keep_S2:
+            output['S2'] = S2
         # calculate VTU if trained
         if self.istrained:
-            output['VTU'] = self.get_VTU(output['C2'])
+            output['VTU'] = self._profile('VTU', None, None, self.get_VTU,
+                                          output['C2'], top_k=self.VTU_top_k)
         sys.stdout.write("\r%s: done\n" %op)
 
 
         return output
 
+    def _profile(self, layer, band, imNo, func, *args, **kwargs):
+        """Calls `func` and records its cost if a profiler is set"""
+        if self.profiler is None:
+            return func(*args, **kwargs)
+        else:
+            return self.profiler.call(layer, band, imNo, func, *args,
+                                      **kwargs)
+
+    def test_image(self, im, keep_S2=False, imNo=None, keep_C1=True):
+        """
+        Computes C1 and C2 (and optionally S2) responses to a single image.
+        `imNo` is only used to label profiler records.
+
+        **Returns**
+            (C1, C2, S2), where C1 is of shape (image height, image width,
+            orientations, bands) (None unless `keep_C1` is *True*), and S2
+            is a list of S2 responses per band (empty unless `keep_S2` is
+            *True*)
+        """
+        im = np.asarray(im, dtype=self.dtype)
+        if keep_C1:
+            C1 = np.zeros(im.shape + (self.n_ori, len(self.filter_sizes_all)),
+                          dtype=self.dtype)
+        else:
+            C1 = None
+        C2_tmp = np.zeros((len(self.get_S2_seq()),
+                           len(self.filter_sizes_all)), dtype=self.dtype)
+        S2 = []
+        # image spectra are shared by all bands in FFT convolutions
+        spectra = None
+        if any(self.get_S1_engine(band, j, im.shape) == 'fft'
+               for band, sizes in enumerate(self.filter_sizes_all)
+               for j in range(len(sizes))):
+            spectra = self._profile('FFT', None, imNo,
+                                    self.get_S1_spectra, im)
+        # and cumulative sums for normalization are shared by all filters
+        energy = self._profile('energy', None, imNo, self.get_S1_energy, im)
+        # Go through each scale band
+        for which_band in range(len(self.filter_sizes_all)):
+            # calculate S1 responses
+            S1_tmp = self._profile('S1', which_band, imNo, self.get_S1, im,
+                                   which_band, spectra=spectra, energy=energy)
+            # calculate other layers
+            if keep_C1:
+                C1_tmp = self._profile('C1', which_band, imNo, self.get_C1,
+                                       S1_tmp, which_band)
+                C1[..., which_band] = C1_tmp
+            else:  # only where S2 needs it
+                C1_tmp = self._profile('C1', which_band, imNo,
+                                       self.get_C1_grid, S1_tmp, which_band)
+            del S1_tmp
+            if keep_S2:
+                S2_tmp = self._profile('S2', which_band, imNo, self.get_S2,
+                                       C1_tmp, which_band, grid=not keep_C1)
+                S2.append(S2_tmp)
+                C2_tmp[:, which_band] = self._profile('C2', which_band, imNo,
+                                            self.get_C2, S2_tmp, which_band)
+            else:
+                C2_tmp[:, which_band] = self._profile('S2+C2', which_band,
+                                    imNo, self.get_S2_C2, C1_tmp, which_band,
+                                    grid=not keep_C1)
+        C2 = np.max(C2_tmp, -1) # max over all scale bands
+        return C1, C2, S2
+
+    def _test_parallel(self, ims, todo, output, workers, op):
+        """
+        Computes C1 (if in `output`) and C2 for images listed in `todo` using
+        a pool of processes. Images and outputs are shared via memory-mapped
+        files.
+        """
+        tmpdir = tempfile.mkdtemp()
+        try:
+            paths = dict([(name, os.path.join(tmpdir, name + '.npy'))
+                          for name in ['ims'] + output.keys()])
+            np.save(paths['ims'], ims)
+            for name in output:
+                out = np.lib.format.open_memmap(paths[name], mode='w+',
+                                dtype=self.dtype, shape=output[name].shape)
+                del out  # flush to disk and close
+
+            pool = multiprocessing.Pool(workers, initializer=_hmax_init,
+                                        initargs=(self, paths))
+            try:
+                results = pool.imap_unordered(_hmax_worker, todo)
+                for count, (imNo, records) in enumerate(results):
+                    if self.profiler is not None:
+                        self.profiler.records.extend(records)
+                    sys.stdout.write("\r%s: %d%%" %(op, 100*count/len(todo)))
+                    sys.stdout.flush()
+                pool.close()
+            except:
+                pool.terminate()
+                raise
+            finally:
+                pool.join()
+
+            for name in output:
+                out = np.load(paths[name], mmap_mode='r')
+                output[name][todo] = out[todo]
+                del out
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    def _batch_outputs(self, ims):
+        return self.test(ims, op='batch')
+
     def get_gaussians(
         self,
         filter_sizes_all,
@@ -839,30 +2279,258 @@ class HMAX(Model):
         return matrix_new
 
 
-    def get_S1(self, im, whichBand):
+    def get_mask(self, filter_size):
+        """Returns a mask over which S1 responses are normalized"""
+        if self.mask_name == 'circle':
+            mask = self.get_circle(filter_size)
+        else:
+            mask = np.ones((filter_size,filter_size))
+        return mask
+
+    def get_S1_engine(self, whichBand, j, shape):
+        """
+        Decides how the j-th filter of a given band should be applied, as
+        defined by `S1_engine`.
+
+        In the 'auto' mode, the cost of a direct convolution is taken to be
+        proportional to filter_size**2 per pixel, a separable convolution
+        costs 2*filter_size per pixel and per separable component, while
+        FFT convolution costs about `fft_cost * log2(pixels)` per pixel of
+        the padded image.
+
+        **Returns**
+            One of 'direct', 'separable', and 'fft'
+        """
+        if self.S1_engine != 'auto':
+            return self.S1_engine
+        filter_size = self.filter_sizes_all[whichBand][j]
+        rank = sum([len(comps) for comps in self.get_separable(whichBand, j)])
+        fft_shape = self._fft_shape(shape)
+        npix = fft_shape[0] * fft_shape[1]
+        costs = [(shape[0] * shape[1] * filter_size**2 * self.n_ori, 'direct'),
+                 (shape[0] * shape[1] * 2 * filter_size * rank, 'separable'),
+                 (self.fft_cost * npix * np.log2(npix) * self.n_ori, 'fft')]
+        return min(costs)[1]
+
+    def get_separable(self, whichBand, j):
+        """
+        Returns (cached) separable components of the j-th filters of a band.
+
+        Each filter is decomposed with SVD into a sum of outer products of
+        column and row vectors. Only as many of them are kept as needed for
+        the norm of the residual to stay below `S1_sep_tol` times the norm
+        of the filter.
+
+        **Returns**
+            sep: list
+                Per orientation, a list of (column, row) vectors
+        """
+        key = (whichBand, j, self.S1_sep_tol)
+        if key not in self._filts_sep:
+            filts = self.filts[whichBand][j]
+            sep = []
+            for i in range(self.n_ori):
+                u, sv, vt = np.linalg.svd(filts[:,:,i])
+                # residual norms if only the first k components are kept
+                resid = np.sqrt(np.cumsum(sv[::-1]**2)[::-1])
+                rank = np.sum(resid > self.S1_sep_tol * resid[0])
+                sep.append([(u[:,k] * sv[k], vt[k]) for k in range(rank)])
+            self._filts_sep[key] = sep
+        return self._filts_sep[key]
+
+    def _separable_convolve(self, im, comps):
+        """
+        Convolves an image with a sum of separable filters; the result
+        matches `scipy.ndimage.convolve` with mode='constant'
+        """
+        resp = np.zeros(im.shape, dtype=im.dtype)
+        for col, row in comps:
+            tmp = scipy.ndimage.convolve1d(im, col, axis=0, mode='constant')
+            resp += scipy.ndimage.convolve1d(tmp, row, axis=1,
+                                             mode='constant')
+        return resp
+
+    def _fft_shape(self, shape):
+        """
+        Image shape padded for a linear (not circular) convolution with the
+        largest filter, rounded up to a size that FFT handles fast
+        """
+        max_size = max([max(fs) for fs in self.filter_sizes_all])
+        return tuple(_next_regular(n + max_size - 1) for n in shape[:2])
+
+    def get_S1_spectra(self, im):
+        """
+        Computes image spectra used by FFT convolution in S1.
+
+        These spectra can be reused across all scale bands.
+
+        **Returns**
+            spectra: dict
+                FFT shape, image shape, and spectrum of the image
+        """
+        fft_shape = self._fft_shape(im.shape)
+        return {'shape': fft_shape,
+                'im_shape': im.shape,
+                'im': np.fft.rfft2(im, fft_shape).astype(
+                                            self.get_complex_dtype())}
+
+    def _get_filts_freq(self, fft_shape, whichBand, j):
+        """Returns (cached) spectra of S1 filters"""
+        key = (fft_shape, whichBand, j, np.dtype(self.dtype).name)
+        if key not in self._filts_freq:
+            filts = np.fft.rfft2(self.filts[whichBand][j], fft_shape,
+                                 axes=(0,1))
+            self._filts_freq[key] = filts.astype(self.get_complex_dtype())
+        return self._filts_freq[key]
+
+    def get_S1_energy(self, im):
+        """
+        Computes cumulative sums of squared pixel values and of the number
+        of non-zero pixels, from which sums under a mask of any S1 filter
+        size are obtained (see :func:`get_mask_sum`).
+
+        For square masks, these are summed-area tables, so that a sum costs
+        four lookups per pixel. Otherwise, sums are cumulative along rows and
+        masks are decomposed into horizontal runs (see
+        :func:`get_mask_runs`). Tables are padded by the largest filter size
+        so that all lookups are slices. Sums are always in double precision
+        so that the S1 normalization is not dominated by round-off errors.
+
+        **Returns**
+            energy: dict
+                Image shape, padding, and cumulative sums of squared pixel
+                values ('energy') and of non-zero pixels ('count'; None if
+                there are no zero pixels)
+        """
+        im = np.asarray(im, dtype=float)
+        pad = max([max(fs) for fs in self.filter_sizes_all])
+        energy = {'shape': im.shape, 'pad': pad, 'count': None}
+        tables = [('energy', im**2)]
+        if not np.all(im):
+            tables.append(('count', (im != 0) * 1))
+        for name, values in tables:
+            if self.mask_name == 'circle':
+                table = np.zeros((im.shape[0], im.shape[1]+1),
+                                 dtype=values.dtype)
+                table[:,1:] = np.cumsum(values, 1)
+                # rows outside the image sum to zero
+                table = np.pad(table, ((pad, pad), (0, 0)), mode='constant')
+            else:
+                table = np.zeros((im.shape[0]+1, im.shape[1]+1),
+                                 dtype=values.dtype)
+                table[1:,1:] = np.cumsum(np.cumsum(values, 0), 1)
+                table = np.pad(table, ((pad, pad), (0, 0)), mode='edge')
+            # sums beyond image edges do not change
+            energy[name] = np.pad(table, ((0, 0), (pad, pad)), mode='edge')
+        return energy
+
+    def get_mask_runs(self, filter_size):
+        """
+        Returns (cached) horizontal runs of ones in a (flipped) mask.
+
+        **Returns**
+            runs: list
+                (row, first column, last column + 1) of each run
+        """
+        if filter_size not in self._mask_runs:
+            # masks are flipped in a convolution
+            mask = self.get_mask(filter_size)[::-1, ::-1]
+            runs = []
+            for row, values in enumerate(mask):
+                edges = np.diff(np.hstack([0, values != 0, 0]) * 1)
+                starts = np.nonzero(edges == 1)[0]
+                stops = np.nonzero(edges == -1)[0]
+                runs.extend([(row, start, stop) for start, stop in
+                             zip(starts, stops)])
+            self._mask_runs[filter_size] = runs
+        return self._mask_runs[filter_size]
+
+    def get_mask_sum(self, energy, name, filter_size):
+        """
+        Sums values under a mask of a given size centered at each pixel,
+        given their cumulative sums `energy[name]` (see
+        :func:`get_S1_energy`). The result matches `scipy.ndimage.convolve`
+        with mode='constant'.
+        """
+        table = energy[name]
+        height, width = energy['shape']
+        # offset of the first mask element in padded tables
+        start = energy['pad'] - (filter_size - 1) // 2
+        if self.mask_name != 'circle':  # use a summed-area table
+            stop = start + filter_size
+            return (table[stop:stop+height, stop:stop+width] -
+                    table[start:start+height, stop:stop+width] -
+                    table[stop:stop+height, start:start+width] +
+                    table[start:start+height, start:start+width])
+
+        out = np.zeros((height, width), dtype=table.dtype)
+        for row, first, last in self.get_mask_runs(filter_size):
+            rows = slice(start + row, start + row + height)
+            out += (table[rows, start+last:start+last+width] -
+                    table[rows, start+first:start+first+width])
+        return out
+
+    def _fft_convolve(self, im_freq, filt_freq, spectra, filter_size):
+        """
+        Inverse transforms a product of spectra and crops it so that the
+        result matches `scipy.ndimage.convolve` with mode='constant'
+        """
+        resp = np.fft.irfft2(im_freq * filt_freq, spectra['shape'])
+        offset = filter_size // 2
+        return resp[offset:offset + spectra['im_shape'][0],
+                    offset:offset + spectra['im_shape'][1]]
+
+    def get_S1(self, im, whichBand, spectra=None, energy=None):
         """
         This function returns S1 responses,
         using the difference of the Gaussians or Gabors as S1 filters.
         Filters are based on the original HMAX model.
+
+        Depending on `S1_engine`, convolutions are direct, separable or
+        done via FFT. For the latter, image spectra can be passed as
+        `spectra` (see :func:`get_S1_spectra`) to avoid recomputing them
+        for every band. Likewise, cumulative sums used for normalization
+        can be passed as `energy` (see :func:`get_S1_energy`).
         """
         filter_sizes = self.filter_sizes_all[whichBand]
         num_filter = len(filter_sizes)
         # make S1 same size as stimulus
-        S1 = np.zeros((im.shape[0], im.shape[1], num_filter, self.n_ori))
+        S1 = np.zeros((im.shape[0], im.shape[1], num_filter, self.n_ori),
+                      dtype=self.dtype)
+        if energy is None:
+            energy = self.get_S1_energy(im)
 
         for j in range(num_filter):
             S1_filter = self.filts[whichBand][j]
             fs = filter_sizes[j]
-            if self.mask_name == 'circle':
-                mask = self.get_circle(fs)
-            else:
-                mask = np.ones((fs,fs))
-            # import pdb; pdb.set_trace()
-            norm = scipy.ndimage.convolve(im**2, mask, mode='constant') + \
-                                          sys.float_info.epsilon
+            # local energy under the mask; round-off can make it negative
+            norm = np.maximum(self.get_mask_sum(energy, 'energy', fs), 0) + \
+                   sys.float_info.epsilon
+            engine = self.get_S1_engine(whichBand, j, im.shape)
+            empty = None
+            if engine != 'direct' and energy['count'] is not None:
+                # FFT round-off and separable approximations leave tiny
+                # values where the image is empty under the mask; direct
+                # convolution gives zero responses there
+                empty = self.get_mask_sum(energy, 'count', fs) == 0
+            if engine == 'fft':
+                if spectra is None:
+                    spectra = self.get_S1_spectra(im)
+                filt_freq = self._get_filts_freq(spectra['shape'],
+                                                 whichBand, j)
+            elif engine == 'separable':
+                sep = self.get_separable(whichBand, j)
             for i in range(self.n_ori):
-                S1_buf = scipy.ndimage.convolve(im, S1_filter[:,:,i],
-                                                mode='constant')
+                if engine == 'fft':
+                    S1_buf = self._fft_convolve(spectra['im'],
+                                                filt_freq[:,:,i], spectra, fs)
+                elif engine == 'separable':
+                    S1_buf = self._separable_convolve(im, sep[i])
+                else:
+                    S1_buf = scipy.ndimage.convolve(im, S1_filter[:,:,i],
+                                                    mode='constant')
+                if empty is not None:
+                    S1_buf[empty] = 0
                 S1[:,:,j,i] = np.abs(S1_buf) / np.sqrt(norm)
 
         return S1
@@ -886,7 +2554,158 @@ class HMAX(Model):
         return C1
 
 
-    def get_S2(self, C1, which_band, target=1., sigma=1.):
+    def get_S2_shift(self, which_band):
+        """Distance between neighboring S2 units in C1 (pixels)"""
+        # half overlaped S2 sampling
+        return int(np.ceil(self.C1_pooling_all[which_band]/2.))
+
+    def get_C1_grid(self, S1, which_band):
+        """
+        Computes C1 responses only at positions sampled by S2, that is,
+        `get_C1(S1, which_band)[::shift, ::shift]` where `shift` is given
+        by :func:`get_S2_shift`.
+
+        The max over scales is taken first, and then windows of
+        C1_pooling pixels are pooled at steps of `shift` pixels in each
+        direction (see :func:`_pool_grid`), so work and memory are about
+        shift**2 times smaller than for the full C1.
+        """
+        C1 = np.max(S1, 2)
+        size = self.C1_pooling_all[which_band]
+        shift = self.get_S2_shift(which_band)
+        for axis in range(2):
+            C1 = self._pool_grid(C1, axis, size, shift)
+        return C1
+
+    def _pool_grid(self, resp, axis, size, step):
+        """
+        Takes a max over windows of `size` values starting every `step`
+        values along an axis, with zeros beyond the end (responses must be
+        non-negative).
+
+        As `step <= size <= 2*step`, each window is made of a block of
+        `step` values and the beginning of the next block, so this takes
+        linear time.
+        """
+        resp = np.rollaxis(resp, axis)
+        n_out = -(-len(resp) // step)  # ceil
+        # one more block of zeros for the last window
+        blocks = np.zeros(((n_out + 1) * step,) + resp.shape[1:],
+                          dtype=resp.dtype)
+        blocks[:len(resp)] = resp
+        blocks = blocks.reshape((n_out + 1, step) + resp.shape[1:])
+        out = np.max(blocks[:-1], 1)
+        if size > step:
+            out = np.maximum(out, np.max(blocks[1:, :size-step], 1))
+        return np.rollaxis(out, 0, axis+1)
+
+    def _S2_afferents(self, C1, which_band, target=1., grid=False):
+        """
+        Collects C1 afferents of all S2 units.
+
+        If `grid` is *True*, C1 is only given at positions sampled by S2
+        (see :func:`get_C1_grid`).
+
+        **Returns**
+            aff: numpy.array
+                Squared distances of C1 afferents to `target`, of shape
+                (afferents per S2 unit, S2 positions, orientations)
+            grid_shape: tuple
+                Spatial shape of S2
+            seq: numpy.array
+                Orientation combinations (see :func:`get_S2_seq`)
+        """
+        if not grid:
+            S2_shift = self.get_S2_shift(which_band)
+            C1 = C1[::S2_shift, ::S2_shift]
+        # C1 afferents are adjacent for each S2, i.e., two S2 shifts apart
+        n_rows = C1.shape[0] - 2 * (self.S2_config[1] - 1)
+        n_cols = C1.shape[1] - 2 * (self.S2_config[0] - 1)
+
+        seq = self.get_S2_seq()
+
+        aff = []
+        for c in range(self.S2_config[0]*self.S2_config[1]):
+            c1 = c % self.S2_config[0]
+            c2 = c // self.S2_config[0]
+            # the window is sliding in the x-dir
+            aff.append((C1[2*c2:2*c2+n_rows, 2*c1:2*c1+n_cols] - target)**2)
+        grid_shape = aff[0].shape[:2]
+        aff = np.array(aff).reshape((len(aff), -1, C1.shape[-1]))
+        return aff, grid_shape, seq
+
+    def get_S2_seq(self):
+        """
+        Returns (cached) orientation combinations of C1 afferents that S2
+        units are tuned to, as defined by `S2_dict`.
+
+        A list (or an array) in `S2_dict` is recognized by its identity, so
+        assign a new one to change it rather than modifying it in place.
+
+        **Returns**
+            seq: numpy.array
+                Orientations of each C1 afferent (columns) per combination
+                (rows), in the order of the original model (i.e., the first
+                afferent changes the fastest)
+        """
+        n_aff = self.S2_config[0] * self.S2_config[1]
+        S2_dict = self.S2_dict
+        # comparing lists would take longer than the lookup is worth; the
+        # list is stored along with the sequence, so its id is not reused
+        dict_key = S2_dict if isinstance(S2_dict, (int, long, type(None))) \
+                   else id(S2_dict)
+        key = (tuple(self.S2_config), self.n_ori, dict_key, self.S2_seed)
+        if key in self._S2_seqs:
+            return self._S2_seqs[key][1]
+
+        if isinstance(S2_dict, int) and S2_dict >= self.n_ori**n_aff:
+            S2_dict = None  # that is, all of them
+        if S2_dict is None:
+            # produce a sequence of all possible orientation combinations
+            seq = itertools.product(range(self.n_ori), repeat=n_aff)
+            # we have to keep the same order as in the original model
+            seq = np.fliplr([s for s in seq])
+        elif isinstance(S2_dict, int):
+            rng = np.random.RandomState(self.S2_seed)
+            combs = set()
+            while len(combs) < S2_dict:
+                new = rng.randint(self.n_ori, size=(S2_dict-len(combs), n_aff))
+                combs.update([tuple(c) for c in new])
+            seq = np.array(sorted(combs, key=lambda c: c[::-1]))
+        else:
+            seq = np.array(S2_dict, dtype=int)
+            if seq.ndim != 2 or seq.shape[1] != n_aff:
+                raise ValueError('S2_dict must have %d columns' % n_aff)
+            if np.any(seq < 0) or np.any(seq >= self.n_ori):
+                raise ValueError('S2_dict must contain orientations from 0 '
+                                 'to %d' % (self.n_ori - 1))
+        self._S2_seqs[key] = (self.S2_dict, seq)
+        return seq
+
+    def _S2_blocks(self, aff, seq):
+        """
+        Yields squared distances between S2 afferents and the target
+        blockwise, so that at most `S2_block_size` values are held at once.
+
+        **Yields**
+            (pos, comb, dist), where `pos` and `comb` are slices of S2
+            positions and orientation combinations, and `dist` is a 2D array
+            of distances for them
+        """
+        n_pos = aff.shape[1]
+        comb_step = max(1, min(len(seq), self.S2_block_size))
+        pos_step = max(1, self.S2_block_size // comb_step)
+        for comb_start in range(0, len(seq), comb_step):
+            comb = slice(comb_start, comb_start + comb_step)
+            seq_block = seq[comb]
+            for pos_start in range(0, n_pos, pos_step):
+                pos = slice(pos_start, pos_start + pos_step)
+                dist = aff[0, pos][:, seq_block[:,0]]
+                for c in range(1, aff.shape[0]):
+                    dist += aff[c, pos][:, seq_block[:,c]]
+                yield pos, comb, dist
+
+    def get_S2(self, C1, which_band, target=1., sigma=1., grid=False):
         """
         Calculates S2 responses given C1.
 
@@ -894,69 +2713,68 @@ class HMAX(Model):
         filters.
         Then computes a distance to /target/ using /sigma/ as its tuning
         sharpness.
+
+        S2 is computed blockwise (see `S2_block_size`) but the full output
+        is returned. If you only need C2, use :func:`get_S2_C2` which never
+        holds the full S2. If `grid` is *True*, C1 is only given at positions
+        sampled by S2 (see :func:`get_C1_grid`).
         """
-        # half overlaped S2 sampling
-        S2_shift = int(np.ceil(self.C1_pooling_all[which_band]/2.))
-        # C1 afferents are adjacent for each S2
-        C1_shift = S2_shift * 2 # distance/shift between C1 afferents
-        S2_buf = [C1.shape[0] - C1_shift*(self.S2_config[0]-1),
-            C1.shape[1] - C1_shift*(self.S2_config[1]-1)]
-
-        # produce a sequence of all possible orientation combinations
-        seq = itertools.product(range(self.n_ori),
-            repeat = self.S2_config[0]*self.S2_config[1])
-        # we have to keep the same order as in the original model
-        seq = np.fliplr([s for s in seq])
-
-        S2_permute = np.zeros((
-            (S2_buf[0]-1)/S2_shift+1,
-            (S2_buf[1]-1)/S2_shift+1,
-            len(seq),
-            self.S2_config[0]*self.S2_config[1]))
-
-        for c1 in range(self.S2_config[0]):
-            for c2 in range(self.S2_config[1]):
-                c = self.S2_config[0]*c2 + c1
-                r1 = np.arange(C1_shift*c1, S2_buf[0] + C1_shift*c1, S2_shift)
-                r2 = np.arange(C1_shift*c2, S2_buf[1] + C1_shift*c2, S2_shift)
-                ii,jj = np.meshgrid(r1, r2)
-                S2_permute[:,:,:,c] = np.take(C1[jj,ii], seq[:,c], axis=2)
-                # for si, s in enumerate(seq):
-                #     S2_permute[:,:,si,c] = C1[jj,ii,s[c]] # the window is
-                                                         # sliding in the x-dir
-        S2 = np.sum((S2_permute-target)**2,3)
-        S2 = np.exp(-S2/(2.*sigma**2))
-
-        return S2
+        aff, grid_shape, seq = self._S2_afferents(C1, which_band,
+                                                  target=target, grid=grid)
+        S2 = np.zeros((aff.shape[1], len(seq)), dtype=aff.dtype)
+        for pos, comb, dist in self._S2_blocks(aff, seq):
+            S2[pos, comb] = np.exp(-dist/(2.*sigma**2))
+
+        return S2.reshape(grid_shape + (len(seq),))
+
+    def get_S2_C2(self, C1, which_band, target=1., sigma=1., grid=False):
+        """
+        Calculates C2 responses directly from C1.
+
+        S2 responses are computed blockwise and only their spatial maximum is
+        kept, thus peak memory is bounded by `S2_block_size`. Since the S2
+        tuning function decreases monotonically with the distance to target,
+        the maximum is taken over distances and exponentiated only once.
+        As in :func:`get_S2`, C1 can be given at S2 positions only.
+        """
+        aff, grid_shape, seq = self._S2_afferents(C1, which_band,
+                                                  target=target, grid=grid)
+        min_dist = np.empty(len(seq), dtype=aff.dtype)
+        min_dist.fill(np.inf)
+        for pos, comb, dist in self._S2_blocks(aff, seq):
+            min_dist[comb] = np.minimum(min_dist[comb], np.min(dist, 0))
+        return np.exp(-min_dist/(2.*sigma**2))
 
     def get_C2(self, S2, which_band):
         """C2 is a max over space per an S2 filter quadruplet"""
         return  np.max(np.max(S2,0),0)
 
-    def get_VTU(self, C2resp, tuningWidth = .1):
+    def get_VTU(self, C2resp, tuningWidth = .1, top_k=None, chunk_size=None):
         """
         Calculate response of view-tuned units
 
+        Responses are a Gaussian function of squared distances between C2
+        responses and prototypes, computed from dot products for chunks of
+        stimuli at once.
+
         **Parameters**
             c2RespSpec: numpy.array
                 C2 responses to the stimuli
             tuningWidth: float
                 How sharply VTUs should be tuned; lower values are shaper
                 tuning (default: .1)
+            top_k: int
+                If given, only responses of VTUs tuned to the `top_k`
+                nearest prototypes are kept for each stimulus, and a sparse
+                matrix is returned (default: None)
+            chunk_size: int
+                How many stimuli to process at once (by default, chunks
+                hold up to 2**24 distances)
         **Returns**
-            output: np.array
+            output: np.array or scipy.sparse.csr_matrix
                 An array where each column represents view-tuned units
                 responses to a particular image (stimulus)
         """
-        def sq(c):
-            return np.dot(c,c)
-        def func(row):
-            # difference between tuning and each C2 response
-            diff = self.tuning - \
-                    np.tile(row,(self.tuning.shape[0],1))
-            # this difference is then square-summed and then exponentiated :)
-            return np.exp(-.5 * np.apply_along_axis(sq,1,diff) / tuningWidth)
-
         if not self.istrained:
             raise Exception("You must first train VTUs by providing prototype "
                             "images to them using the train() function")
@@ -964,8 +2782,33 @@ class HMAX(Model):
         if C2resp.shape[1] != self.tuning.shape[1]:
             raise Exception("The size of exemplar matrix does not match "
                             "that of the prototype matrix")
-        # apply func on each row
-        return np.apply_along_axis(func, 1, C2resp)
+        n_proto = len(self.tuning)
+        if chunk_size is None:
+            chunk_size = max(1, 2**24 // n_proto)
+        if top_k is None:
+            # squared distance between each C2 response and each prototype
+            # is exponentiated :)
+            dist = self.dissimilarity(C2resp, kind='sqeuclidean',
+                                      other=self.tuning, tile_size=chunk_size)
+            return np.exp(-.5 * dist / tuningWidth)
+
+        top_k = min(top_k, n_proto)
+        cols = []
+        resp = []
+        for start in range(0, len(C2resp), chunk_size):
+            dist = self.dissimilarity(C2resp[start:start+chunk_size],
+                                      kind='sqeuclidean', other=self.tuning,
+                                      tile_size=chunk_size)
+            # prototypes nearest to each stimulus (in no particular order)
+            nearest = np.argpartition(dist, top_k-1, axis=1)[:, :top_k]
+            dist = dist[np.arange(len(dist))[:, np.newaxis], nearest]
+            cols.append(nearest.ravel())
+            resp.append(np.exp(-.5 * dist.ravel() / tuningWidth))
+        indptr = np.arange(0, len(C2resp)*top_k + 1, top_k)
+        VTU = scipy.sparse.csr_matrix((np.hstack(resp), np.hstack(cols),
+                                       indptr), shape=(len(C2resp), n_proto))
+        VTU.sort_indices()
+        return VTU
 
     def compare(self, ims):
         print ims
@@ -976,6 +2819,8 @@ class HMAX(Model):
         print 'Dissimilarity across stimuli'
         print '0: similar, 1: dissimilar'
         print dis
+        if self.cache is not None:
+            print 'Feature cache: ' + self.cache.summary()
 
         ax = plt.subplot(111)
         matrix = ax.imshow(dis, interpolation='none')
@@ -987,6 +2832,193 @@ class HMAX(Model):
         plt.show()
 
 
+# state of a process in a pool used by HMAX.test
+_hmax_state = {}
+
+def _hmax_init(model, paths):
+    """Receives a model and opens shared arrays once per process"""
+    _hmax_state['model'] = model
+    if model.profiler is not None:  # records are sent back per image
+        model.profiler = Profiler()
+    _hmax_state['ims'] = np.load(paths['ims'], mmap_mode='r')
+    _hmax_state['outputs'] = dict([(name, np.load(path, mmap_mode='r+'))
+                                   for name, path in paths.items()
+                                   if name != 'ims'])
+
+def _hmax_worker(imNo):
+    """Computes C1 and C2 of a single image and writes them to shared arrays"""
+    model = _hmax_state['model']
+    im = np.array(_hmax_state['ims'][imNo])
+    outputs = _hmax_state['outputs']
+    C1, C2, S2 = model.test_image(im, imNo=imNo, keep_C1='C1' in outputs)
+    for name, out in [('C1', C1), ('C2', C2)]:
+        if name in outputs:
+            outputs[name][imNo] = out
+            outputs[name].flush()
+    records = []
+    if model.profiler is not None:
+        records = model.profiler.records
+        model.profiler.records = []
+    return imNo, records
+
+
+def _read_ahead(iterable, size):
+    """
+    Consumes an iterable in a background thread, keeping up to `size`
+    items in a queue. Returns a generator over the items.
+    """
+    items = Queue.Queue(maxsize=max(1, size))
+    stop = threading.Event()
+    end = object()
+
+    def put(item, exc_info=None):
+        """Waits for free space in the queue unless reading was stopped"""
+        while not stop.is_set():
+            try:
+                items.put((item, exc_info), timeout=.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def worker():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+            put(end)
+        except Exception:
+            put(end, sys.exc_info())
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+
+    def reader():
+        try:
+            while True:
+                item, exc_info = items.get()
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                if item is end:
+                    break
+                yield item
+        finally:
+            stop.set()
+
+    return reader()
+
+
+class _BatchWriter(object):
+    """
+    Appends batches of outputs to an HDF5 file or to a folder of `.npy`
+    files (one per output and batch).
+
+    Like the HDF5 file, which is overwritten, batches left in the folder
+    by a previous run are removed, so that :func:`load_batches` does not
+    mix them with new ones.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.nbatches = 0
+        if path.endswith('.h5') or path.endswith('.hdf5'):
+            import h5py
+            self.h5 = h5py.File(path, 'w')
+        else:
+            self.h5 = None
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            for fname in _batch_files(path):
+                os.remove(fname)
+
+    def append(self, outputs):
+        for name, values in outputs.items():
+            values = np.asarray(values)
+            if self.h5 is None:
+                fname = os.path.join(self.path,
+                                     '%s_%05d.npy' % (name, self.nbatches))
+                np.save(fname, values)
+            elif name not in self.h5:
+                self.h5.create_dataset(name, data=values,
+                                       maxshape=(None,) + values.shape[1:],
+                                       chunks=True)
+            else:
+                dataset = self.h5[name]
+                nrows = dataset.shape[0]
+                dataset.resize(nrows + len(values), axis=0)
+                dataset[nrows:] = values
+        self.nbatches += 1
+
+    def close(self):
+        if self.h5 is not None:
+            self.h5.close()
+
+
+def load_batches(path, name, mmap_mode=None):
+    """
+    Loads and concatenates outputs saved by :func:`Model.run_batches`
+    in a folder.
+
+    :Args:
+        - path (str)
+            Folder with outputs
+        - name (str)
+            Output name, e.g., 'C2'
+
+    :Kwargs:
+        mmap_mode (str, default: None)
+            Passed to `np.load`; use 'r' to memory-map each batch (note
+            that concatenating them still makes a copy)
+    """
+    fnames = _batch_files(path, name)
+    return np.concatenate([np.load(f, mmap_mode=mmap_mode) for f in fnames])
+
+
+def _batch_files(path, name=None):
+    """
+    Returns batch files of an output `name` (or of all outputs if None)
+    in a folder, in the order of their batch numbers.
+    """
+    batches = []
+    for fname in os.listdir(path):
+        match = re.match(r'^(.+)_(\d{5,})\.npy$', fname)
+        if match is not None and name in (None, match.group(1)):
+            batches.append((match.group(1), int(match.group(2)),
+                            os.path.join(path, fname)))
+    return [fname for _, _, fname in sorted(batches)]
+
+
+def _peak_memory():
+    """Returns peak resident memory of this process in bytes (or None)"""
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, Mac OS bytes
+    return maxrss if sys.platform == 'darwin' else maxrss * 1024
+
+
+def _next_regular(target):
+    """
+    Returns the smallest 5-smooth number (i.e., of the form 2**a * 3**b *
+    5**c) that is not smaller than target. FFT is fastest for such sizes.
+    """
+    if target <= 6:
+        return target
+    match = float('inf')
+    p5 = 1
+    while p5 < target:
+        p35 = p5
+        while p35 < target:
+            # ceiling of target / p35 rounded up to a power of two
+            quotient = -(-target // p35)
+            p2 = 2**int(np.ceil(np.log2(quotient)))
+            match = min(match, p2 * p35)
+            p35 *= 3
+        match = min(match, p35)
+        p5 *= 5
+    return int(min(match, p5))
+
+
 if __name__ == '__main__':
     models = {'px': Pixelwise, 'gaborjet': GaborJet, 'hmax': HMAX}
 
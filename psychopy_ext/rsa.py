@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+# Part of the psychopy_ext library
+# Copyright 2010-2013 Jonas Kubilius
+# The program is distributed under the terms of the GNU General Public License,
+# either version 3 of the License, or (at your option) any later version.
+
+"""
+Representational similarity analysis (RSA): comparing representational
+dissimilarity matrices (RDMs) of fMRI data and models of vision.
+
+RDMs of fMRI data come from :func:`fmri.Analysis.correlation` or
+:func:`fmri.Analysis.svm` (see :func:`df2rdms`), and model RDMs from
+:func:`models.Model.dissimilarity`::
+
+    rdms, subjIDs, rois, conds = rsa.df2rdms(df)
+    hmax = models.HMAX()
+    px = models.Pixelwise()
+    model_rdms = OrderedDict([
+        ('HMAX', hmax.dissimilarity(hmax.run(ims)['C2'])),
+        ('pixelwise', px.dissimilarity(px.run(ims)))])
+    res = rsa.compare_rdms(rdms, model_rdms, n_perm=5000, workers=4)
+"""
+
+import multiprocessing
+
+import numpy as np
+import scipy.stats
+import pandas
+
+
+def condense(rdms):
+    """
+    Returns the upper triangles (without the diagonal) of RDMs.
+
+    :Args:
+        rdms (numpy.array)
+            RDMs in the last two dimensions, e.g., (subjects, ROIs, n, n)
+
+    :Returns:
+        An array of shape (..., n*(n-1)/2)
+    """
+    rdms = np.asarray(rdms)
+    n = rdms.shape[-1]
+    if rdms.ndim < 2 or rdms.shape[-2] != n:
+        raise ValueError('RDMs must be square in the last two dimensions')
+    rows, cols = np.triu_indices(n, k=1)
+    return rdms[..., rows, cols]
+
+
+def df2rdms(df, values='subjResp'):
+    """
+    Converts pairwise fMRI results to a stack of RDMs.
+
+    Results of :func:`fmri.Analysis.correlation` and
+    :func:`fmri.Analysis.svm` (as returned by
+    :func:`fmri.Analysis.run_method`) are averaged across iterations, and
+    the two halves of each RDM are averaged to make it symmetric.
+
+    :Args:
+        df (pandas.DataFrame)
+            Results with 'subjID', 'ROI', 'stim1.cond' and 'stim2.cond'
+            columns
+
+    :Kwargs:
+        values (str, default: 'subjResp')
+            Column with dissimilarities
+
+    :Returns:
+        A (subjects, ROIs, conditions, conditions) array of RDMs, and lists
+        of participants, ROIs and conditions
+    """
+    subjIDs = sorted(pandas.unique(df['subjID']))
+    rois = list(pandas.unique(df['ROI']))
+    conds = sorted(set(df['stim1.cond']) | set(df['stim2.cond']))
+    resp = df[values].astype(float)  # svm has None on the diagonal
+    agg = resp.groupby([df['subjID'], df['ROI'], df['stim1.cond'],
+                        df['stim2.cond']]).mean()
+
+    rdms = np.zeros((len(subjIDs), len(rois), len(conds), len(conds)))
+    count = np.zeros(rdms.shape)
+    subj_ind = dict([(s,i) for i,s in enumerate(subjIDs)])
+    roi_ind = dict([(r,i) for i,r in enumerate(rois)])
+    cond_ind = dict([(c,i) for i,c in enumerate(conds)])
+    for (subjID, roi, cond1, cond2), value in zip(agg.index, agg.values):
+        if np.isnan(value):
+            continue
+        for i, j in [(cond1, cond2), (cond2, cond1)]:
+            ind = (subj_ind[subjID], roi_ind[roi], cond_ind[i], cond_ind[j])
+            rdms[ind] += value
+            count[ind] += 1
+    rdms /= np.maximum(count, 1)
+    rows, cols = np.diag_indices(len(conds))
+    rdms[..., rows, cols] = 0
+    return rdms, subjIDs, rois, conds
+
+
+def get_permutations(n, n_perm=1000, seed=0):
+    """
+    Returns indices that reorder condensed RDMs as if condition labels
+    were permuted.
+
+    :Args:
+        n (int)
+            Number of conditions
+
+    :Kwargs:
+        - n_perm (int, default: 1000)
+            Number of random permutations
+        - seed (int, default: 0)
+            Seed for the random number generator
+
+    :Returns:
+        An (n_perm, n*(n-1)/2) array of indices
+    """
+    rng = np.random.RandomState(seed)
+    perms = np.array([rng.permutation(n) for p in range(n_perm)],
+                     dtype=int).reshape((n_perm, n))
+    rows, cols = np.triu_indices(n, k=1)
+    # condensed index of each cell of a full matrix
+    index = np.zeros((n, n), dtype=int)
+    index[rows, cols] = np.arange(len(rows))
+    index[cols, rows] = np.arange(len(rows))
+    return index[perms[:, rows], perms[:, cols]]
+
+
+def _standardize(vectors, kind):
+    """Ranks (if needed) and scales vectors so that np.dot gives correlations"""
+    vectors = np.asarray(vectors, dtype=float)
+    if kind == 'spearman':
+        vectors = np.apply_along_axis(scipy.stats.rankdata, -1, vectors)
+    elif kind != 'pearson':
+        raise ValueError('Correlation of %s not recognized' % kind)
+    vectors = vectors - np.mean(vectors, axis=-1)[..., np.newaxis]
+    norm = np.sqrt(np.sum(vectors * vectors, axis=-1))[..., np.newaxis]
+    return vectors / np.where(norm > 0, norm, 1)
+
+
+def _compare(data, models, perms, chunk_size):
+    """
+    Correlates RDMs of all participants and ROIs with model RDMs and with
+    their permuted versions.
+
+    :Args:
+        - data: (subjects, ROIs, pairs) standardized data RDMs
+        - models: (models, pairs) standardized model RDMs
+        - perms: (n_perm, pairs) permutation indices
+
+    :Returns:
+        Correlations (subjects, ROIs, models), null distribution of the mean
+        correlation across participants (n_perm, ROIs, models) and how many
+        times permuted correlations reached the observed ones (subjects,
+        ROIs, models)
+    """
+    nsubj, nroi, npairs = data.shape
+    rows = data.reshape((-1, npairs))
+    corr = np.dot(rows, models.T).reshape((nsubj, nroi, len(models)))
+    null = np.zeros((len(perms), nroi, len(models)))
+    exceed = np.zeros(corr.shape, dtype=int)
+    for start in range(0, len(perms), chunk_size):
+        chunk = perms[start:start+chunk_size]
+        # permuting a model is equivalent to permuting the data and has to
+        # be done only once for all participants and ROIs
+        permuted = models[:, chunk].reshape((-1, npairs))
+        null_corr = np.dot(rows, permuted.T)
+        null_corr = null_corr.reshape((nsubj, nroi, len(models), len(chunk)))
+        null[start:start+len(chunk)] = np.mean(null_corr, axis=0).transpose(
+                                                                    (2,0,1))
+        exceed += np.sum(null_corr >= corr[..., np.newaxis] - 1e-12, axis=-1)
+    return corr, null, exceed
+
+
+_rsa_state = {}
+
+def _rsa_init(data, models, perms, chunk_size):
+    """Receives the inputs once per process"""
+    _rsa_state.update({'data': data, 'models': models, 'perms': perms,
+                       'chunk_size': chunk_size})
+
+def _rsa_worker(rois):
+    """Compares RDMs of a group of ROIs"""
+    st = _rsa_state
+    return rois, _compare(st['data'][:, rois], st['models'], st['perms'],
+                          st['chunk_size'])
+
+
+def compare_rdms(data_rdms, model_rdms, kind='spearman', n_perm=1000,
+                 seed=0, workers=1, chunk_size=None):
+    """
+    Correlates fMRI RDMs with model RDMs and tests significance with a
+    condition-label permutation test.
+
+    For each ROI, a null distribution is formed by randomly permuting
+    condition labels of model RDMs, which is equivalent to permuting labels
+    of the data but has to be done only once for all participants. The
+    same permutations are used for all participants, ROIs and models, and
+    all permutations are evaluated with matrix products.
+
+    Correlations with the permuted RDMs are computed for chunks of
+    permutations at a time, so that memory use does not grow with
+    `n_perm`. Groups of ROIs can be processed in parallel; results do not
+    depend on the number of workers.
+
+    :Args:
+        - data_rdms (numpy.array)
+            RDMs of shape (subjects, ROIs, n, n), or their upper triangles
+            (see :func:`condense`) of shape (subjects, ROIs, n*(n-1)/2)
+        - model_rdms (numpy.array or dict)
+            RDMs of shape (models, n, n) or a dict of {name: RDM} (use an
+            OrderedDict to keep the order of models)
+
+    :Kwargs:
+        - kind ({'spearman', 'pearson'}, default: 'spearman')
+            Correlation between RDMs
+        - n_perm (int, default: 1000)
+            Number of permutations (0 skips the test)
+        - seed (int, default: 0)
+            Seed for permutations
+        - workers (int, default: 1)
+            Number of processes for processing ROIs in parallel
+        - chunk_size (int, default: None)
+            Number of permutations evaluated at once. By default, chunks
+            take about 128 MB.
+
+    :Returns:
+        A dict with:
+            - corr: (subjects, ROIs, models) correlations
+            - p: (ROIs, models) one-tailed p-values of the mean correlation
+              across participants
+            - p_subj: (subjects, ROIs, models) one-tailed p-values per
+              participant
+            - null: (n_perm, ROIs, models) null distribution of the mean
+              correlation across participants
+            - models: model names (or indices)
+        P-values are computed as (1 + number of permuted correlations at
+        least as large as the observed one) / (1 + n_perm).
+    """
+    if isinstance(model_rdms, dict):
+        names = list(model_rdms.keys())
+        model_rdms = [model_rdms[name] for name in names]
+    else:
+        names = range(len(model_rdms))
+    model_rdms = np.asarray(model_rdms, dtype=float)
+    ncond = model_rdms.shape[-1]
+    models = _standardize(condense(model_rdms), kind)
+
+    data_rdms = np.asarray(data_rdms, dtype=float)
+    if data_rdms.ndim == 4:
+        data_rdms = condense(data_rdms)
+    if data_rdms.ndim != 3 or data_rdms.shape[-1] != models.shape[-1]:
+        raise ValueError('Expected data RDMs of shape (subjects, ROIs, %d, '
+                         '%d)' % (ncond, ncond))
+    data = _standardize(data_rdms, kind)
+
+    perms = get_permutations(ncond, n_perm=n_perm, seed=seed)
+    if chunk_size is None:
+        chunk_size = 2**24 // (len(models) * models.shape[1])
+    chunk_size = max(1, chunk_size)
+
+    nsubj, nroi = data.shape[:2]
+    if workers > 1 and nroi > 1:
+        # each process gets a group of ROIs, so that permuted models are
+        # shared within a group
+        groups = np.array_split(np.arange(nroi), min(workers, nroi))
+        pool = multiprocessing.Pool(len(groups), initializer=_rsa_init,
+                                    initargs=(data, models, perms, chunk_size))
+        try:
+            res = pool.map(_rsa_worker, groups)
+        finally:
+            pool.close()
+            pool.join()
+        corr = np.zeros((nsubj, nroi, len(models)))
+        null = np.zeros((n_perm, nroi, len(models)))
+        exceed = np.zeros(corr.shape, dtype=int)
+        for rois, (c, nl, ex) in res:
+            corr[:, rois] = c
+            null[:, rois] = nl
+            exceed[:, rois] = ex
+    else:
+        corr, null, exceed = _compare(data, models, perms, chunk_size)
+
+    mean_corr = np.mean(corr, axis=0)
+    p = (1 + np.sum(null >= mean_corr - 1e-12, axis=0)) / (1. + n_perm)
+    p_subj = (1 + exceed) / (1. + n_perm)
+    return {'corr': corr, 'p': p, 'p_subj': p_subj, 'null': null,
+            'models': names}
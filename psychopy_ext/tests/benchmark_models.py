@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+
+# Part of the psychopy_ext library
+# Copyright 2010-2013 Jonas Kubilius
+# The program is distributed under the terms of the GNU General Public License,
+# either version 3 of the License, or (at your option) any later version.
+
+"""
+Benchmarks of the models of vision.
+
+Each model is run on synthetic images of several sizes and batch sizes.
+Throughput (images per second) and peak memory (the increase of resident
+memory while running a configuration) are appended to a JSON history file
+and compared against a stored baseline. Before benchmarking, MatLab-parity
+tests from `test_models` are run as correctness guards.
+
+Run it from the folder above `psychopy_ext`::
+
+    python -m psychopy_ext.tests.benchmark_models --sizes 128 256 --batches 1 16
+
+Use `--save-baseline` to store the current results as a new baseline. The
+full matrix (all models, 128/256/512 px, batches of 1/16/256) takes a long
+time, mostly due to HMAX on large images.
+
+With `--dtype float32`, models compute in single precision and the
+accuracy loss is reported per model, with respect to the MatLab outputs
+for the test image where they exist (`*.txt` files next to this script)
+and to float64 outputs otherwise.
+"""
+
+import sys, os, time, json, platform, argparse
+import multiprocessing
+import Queue
+import unittest
+
+import numpy as np
+import matplotlib
+matplotlib.use('Agg')  # some models call plt.show()
+
+from .. import models
+from . import test_models
+
+
+MODELS = {
+    'pixelwise': (models.Pixelwise, {}),
+    'gaborjet': (models.GaborJet, {}),
+    'hmax-gaussian': (models.HMAX, {}),
+    'hmax-matlab': (models.HMAX, {'matlab': True}),
+    'hmax-gabor': (models.HMAX, {'filt_type': 'gabor'}),
+    'zoccolan': (models.Zoccolan, {}),
+    }
+SIZES = [128, 256, 512]
+BATCHES = [1, 16, 256]
+# MatLab-parity tests
+GUARDS = ['TestHMAX.test_gaussian', 'TestHMAX.test_gabor',
+          'TestHMAX.test_float32_matlab',
+          'TestGaborJets.test_mag', 'TestGaborJets.test_phase',
+          'TestGaborJetPrecision.test_float32_matlab']
+# outputs of the MatLab implementations for the test image
+MATLAB_REFS = {
+    'hmax-matlab': {'C2': 'lena_gaussian_matlab.txt'},
+    'hmax-gabor': {'C2': 'lena_gabor_matlab.txt'},
+    'gaborjet': {'magnitude': 'jet_mag.txt'},
+    }
+
+
+def synthetic_images(nims, size, seed=0):
+    """Generates reproducible random images with values from 0 to 255"""
+    rng = np.random.RandomState(seed)
+    return 255 * rng.rand(nims, size, size)
+
+
+def peak_memory():
+    """Returns peak resident memory of this process in bytes (or None)"""
+    return models._peak_memory()
+
+
+def _run_config(queue, model_name, size, batch_size, repeats, dtype):
+    """
+    Runs a single configuration (in a separate process).
+
+    The process is forked, so its resident memory starts with pages
+    shared with the parent; peak memory is reported as the increase over
+    that starting level.
+    """
+    try:
+        start_memory = peak_memory()
+        sys.stdout = open(os.devnull, 'w')  # models report progress
+        model_class, kwargs = MODELS[model_name]
+        m = model_class(**kwargs)
+        m.dtype = dtype
+        ims = synthetic_images(batch_size, size).astype(dtype)
+        durs = []
+        for rep in range(repeats):
+            start = time.time()
+            m._batch_outputs(ims)
+            durs.append(time.time() - start)
+        mem = peak_memory()
+        if mem is not None:
+            mem -= start_memory
+        queue.put({'status': 'ok',
+                   'throughput': batch_size / min(durs),
+                   'peak_memory': mem})
+    except BaseException as e:
+        queue.put({'status': 'error', 'error': '%s: %s' %
+                   (e.__class__.__name__, e)})
+
+
+def run_config(model_name, size, batch_size, repeats=1, dtype='float64'):
+    """
+    Runs a configuration in a fresh process so that peak memory is not
+    affected by other configurations. If the process dies without a result
+    (e.g., killed when running out of memory), the configuration is
+    reported as an error.
+    """
+    res_queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(target=_run_config, args=(res_queue,
+                    model_name, size, batch_size, repeats, dtype))
+    proc.start()
+    while True:
+        try:
+            res = res_queue.get(timeout=1)
+            break
+        except Queue.Empty:
+            if not proc.is_alive() and res_queue.empty():
+                res = {'status': 'error', 'error': 'process exited with '
+                       'code %s without a result' % proc.exitcode}
+                break
+    proc.join()
+    res.update({'model': model_name, 'size': size, 'batch_size': batch_size,
+                'dtype': dtype})
+    return res
+
+
+def matlab_reference(model_name):
+    """Returns MatLab outputs for the test image as a dict (or None)"""
+    if model_name not in MATLAB_REFS:
+        return None
+    path = os.path.dirname(os.path.abspath(__file__))
+    return dict([(name, np.genfromtxt(os.path.join(path, fname),
+                                      delimiter=','))
+                 for name, fname in MATLAB_REFS[model_name].items()])
+
+
+def precision(model_name, size, dtype):
+    """
+    Returns (maximal absolute, maximal relative) differences between
+    outputs computed with `dtype` and MatLab outputs for the test image or,
+    for models without them, float64 outputs for a synthetic image, per
+    output
+    """
+    model_class, kwargs = MODELS[model_name]
+    ref = matlab_reference(model_name)
+    ims = None if ref is not None else synthetic_images(1, size)
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        delta = model_class(**kwargs).precision_delta(ims, dtype=dtype,
+                                                      ref=ref)
+    except (Exception, SystemExit) as e:  # some models exit on bad sizes
+        return {'error': '%s: %s' % (e.__class__.__name__, e)}
+    finally:
+        sys.stdout = stdout
+    return dict([(name, [float(d) for d in dlt])
+                 for name, dlt in delta.items()])
+
+
+def run_guards():
+    """Runs MatLab-parity tests; returns True if all of them passed"""
+    suite = unittest.TestSuite()
+    loader = unittest.TestLoader()
+    for guard in GUARDS:
+        suite.addTests(loader.loadTestsFromName(guard, test_models))
+    result = unittest.TextTestRunner(verbosity=1).run(suite)
+    return result.wasSuccessful()
+
+
+def find_regressions(results, baseline, tolerance=.2):
+    """
+    Compares results against a baseline.
+
+    A regression is a throughput lower than `1-tolerance` times the
+    baseline or peak memory higher than `1+tolerance` times the baseline.
+
+    :Returns:
+        A list of messages, one per regression
+    """
+    def get_key(res):
+        return (res['model'], res['size'], res['batch_size'],
+                res.get('dtype', 'float64'))
+    base = dict([(get_key(r), r) for r in baseline['results']
+                 if r['status'] == 'ok'])
+    msgs = []
+    for res in results:
+        key = get_key(res)
+        if res['status'] != 'ok' or key not in base:
+            continue
+        old = base[key]
+        if res['throughput'] < (1 - tolerance) * old['throughput']:
+            msgs.append('%s %dpx x%d %s: throughput %.2f -> %.2f images/s' %
+                        (key + (old['throughput'], res['throughput'])))
+        if res['peak_memory'] is not None and old['peak_memory'] is not None:
+            if res['peak_memory'] > (1 + tolerance) * old['peak_memory']:
+                msgs.append('%s %dpx x%d %s: peak memory %.1f -> %.1f MB' %
+                            (key + (old['peak_memory'] / 2.**20,
+                                    res['peak_memory'] / 2.**20)))
+    return msgs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--models', nargs='+', default=sorted(MODELS.keys()),
+                        choices=sorted(MODELS.keys()))
+    parser.add_argument('--sizes', nargs='+', type=int, default=SIZES)
+    parser.add_argument('--batches', nargs='+', type=int, default=BATCHES)
+    parser.add_argument('--repeats', type=int, default=1,
+                        help='best of this many runs is reported')
+    parser.add_argument('--history', default='benchmark_history.json')
+    parser.add_argument('--baseline', default='benchmark_baseline.json')
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=.2)
+    parser.add_argument('--dtype', default='float64',
+                        choices=['float64', 'float32'])
+    parser.add_argument('--no-guards', action='store_true')
+    args = parser.parse_args(argv)
+
+    correct = None if args.no_guards else run_guards()
+
+    results = []
+    for model_name in args.models:
+        for size in args.sizes:
+            for batch_size in args.batches:
+                res = run_config(model_name, size, batch_size, args.repeats,
+                                 dtype=args.dtype)
+                if res['status'] == 'ok':
+                    mem = res['peak_memory']
+                    mem = 'n/a' if mem is None else '%.1f MB' % (mem / 2.**20)
+                    print '%-14s %4dpx x%-4d %10.2f images/s %12s' % (
+                        model_name, size, batch_size, res['throughput'], mem)
+                else:
+                    print '%-14s %4dpx x%-4d %s' % (model_name, size,
+                                                    batch_size, res['error'])
+                results.append(res)
+
+    deltas = {}
+    if args.dtype != 'float64':
+        for model_name in args.models:
+            deltas[model_name] = precision(model_name, min(args.sizes),
+                                           args.dtype)
+            if 'error' in deltas[model_name]:
+                print '%-14s %s' % (model_name, deltas[model_name]['error'])
+                continue
+            against = 'MatLab' if model_name in MATLAB_REFS else 'float64'
+            for name, (diff, rel) in sorted(deltas[model_name].items()):
+                print '%-14s %-10s max. difference from %s: %.3g ' \
+                      '(%.3g relative)' % (model_name, name, against, diff, rel)
+
+    run = {'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+           'platform': platform.platform(),
+           'python': platform.python_version(),
+           'numpy': np.__version__,
+           'correct': correct,
+           'dtype': args.dtype,
+           'precision': deltas,
+           'results': results}
+
+    if os.path.isfile(args.history):
+        history = json.load(open(args.history))
+    else:
+        history = []
+    history.append(run)
+    json.dump(history, open(args.history, 'w'), indent=1)
+
+    regressions = []
+    if args.save_baseline:
+        json.dump(run, open(args.baseline, 'w'), indent=1)
+        print 'saved baseline to %s' % args.baseline
+    elif os.path.isfile(args.baseline):
+        regressions = find_regressions(results, json.load(open(args.baseline)),
+                                       tolerance=args.tolerance)
+        for msg in regressions:
+            print 'REGRESSION: ' + msg
+
+    if correct is False or len(regressions) > 0:
+        return 1
+    else:
+        return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
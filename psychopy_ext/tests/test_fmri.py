@@ -0,0 +1,304 @@
+import os, shutil, tempfile, time
+import cPickle as pickle
+import numpy as np
+from .. import fmri
+
+import unittest
+
+class TestSplits(unittest.TestCase):
+    def setUp(self):
+        self.runtype = [0]*6 + [1]*3 + [-1]
+        self.nchunks = len(self.runtype)
+        self.targets = np.array([1, 2, 3, 4])
+        # chunk-major order, as after averaging per target per chunk
+        self.sample_targets = np.tile(self.targets, self.nchunks)
+        self.chunk_ind = np.repeat(np.arange(self.nchunks), len(self.targets))
+
+    def test_get_splits(self):
+        splits = fmri.get_splits(self.runtype, 20, seed=3)
+        for split in splits:
+            self.assertEqual(sorted(split), sorted(self.runtype))
+        np.testing.assert_array_equal(splits,
+                                      fmri.get_splits(self.runtype, 20, seed=3))
+        # iterations do not depend on how many of them there are
+        np.testing.assert_array_equal(splits[:5],
+                                      fmri.get_splits(self.runtype, 5, seed=3))
+        self.assertTrue(len(set([tuple(s) for s in splits])) > 1)
+        # without a seed, np.random.seed makes splits reproducible
+        np.random.seed(0)
+        splits = fmri.get_splits(self.runtype, 5)
+        np.random.seed(0)
+        np.testing.assert_array_equal(splits, fmri.get_splits(self.runtype, 5))
+
+    def test_pair_plan(self):
+        splits = fmri.get_splits(self.runtype, 5, seed=0)
+        sample_splits = splits[:, self.chunk_ind]
+        plan = fmri.PairPlan(self.sample_targets, sample_splits, self.targets)
+        self.assertEqual(len(plan.pairs), 6)
+        for n, split in enumerate(splits):
+            # the old loop assigned runtypes by repeating them per target
+            runtype = np.repeat(split, len(self.targets))
+            np.testing.assert_array_equal(sample_splits[n], runtype)
+            for i, j in plan.pairs:
+                pair = (self.targets[i], self.targets[j])
+                in_pair = np.array([k in pair for k in self.sample_targets])
+                train, test_i, test_j = plan.get(n, i, j)
+                np.testing.assert_array_equal(train,
+                    np.flatnonzero((runtype == 0) & in_pair))
+                np.testing.assert_array_equal(test_i, np.flatnonzero(
+                    (runtype == 1) & (self.sample_targets == pair[0])))
+                np.testing.assert_array_equal(test_j, np.flatnonzero(
+                    (runtype == 1) & (self.sample_targets == pair[1])))
+            for i, target in enumerate(self.targets):
+                train, test = plan.get_cond(n, i)
+                is_target = self.sample_targets == target
+                np.testing.assert_array_equal(train,
+                    np.flatnonzero((runtype == 0) & is_target))
+                np.testing.assert_array_equal(test,
+                    np.flatnonzero((runtype == 1) & is_target))
+
+
+class TestCorrelation(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        nchunks, ntargets, nvoxels = 7, 5, 20
+        # patterns averaged per target per chunk, in a shuffled order
+        order = rng.permutation(nchunks * ntargets)
+        self.targets = np.tile(np.arange(ntargets), nchunks)[order]
+        self.chunks = np.repeat(np.arange(nchunks), ntargets)[order]
+        self.samples = rng.randn(nchunks * ntargets, nvoxels)
+        self.samples += rng.randn(ntargets, nvoxels)[self.targets]
+        self.runtype = [0,1] * (nchunks//2) + [-1] * (nchunks%2)
+
+    def old_correlation(self, splits):
+        """The loop over splits that split_half_correlation replaced"""
+        samples = self.samples.copy()
+        targets = np.unique(self.targets)
+        for chunk in np.unique(self.chunks):
+            rows = self.chunks == chunk
+            samples[rows] -= np.mean(samples[rows], axis=0)
+        results = []
+        for split in splits:
+            runtype = split[np.searchsorted(np.unique(self.chunks),
+                                            self.chunks)]
+            split1 = np.array([np.mean(samples[(runtype == 0) &
+                              (self.targets == t)], axis=0) for t in targets])
+            split2 = np.array([np.mean(samples[(runtype == 1) &
+                              (self.targets == t)], axis=0) for t in targets])
+            corr = np.corrcoef(split1, split2)[:len(targets), len(targets):]
+            results.append((1 - corr) / 2.)
+        return np.array(results)
+
+    def test_loop(self):
+        nIter = 10
+        old = self.old_correlation(fmri.get_splits(self.runtype, nIter,
+                                                   seed=2))
+        header, results = fmri.split_half_correlation(self.samples,
+                            self.targets, self.chunks, nIter=nIter, seed=2)
+        self.assertEqual(header, ['iter', 'stim1.cond', 'stim2.cond',
+                                  'subjResp'])
+        self.assertEqual(len(results), old.size)
+        for n, t1, t2, dis in results:
+            self.assertAlmostEqual(dis, old[n, t1, t2])
+
+        targets, dis = fmri.split_half_correlation(self.samples,
+            self.targets, self.chunks, nIter=nIter, seed=2, compact=True)
+        np.testing.assert_array_equal(targets, np.unique(self.targets))
+        np.testing.assert_allclose(dis, old)
+
+        targets, dis = fmri.split_half_correlation(self.samples,
+            self.targets, self.chunks, nIter=nIter, seed=2, fisher=True,
+            compact=True)
+        corr = np.tanh(np.mean(np.arctanh(1 - 2 * old), axis=0))
+        np.testing.assert_allclose(dis, (1 - corr) / 2.)
+
+        header, results = fmri.split_half_correlation(self.samples,
+            self.targets, self.chunks, nIter=nIter, seed=2, fisher=True)
+        self.assertEqual(len(results), dis.size)
+        for n, t1, t2, d in results:
+            self.assertEqual(n, 0)
+            self.assertAlmostEqual(d, dis[t1, t2])
+
+
+@unittest.skipIf(fmri.mvpa2 is None, 'PyMVPA is not available')
+class TestSVM(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        nchunks, ntargets, nvoxels = 10, 4, 30
+        targets = np.tile(np.arange(1, ntargets+1), nchunks)
+        chunks = np.repeat(np.arange(nchunks), ntargets)
+        samples = rng.randn(len(targets), nvoxels)
+        samples[:, :ntargets] += 2 * (targets[:, np.newaxis] ==
+                                      np.arange(1, ntargets+1))
+        self.evds = fmri.mvpa2.suite.dataset_wizard(samples, targets=targets,
+                                                    chunks=chunks)
+        self.analysis = fmri.Analysis({}, 2, runParams={'rois': []})
+
+    def test_workers(self):
+        header, serial = self.analysis.svm(self.evds, nIter=4, seed=1)
+        header, parallel = self.analysis.svm(self.evds, nIter=4, seed=1,
+                                             workers=2)
+        self.assertEqual(serial, parallel)
+        # each pair is trained once and reported for both orders
+        acc = dict([((n, i, j), r) for n, i, j, r in serial])
+        for (n, i, j), r in acc.items():
+            self.assertEqual(r, acc[(n, j, i)])
+
+
+class PidAnalysis(fmri.Analysis):
+    """Records which process ran each job instead of analyzing data"""
+    def extract_rois(self, subjID, runType, rois, values='raw'):
+        return [r[1] for r in rois]
+
+    def run_job(self, subjID, runType, ROI_list, method='svm', values='raw',
+                offset=None, dur=None, filename='%s_%s_%s.pkl', simds=None,
+                ds=None):
+        time.sleep(.5)  # so that no process takes all jobs
+        return (subjID, ROI_list[1], method, values, ['pid', 'subjID', 'ROI'],
+                [[os.getpid(), subjID, ds]], .5)
+
+
+class TestRunMethod(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.filename = os.path.join(self.path, '%s_%s_%s.pkl')
+        self.rois = fmri.make_roi_pattern(['V1', 'LO'])
+        self.header = ['iter', 'stim1.cond', 'stim2.cond', 'subjResp',
+                       'subjID', 'ROI']
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def store(self, fname, rois):
+        result = [[0, 1, 2, .5, 'subj01', roi] for roi in rois]
+        pickle.dump([self.header, result], open(fname, 'wb'))
+        return result
+
+    def test_resume(self):
+        analysis = fmri.Analysis({}, 2, runParams={'rois': []})
+        results = []
+        for roi in ['V1', 'LO']:
+            fname = analysis._job_fname(self.filename, 'svm', 'raw',
+                                        'subj01', roi)
+            self.assertEqual(fname, os.path.join(self.path,
+                                                 'svm_raw_subj01_%s.pkl' % roi))
+            results += self.store(fname, [roi])
+        # nothing is extracted or computed, so no data are needed
+        header, res = analysis.run_method('subj01', 'main', self.rois,
+                                          filename=self.filename)
+        self.assertEqual(header, self.header)
+        self.assertEqual(res, results)
+        self.assertTrue(all([t['loaded'] for t in analysis.timing]))
+
+    def test_resume_old(self):
+        # a per-participant file from before per-job files, plus a job
+        analysis = fmri.Analysis({}, 2, runParams={'rois': []})
+        results = self.store(self.filename % ('svm', 'raw', 'subj01'),
+                             ['V1'])
+        results += self.store(analysis._job_fname(self.filename, 'svm', 'raw',
+                              'subj01', 'LO'), ['LO'])
+        header, res = analysis.run_method('subj01', 'main', self.rois,
+                                          filename=self.filename)
+        self.assertEqual(res, results)
+
+    @unittest.skipIf(fmri.mvpa2 is None, 'PyMVPA is not available')
+    def test_no_output(self):
+        rng = np.random.RandomState(0)
+        extracted = []
+
+        class Analysis(fmri.Analysis):
+            def extract_rois(self, subjID, runType, rois, values='raw'):
+                extracted.append([r[1] for r in rois])
+                return [fmri.mvpa2.suite.dataset_wizard(rng.randn(40, 10),
+                        targets=np.tile([1,2,3,4], 10),
+                        chunks=np.repeat(range(10), 4)) for r in rois]
+
+            def extract_samples(self, *args, **kwargs):
+                raise AssertionError('ROIs must be extracted in one pass')
+
+        analysis = Analysis({}, 2, runParams={'rois': [], 'noOutput': True})
+        header, res = analysis.run_method('subj01', 'main', self.rois,
+                                          method='corr', values='beta',
+                                          filename=self.filename)
+        self.assertEqual(extracted, [['V1', 'LO']])
+        self.assertEqual(set([line[-1] for line in res]), set(['V1', 'LO']))
+        self.assertEqual(os.listdir(self.path), [])
+
+    def test_parallel_rois(self):
+        analysis = PidAnalysis({}, 2, runParams={'rois': [],
+                                                 'noOutput': True})
+        header, res = analysis.run_method('subj01', 'main', self.rois,
+                                          filename=self.filename, workers=2)
+        # jobs get their own ROI's samples and run in both processes
+        self.assertEqual([line[1:] for line in res],
+                         [['subj01', 'V1'], ['subj01', 'LO']])
+        self.assertEqual(len(set([line[0] for line in res])), 2)
+        self.assertFalse(os.getpid() in [line[0] for line in res])
+
+    @unittest.skipIf(fmri.mvpa2 is None, 'PyMVPA is not available')
+    def test_interleaved(self):
+        rng = np.random.RandomState(0)
+        events = []
+
+        class Analysis(fmri.Analysis):
+            def extract_rois(self, subjID, runType, rois, values='raw'):
+                events.append(('extract', subjID))
+                return [fmri.mvpa2.suite.dataset_wizard(rng.randn(40, 10),
+                        targets=np.tile([1,2,3,4], 10),
+                        chunks=np.repeat(range(10), 4)) for r in rois]
+
+            def run_job(self, subjID, runType, ROI_list, *args, **kwargs):
+                events.append(('job', subjID, ROI_list[1]))
+                return super(Analysis, self).run_job(subjID, runType,
+                                                     ROI_list, *args, **kwargs)
+
+        analysis = Analysis({}, 2, runParams={'rois': [], 'noOutput': True})
+        analysis.run_method(['subj01', 'subj02'], 'main', self.rois,
+                            method='corr', values='beta',
+                            filename=self.filename)
+        self.assertEqual(events, [('extract', 'subj01'),
+                                  ('job', 'subj01', 'V1'),
+                                  ('job', 'subj01', 'LO'),
+                                  ('extract', 'subj02'),
+                                  ('job', 'subj02', 'V1'),
+                                  ('job', 'subj02', 'LO')])
+
+    @unittest.skipIf(fmri.mvpa2 is None, 'PyMVPA is not available')
+    def test_resume_interrupted(self):
+        rng = np.random.RandomState(0)
+        extracted = []
+
+        class Analysis(fmri.Analysis):
+            interrupt = 'subj02'
+
+            def extract_rois(self, subjID, runType, rois, values='raw'):
+                if subjID == self.interrupt:
+                    raise KeyboardInterrupt
+                extracted.append(subjID)
+                return [fmri.mvpa2.suite.dataset_wizard(rng.randn(40, 10),
+                        targets=np.tile([1,2,3,4], 10),
+                        chunks=np.repeat(range(10), 4)) for r in rois]
+
+        analysis = Analysis({}, 2, runParams={'rois': []})
+        self.assertRaises(KeyboardInterrupt, analysis.run_method,
+                          ['subj01', 'subj02'], 'main', self.rois,
+                          method='corr', values='beta', filename=self.filename)
+        # jobs of the first participant were stored before the interruption
+        for roi in ['V1', 'LO']:
+            self.assertTrue(os.path.isfile(analysis._job_fname(self.filename,
+                            'corr', 'beta', 'subj01', roi)))
+        analysis.interrupt = None
+        header, res = analysis.run_method(['subj01', 'subj02'], 'main',
+                                          self.rois, method='corr',
+                                          values='beta',
+                                          filename=self.filename)
+        self.assertEqual(extracted, ['subj01', 'subj02'])
+        self.assertEqual(set([tuple(line[-2:]) for line in res]),
+                         set([(s, r) for s in ['subj01', 'subj02']
+                              for r in ['V1', 'LO']]))
+        self.assertEqual([t['loaded'] for t in analysis.timing],
+                         [True, True, False, False])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,13 +1,171 @@
+import os, shutil, tempfile
 import numpy as np
+import scipy.ndimage
 from .. import models
 
 import unittest
 
+# MatLab outputs for the test image are stored next to this file
+REF_PATH = os.path.dirname(os.path.abspath(__file__))
+
+class TestDissimilarity(unittest.TestCase):
+    def setUp(self):
+        self.m = models.Model()
+        self.outputs = np.random.rand(20, 50)
+
+    def test_simple(self):
+        dis = self.m.dissimilarity(self.outputs, kind='simple', tile_size=6)
+        diff = self.outputs[:, np.newaxis] - self.outputs
+        dis_loop = np.sqrt(np.sum(diff**2, -1) / self.outputs.shape[1])
+        np.testing.assert_allclose(dis, dis_loop, atol=1e-10)
+
+    def test_corr(self):
+        dis = self.m.dissimilarity(self.outputs, kind='corr', tile_size=6)
+        np.testing.assert_allclose(dis, (1 - np.corrcoef(self.outputs)) / 2,
+                                   atol=1e-10)
+
+    def test_projection(self):
+        outputs = np.random.RandomState(0).rand(30, 5000)
+        for kind in ['simple', 'gaborjet', 'corr']:
+            dis = self.m.dissimilarity(outputs, kind=kind)
+            # principal components of 30 stimuli lose nothing
+            dis_pca = self.m.dissimilarity(outputs, kind=kind,
+                        n_components=30, projection='pca', tile_size=7)
+            self.assertTrue(self.m.distortion < 1e-10)
+            np.testing.assert_allclose(dis_pca, dis, atol=1e-8)
+            dis_sparse = self.m.dissimilarity(outputs, kind=kind,
+                                              n_components=1000)
+            self.assertTrue(self.m.distortion < 1)
+            if kind == 'simple':
+                ratio = dis_sparse[dis > 0]**2 / dis[dis > 0]**2
+                self.assertTrue(np.all(np.abs(ratio - 1) <
+                                       self.m.distortion))
+
+
+class TestFeatureCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_hmax(self):
+        m = models.HMAX()
+        m.cache = models.FeatureCache(self.path)
+        ims = np.random.rand(2, 64, 64)
+        out = m.test(ims)
+        out_cached = m.test(ims)
+        self.assertEqual(m.cache.stats['hits'], 2)
+        np.testing.assert_array_equal(out['C2'], out_cached['C2'])
+
+    def test_zoccolan(self):
+        m = models.Zoccolan()
+        m.cache = models.FeatureCache(self.path)
+        ims = np.random.rand(2, 60, 60)
+        out = m.test_batch(ims)
+        out_cached = m.test_batch(ims)
+        self.assertEqual(m.cache.stats['hits'], 2)
+        for V1resp, V1cached in zip(out, out_cached):
+            np.testing.assert_array_equal(V1resp, V1cached)
+
+    def test_eviction(self):
+        cache = models.FeatureCache(self.path, max_size=3000)
+        for i in range(5):
+            cache.set(str(i), x=np.zeros(100))
+        self.assertTrue(cache.size <= 3000)
+        self.assertTrue(cache.get('4') is not None)
+        self.assertTrue(cache.get('0') is None)
+
+
+class TestFeatureIndex(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_query(self):
+        rng = np.random.RandomState(0)
+        outputs = rng.rand(500, 40)
+        queries = outputs[:20] + .01 * rng.rand(20, 40)
+        for kind in ['simple', 'gaborjet']:
+            index = models.FeatureIndex(kind=kind)
+            index.add(outputs[:300])
+            index.add(outputs[300:])  # incremental insertion
+            inds, dis = index.query(queries, k=5, exact=True)
+            dis_all = models.Model().dissimilarity(queries, kind=kind,
+                                                   other=outputs)
+            np.testing.assert_array_equal(inds,
+                                          np.argsort(dis_all, axis=1)[:, :5])
+            np.testing.assert_allclose(dis, np.sort(dis_all, axis=1)[:, :5],
+                                       atol=1e-10)
+            inds_lsh, dis_lsh = index.query(queries, k=1)
+            np.testing.assert_array_equal(inds_lsh[:, 0], np.arange(20))
+
+            fname = self.path + '/index.npz'
+            index.save(fname)
+            loaded = models.FeatureIndex.load(fname)
+            np.testing.assert_array_equal(loaded.query(queries, k=5)[0],
+                                          index.query(queries, k=5)[0])
+
+
+class TestBatches(unittest.TestCase):
+    def test_run_batches(self):
+        m = models.Pixelwise()
+        ims = np.random.rand(7, 16, 16)
+        outs = [out['output'] for out in m.run_batches(ims, batch_size=3)]
+        self.assertEqual([len(out) for out in outs], [3, 3, 1])
+        np.testing.assert_array_equal(np.vstack(outs), m.run(ims))
+
+    def test_output(self):
+        m = models.Pixelwise()
+        path = tempfile.mkdtemp()
+        try:
+            for n in [7, 4]:  # a smaller rerun must not pick up old batches
+                ims = np.random.rand(n, 16, 16)
+                list(m.run_batches(ims, batch_size=3, output=path))
+                np.testing.assert_array_equal(
+                    models.load_batches(path, 'output'), m.run(ims))
+        finally:
+            shutil.rmtree(path)
+
+    def test_load_batches(self):
+        path = tempfile.mkdtemp()
+        try:
+            for n in [99999, 100000, 3]:
+                np.save(os.path.join(path, 'C1_%05d.npy' % n), [n])
+            # another output whose name starts with the same prefix
+            np.save(os.path.join(path, 'C1_max_00000.npy'), [-1])
+            np.save(os.path.join(path, 'C1_old.npy'), [-1])
+            np.testing.assert_array_equal(models.load_batches(path, 'C1'),
+                                          [3, 99999, 100000])
+            writer = models._BatchWriter(path)
+            writer.close()
+            self.assertEqual(os.listdir(path), ['C1_old.npy'])
+        finally:
+            shutil.rmtree(path)
+
+
+class TestZoccolan(unittest.TestCase):
+    def test_windows(self):
+        m = models.Zoccolan()
+        im = np.random.rand(64, 64)
+        rf = m.get_rf_px(m.rfs[0], im.shape)
+        gabors = m.get_gabors(rf).reshape((12, 2, 10, -1))
+        V1 = m.run(im)[0][0]
+        step = im.shape[0] // m.num_tiles[0]
+        for i, wi in enumerate(range(0, im.shape[0] - rf[0], step)):
+            for j, wj in enumerate(range(0, im.shape[1] - rf[1], step)):
+                window = im[wi:wi+rf[0], wj:wj+rf[1]]
+                resp = np.maximum(np.inner(gabors, window.ravel()), 0)
+                np.testing.assert_allclose(V1[..., i, j], resp, atol=1e-10)
+
+
 class TestHMAX(unittest.TestCase):
     def test_gaussian(self):
         m = models.HMAX(matlab=True, filt_type='gaussian')
         out = m.run()
-        fid = open('scripts/tests/lena_gaussian_matlab.txt')
+        fid = open(os.path.join(REF_PATH, 'lena_gaussian_matlab.txt'))
         c2_matlab = np.array([float(i.strip('\n')) for i in fid.readlines()])
         c2_python = np.around(out['C2'], decimals=5)  # matlab's output has 5
                                                       # significant digits
@@ -17,13 +175,147 @@ class TestHMAX(unittest.TestCase):
     def test_gabor(self):
         m = models.HMAX(matlab=False, filt_type='gabor')
         out = m.run()
-        fid = open('scripts/tests/lena_gabor_matlab.txt')
+        fid = open(os.path.join(REF_PATH, 'lena_gabor_matlab.txt'))
         c2_matlab = np.array([float(i.strip('\n')) for i in fid.readlines()])
         c2_python = np.around(out['C2'], decimals=5)  # matlab's output has 5
                                                       # significant digits
         rms = np.mean(np.sqrt((c2_matlab - c2_python)**2))
         self.assertEqual(rms, 0)
 
+    def test_S1_engines(self):
+        im = np.random.rand(128, 128)
+        out = {}
+        for engine in ['direct', 'separable', 'fft']:
+            m = models.HMAX(S1_engine=engine)
+            out[engine] = m.test(im[np.newaxis])
+        for engine in ['separable', 'fft']:
+            np.testing.assert_allclose(out[engine]['C1'],
+                                       out['direct']['C1'], atol=1e-10)
+            np.testing.assert_allclose(out[engine]['C2'],
+                                       out['direct']['C2'], atol=1e-10)
+
+    def test_mask_sum(self):
+        im = np.random.rand(40, 37)
+        im[:10] = 0
+        for filt_type in ['gaussian', 'gabor']:
+            m = models.HMAX(filt_type=filt_type)
+            energy = m.get_S1_energy(im)
+            for fs in [7, 8, 29]:
+                mask = m.get_mask(fs).astype(float)
+                norm = scipy.ndimage.convolve(im**2, mask, mode='constant')
+                np.testing.assert_allclose(m.get_mask_sum(energy, 'energy',
+                                           fs), norm, atol=1e-10)
+                count = scipy.ndimage.convolve((im != 0) * 1., mask,
+                                               mode='constant')
+                np.testing.assert_array_equal(m.get_mask_sum(energy, 'count',
+                                              fs), count)
+
+    def test_separable(self):
+        m = models.HMAX(filt_type='gabor')
+        m.S1_sep_tol = 1e-2
+        filts = m.filts[3][0]
+        for i, comps in enumerate(m.get_separable(3, 0)):
+            approx = sum([np.outer(col, row) for col, row in comps])
+            err = np.linalg.norm(approx - filts[:,:,i])
+            self.assertTrue(err <= 1e-2 * np.linalg.norm(filts[:,:,i]))
+            self.assertTrue(len(comps) < filts.shape[0])
+
+    def test_workers(self):
+        m = models.HMAX()
+        ims = np.random.rand(3, 64, 64)
+        out = m.test(ims)
+        out_parallel = m.test(ims, workers=2)
+        np.testing.assert_array_equal(out['C1'], out_parallel['C1'])
+        np.testing.assert_array_equal(out['C2'], out_parallel['C2'])
+
+    def test_profiler(self):
+        m = models.HMAX()
+        m.profiler = models.Profiler()
+        m.test(np.random.rand(2, 64, 64))
+        layers = set([rec['layer'] for rec in m.profiler.records])
+        self.assertTrue(set(['S1', 'C1', 'S2+C2']) <= layers)
+        nbands = len(m.filter_sizes_all)
+        s1 = [rec for rec in m.profiler.records if rec['layer'] == 'S1']
+        self.assertEqual(len(s1), 2 * nbands)
+        for rec in s1:
+            self.assertEqual(rec['out_bytes'],
+                             8 * np.prod(rec['shape']))  # float64
+        for rec in m.profiler.records:
+            if models.resource is None:
+                self.assertTrue(rec['peak_bytes'] is None)
+            else:
+                self.assertTrue(rec['peak_bytes'] >= 0)
+        self.assertTrue('peak+, MB' in m.profiler.summary())
+
+    def test_S2_C2(self):
+        m = models.HMAX()
+        m.S2_block_size = 1000  # force many blocks
+        C1 = np.random.rand(64, 64, m.n_ori)
+        S2 = m.get_S2(C1, 1)
+        np.testing.assert_allclose(m.get_S2_C2(C1, 1), m.get_C2(S2, 1))
+
+    def test_C1_grid(self):
+        m = models.HMAX()
+        ims = np.random.rand(2, 50, 37)
+        for band in range(len(m.filter_sizes_all)):
+            S1 = m.get_S1(ims[0], band)
+            shift = m.get_S2_shift(band)
+            np.testing.assert_array_equal(m.get_C1_grid(S1, band),
+                                          m.get_C1(S1, band)[::shift, ::shift])
+        out = m.test(ims, keep_C1=False)
+        self.assertTrue('C1' not in out)
+        np.testing.assert_allclose(out['C2'], m.test(ims)['C2'])
+
+    def test_S2_dict(self):
+        ims = np.random.rand(2, 64, 64)
+        m = models.HMAX()
+        seq = m.get_S2_seq()
+        C2 = m.test(ims)['C2']
+        m_sampled = models.HMAX(S2_dict=20, S2_seed=1)
+        seq_sampled = m_sampled.get_S2_seq()
+        self.assertEqual(len(set([tuple(c) for c in seq_sampled])), 20)
+        idx = [np.nonzero(np.all(seq == c, 1))[0][0] for c in seq_sampled]
+        np.testing.assert_allclose(m_sampled.test(ims)['C2'], C2[:, idx])
+        m_given = models.HMAX(S2_dict=seq[::-10])
+        np.testing.assert_allclose(m_given.test(ims)['C2'], C2[:, ::-10])
+        m_given.S2_dict = seq[::-5].tolist()  # a new dictionary is noticed
+        np.testing.assert_allclose(m_given.test(ims)['C2'], C2[:, ::-5])
+        m_large = models.HMAX(S2_config=(3,3), S2_dict=50)
+        self.assertEqual(m_large.test(ims)['C2'].shape, (2, 50))
+
+    def test_VTU(self):
+        ims = np.random.rand(3, 64, 64)
+        protos = np.random.rand(5, 64, 64)
+        m = models.HMAX()
+        m.train(protos)
+        VTU = m.test(ims)['VTU']
+        m_inc = models.HMAX()
+        m_inc.train(protos[:2])
+        m_inc.train(protos[2:], append=True)
+        np.testing.assert_allclose(m_inc.test(ims)['VTU'], VTU)
+        m_inc.VTU_top_k = 2
+        VTU_sparse = m_inc.test(ims)['VTU'].toarray()
+        for resp, resp_sparse in zip(VTU, VTU_sparse):
+            top = np.argsort(resp)[-2:]
+            np.testing.assert_allclose(resp_sparse[top], resp[top])
+            self.assertEqual(np.sum(resp_sparse > 0), 2)
+
+    def test_float32(self):
+        m = models.HMAX(S1_engine='fft')
+        ims = np.random.rand(2, 64, 64)
+        delta = m.precision_delta(ims, dtype='float32')
+        self.assertTrue(delta['C2'][1] < 1e-5)
+        m.dtype = 'float32'
+        self.assertEqual(m.test(ims)['C2'].dtype, np.float32)
+
+    def test_float32_matlab(self):
+        m = models.HMAX(matlab=True, filt_type='gaussian')
+        c2_matlab = np.genfromtxt(os.path.join(REF_PATH,
+                                               'lena_gaussian_matlab.txt'))
+        delta = m.precision_delta(dtype='float32', ref={'C2': c2_matlab})
+        self.assertTrue(delta['C2'][0] < 1e-5)  # matlab's output has 5
+                                                # significant digits
+
 
 class TestGaborJets(unittest.TestCase):
     def setUp(self):
@@ -31,14 +323,15 @@ class TestGaborJets(unittest.TestCase):
         self.mag, self.phase, self.grid = m.run()
 
     def test_mag(self):
-        mag_matlab = np.genfromtxt('scripts/tests/jet_mag.txt', delimiter=',')
+        mag_matlab = np.genfromtxt(os.path.join(REF_PATH, 'jet_mag.txt'),
+                                   delimiter=',')
         mag_python = np.around(self.mag, decimals=5)  # matlab's output has 5
                                                       # significant digits
         rms = np.mean(np.sqrt((mag_matlab - mag_python)**2))
         self.assertTrue(rms, 0)
 
     def test_phase(self):
-        phase_matlab = np.genfromtxt('scripts/tests/jet_phase.txt',
+        phase_matlab = np.genfromtxt(os.path.join(REF_PATH, 'jet_phase.txt'),
                                      delimiter=',')
         phase_python = np.around(self.mag, decimals=5) # matlab's output has 5
                                                        # significant digits
@@ -46,5 +339,48 @@ class TestGaborJets(unittest.TestCase):
         self.assertTrue(rms, 0)
 
 
+class TestGaborJetSynthetic(unittest.TestCase):
+    def test_batch(self):
+        m = models.GaborJet()
+        ims = np.random.rand(3, 128, 128)
+        mag, phase, grid = m.run(ims, batch_size=2)
+        for imno, im in enumerate(ims):
+            mag_im, phase_im, grid_im = m.test(im)
+            np.testing.assert_allclose(mag[imno], mag_im.ravel())
+            np.testing.assert_allclose(phase[imno], phase_im.ravel())
+
+    def test_sparse(self):
+        m = models.GaborJet()
+        ims = np.random.rand(2, 128, 128)
+        mag_fft, phase_fft, grid = m.test_batch(ims, mode='fft')
+        mag, phase, grid = m.test_batch(ims, mode='sparse')
+        np.testing.assert_allclose(mag, mag_fft, rtol=1e-8)
+        mag, phase, grid = m.test_batch(ims, mode='sparse', phase=False)
+        np.testing.assert_allclose(mag, mag_fft, rtol=1e-8)
+        self.assertIsNone(phase)
+
+
+class TestGaborJetPrecision(unittest.TestCase):
+    def test_float32(self):
+        ims = np.random.rand(2, 128, 128)
+        mag64, phase64, grid = models.GaborJet().test_batch(ims, mode='fft')
+        m = models.GaborJet()
+        m.dtype = 'float32'
+        mag, phase, grid = m.test_batch(ims, mode='fft')
+        self.assertEqual(mag.dtype, np.float32)
+        np.testing.assert_allclose(mag, mag64, rtol=1e-4,
+                                   atol=1e-5 * np.max(mag64))
+
+    def test_float32_matlab(self):
+        m = models.GaborJet()
+        mag_matlab = np.genfromtxt(os.path.join(REF_PATH, 'jet_mag.txt'),
+                                   delimiter=',')
+        delta = m.precision_delta(dtype='float32',
+                                  ref={'magnitude': mag_matlab})
+        # matlab's output has 5 significant digits and goes up to about 70,
+        # so only a relative difference is meaningful
+        self.assertTrue(delta['magnitude'][1] < 5e-5)
+
+
 if __name__ == '__main__':
     unittest.main()
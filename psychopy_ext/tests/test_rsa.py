@@ -0,0 +1,62 @@
+import numpy as np
+import scipy.stats
+import pandas
+from .. import rsa
+
+import unittest
+
+class TestRSA(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.model = rng.rand(2, 8, 8)
+        self.model += self.model.transpose((0,2,1))
+        # two participants, three ROIs; the first ROI follows the first model
+        self.data = rng.rand(2, 3, 8, 8)
+        self.data += self.data.transpose((0,1,3,2))
+        self.data[:, 0] += 2 * self.model[0]
+
+    def test_compare(self):
+        res = rsa.compare_rdms(self.data, self.model, n_perm=200)
+        for s in range(2):
+            for r in range(3):
+                for m in range(2):
+                    rho = scipy.stats.spearmanr(rsa.condense(self.data[s,r]),
+                                                rsa.condense(self.model[m]))[0]
+                    self.assertAlmostEqual(res['corr'][s,r,m], rho)
+
+        # permutation test with an explicit loop over permutations
+        rows, cols = np.triu_indices(8, k=1)
+        rng = np.random.RandomState(0)
+        null = []
+        for p in range(200):
+            perm = rng.permutation(8)
+            model = self.model[1][perm][:, perm]
+            null.append(np.mean([scipy.stats.spearmanr(
+                rsa.condense(self.data[s,2]), rsa.condense(model))[0]
+                for s in range(2)]))
+        np.testing.assert_allclose(res['null'][:, 2, 1], null, atol=1e-12)
+        self.assertTrue(res['p'][0,0] < .05)
+
+        res_par = rsa.compare_rdms(self.data, self.model, n_perm=200,
+                                   workers=2, chunk_size=7)
+        for key in ['corr', 'p', 'p_subj', 'null']:
+            np.testing.assert_allclose(res_par[key], res[key])
+
+    def test_df2rdms(self):
+        lines = []
+        for s in range(2):
+            for r, roi in enumerate(['V1', 'LO']):
+                for i in range(8):
+                    for j in range(8):
+                        lines.append([0, i, j, self.data[s,r,i,j],
+                                      'subj%d' % s, roi])
+        df = pandas.DataFrame(lines, columns=['iter', 'stim1.cond',
+                              'stim2.cond', 'subjResp', 'subjID', 'ROI'])
+        rdms, subjIDs, rois, conds = rsa.df2rdms(df)
+        self.assertEqual(rois, ['V1', 'LO'])
+        np.testing.assert_allclose(rsa.condense(rdms),
+                                   rsa.condense(self.data[:, :2]))
+
+
+if __name__ == '__main__':
+    unittest.main()